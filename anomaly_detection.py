@@ -0,0 +1,216 @@
+"""
+Anomaly Detection - Flags unusual hourly station readings against running per-station baselines
+Baselines are streaming mean/variance (Welford) per station, metric, season and hour of day, kept in
+anomaly_baselines; each run only scores hours newer than a station's last processed hour.
+"""
+import argparse
+import math
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional
+import config
+
+# Hourly station means that are scored; rainfall is too skewed for a z-score
+ANOMALY_METRICS = ('temperature_c', 'humidity_percent', 'pressure_pa', 'wind_speed_ms')
+
+# Meteorological seasons by month (12 -> DJF)
+SEASONS = ('DJF', 'MAM', 'JJA', 'SON')
+
+# Baseline used while a station's season/hour bucket has too few samples
+OVERALL_BUCKET = 'all'
+
+ANOMALY_BASELINES_DDL = """
+    CREATE TABLE IF NOT EXISTS anomaly_baselines (
+        station_id LowCardinality(String),
+        metric LowCardinality(String),
+        bucket LowCardinality(String),
+        count UInt64,
+        mean Float64,
+        m2 Float64,
+        last_hour DateTime,
+        version UInt64
+    ) ENGINE = ReplacingMergeTree(version)
+    ORDER BY (station_id, metric, bucket)
+"""
+
+OBSERVATION_ANOMALIES_DDL = """
+    CREATE TABLE IF NOT EXISTS observation_anomalies (
+        station_id LowCardinality(String),
+        hour DateTime,
+        metric LowCardinality(String),
+        value Float64,
+        baseline_mean Float64,
+        baseline_std Float64,
+        z_score Float64,
+        baseline_bucket LowCardinality(String),
+        baseline_count UInt64,
+        detected_at DateTime
+    ) ENGINE = ReplacingMergeTree(detected_at)
+    PARTITION BY toYYYYMM(hour)
+    ORDER BY (hour, station_id, metric)
+"""
+
+# Hours per scoring query, keeps the IN list bounded
+SCORE_CHUNK_HOURS = 1000
+
+def season_bucket(hour: datetime) -> str:
+    """Seasonal baseline key, e.g. 'JJA-14' for a summer 14:00 (UTC) reading"""
+    return f"{SEASONS[hour.month % 12 // 3]}-{hour.hour:02d}"
+
+class AnomalyDetector:
+    def __init__(self, client=None, z_threshold: Optional[float] = None, min_samples: Optional[int] = None):
+        if client is None:
+            from clickhouse_pool import ClickHousePool
+            client = ClickHousePool(size=1)
+        self.client = client
+        self.z_threshold = z_threshold or config.ANOMALY_Z_THRESHOLD
+        self.min_samples = min_samples or config.ANOMALY_MIN_SAMPLES
+
+    def _load_baselines(self) -> Dict[tuple, Dict]:
+        rows = self.client.execute("""
+            SELECT station_id, metric, bucket, count, mean, m2, toUnixTimestamp(last_hour)
+            FROM anomaly_baselines FINAL
+        """)
+        return {
+            (station_id, metric, bucket): {'count': count, 'mean': mean, 'm2': m2, 'last_hour': last_hour}
+            for station_id, metric, bucket, count, mean, m2, last_hour in rows
+        }
+
+    def _score(self, baseline: Optional[Dict], value: float) -> Optional[tuple]:
+        """(z-score, std) against a baseline with enough samples, else None"""
+        if not baseline or baseline['count'] < self.min_samples:
+            return None
+        std = math.sqrt(baseline['m2'] / (baseline['count'] - 1))
+        if std == 0:
+            return None
+        return (value - baseline['mean']) / std, std
+
+    @staticmethod
+    def _update(baseline: Dict, value: float, hour_ts: int):
+        """Welford's online update of count, mean and sum of squared deviations"""
+        baseline['count'] += 1
+        delta = value - baseline['mean']
+        baseline['mean'] += delta / baseline['count']
+        baseline['m2'] += delta * (value - baseline['mean'])
+        baseline['last_hour'] = max(baseline['last_hour'], hour_ts)
+
+    def process(self, hours: Iterable[int]) -> int:
+        """Score the hourly station means of the given hours (unix seconds) and fold them into the baselines.
+        Hours at or before a station's last processed hour are skipped, so re-loaded history costs nothing."""
+        baselines = self._load_baselines()
+        watermarks: Dict[str, int] = {}
+        for (station_id, _, _), baseline in baselines.items():
+            watermarks[station_id] = max(watermarks.get(station_id, 0), baseline['last_hour'])
+
+        # Hours older than every station's watermark are dropped up front (a station first seen later
+        # only learns from there on); the rest are filtered per station in the query
+        oldest_watermark = min(watermarks.values()) if watermarks else 0
+        hours = sorted(hour for hour in set(hours) if hour > oldest_watermark)
+        if not hours:
+            return 0
+
+        stations = list(watermarks)
+        watermark_filter = ("AND toUnixTimestamp(toStartOfHour(timestamp)) > "
+                            "transform(toString(station_id), %(stations)s, %(watermarks)s, toUInt32(0))") if stations else ""
+        detected_at = datetime.now(timezone.utc)
+        anomalies = []
+        changed = set()
+        for i in range(0, len(hours), SCORE_CHUNK_HOURS):
+            chunk = hours[i:i + SCORE_CHUNK_HOURS]
+            rows = self.client.execute(f"""
+                SELECT
+                    station_id,
+                    toUnixTimestamp(toStartOfHour(timestamp)) as hour_ts,
+                    {', '.join(f'avg({metric})' for metric in ANOMALY_METRICS)}
+                FROM weather_observations
+                WHERE timestamp >= toDateTime(%(start)s) AND timestamp < toDateTime(%(end)s)
+                  AND toUnixTimestamp(toStartOfHour(timestamp)) IN %(hours)s
+                  {watermark_filter}
+                GROUP BY station_id, hour_ts
+                ORDER BY hour_ts
+            """, {'start': chunk[0], 'end': chunk[-1] + 3600, 'hours': chunk,
+                  'stations': stations, 'watermarks': [watermarks[s] for s in stations]})
+
+            for station_id, hour_ts, *values in rows:
+                hour = datetime.fromtimestamp(hour_ts, timezone.utc)
+                bucket = season_bucket(hour)
+                for metric, value in zip(ANOMALY_METRICS, values):
+                    if value is None or math.isnan(value):
+                        continue
+                    keys = [(station_id, metric, bucket), (station_id, metric, OVERALL_BUCKET)]
+                    for key in keys:
+                        baselines.setdefault(key, {'count': 0, 'mean': 0.0, 'm2': 0.0, 'last_hour': 0})
+
+                    # Score against the season/hour baseline, falling back to the station-wide one while it warms up
+                    for key in keys:
+                        scored = self._score(baselines[key], value)
+                        if scored:
+                            z_score, std = scored
+                            if abs(z_score) >= self.z_threshold:
+                                anomalies.append((station_id, hour, metric, value, baselines[key]['mean'], std,
+                                                  z_score, key[2], baselines[key]['count'], detected_at))
+                            break
+
+                    # Scored against the history before this hour, then folded in
+                    for key in keys:
+                        self._update(baselines[key], value, hour_ts)
+                        changed.add(key)
+
+        if anomalies:
+            self.client.execute("INSERT INTO observation_anomalies VALUES", anomalies)
+        if changed:
+            version = time.time_ns()
+            self.client.execute("INSERT INTO anomaly_baselines VALUES", [
+                (*key, baselines[key]['count'], baselines[key]['mean'], baselines[key]['m2'],
+                 datetime.fromtimestamp(baselines[key]['last_hour'], timezone.utc), version)
+                for key in changed
+            ])
+        print(f"Anomaly detection: scored {len(hours)} hours, flagged {len(anomalies)} readings")
+        return len(anomalies)
+
+    def get_recent_anomalies(self, days: int = 7, limit: int = 200) -> List[Dict]:
+        """Flagged readings of the last N days, newest first"""
+        rows = self.client.execute(f"""
+            SELECT station_id, hour, metric, value, baseline_mean, baseline_std, z_score, baseline_bucket, baseline_count
+            FROM observation_anomalies FINAL
+            WHERE hour >= now() - INTERVAL {int(days)} DAY
+            ORDER BY hour DESC, abs(z_score) DESC
+            LIMIT {int(limit)}
+        """)
+        return [
+            {
+                'station_id': row[0],
+                'hour': row[1].isoformat() if hasattr(row[1], 'isoformat') else str(row[1]),
+                'metric': row[2],
+                'value': row[3],
+                'baseline_mean': row[4],
+                'baseline_std': row[5],
+                'z_score': row[6],
+                'baseline_bucket': row[7],
+                'baseline_count': row[8]
+            }
+            for row in rows
+        ]
+
+    def reset(self):
+        """Forget all baselines and flags; the next pipeline run relearns from the hours it loads"""
+        self.client.execute("TRUNCATE TABLE anomaly_baselines")
+        self.client.execute("TRUNCATE TABLE observation_anomalies")
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or reset observation anomaly detection")
+    parser.add_argument("command", choices=["recent", "reset"])
+    parser.add_argument("--days", type=int, default=config.ANOMALY_CACHE_DAYS)
+    args = parser.parse_args()
+
+    detector = AnomalyDetector()
+    if args.command == "reset":
+        detector.reset()
+        print("Cleared anomaly baselines and flags")
+        return
+    for a in detector.get_recent_anomalies(args.days):
+        print(f"{a['hour']}  {a['station_id']:8} {a['metric']:18} {a['value']:>10.2f}  "
+              f"z={a['z_score']:+.1f} (mean {a['baseline_mean']:.2f}, {a['baseline_bucket']}, n={a['baseline_count']})")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+CDC Consumer - Streams new enriched MongoDB documents into ClickHouse via a change stream
+Requires MongoDB running as a replica set (a single-node replica set is enough)
+"""
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+from pymongo.errors import OperationFailure
+import config
+from clickhouse_etl import ClickHouseETL
+
+# MongoDB error code when the resume token has fallen off the oplog
+CHANGE_STREAM_HISTORY_LOST = 286
+
+class ChangeStreamCDC:
+    def __init__(self, clickhouse_etl: Optional[ClickHouseETL] = None):
+        self.clickhouse_etl = clickhouse_etl or ClickHouseETL()
+        self.mongodb_etl = self.clickhouse_etl.mongodb_etl
+        self.state_collection = self.mongodb_etl.db[config.MONGODB_COLLECTION_CDC_STATE]
+        self.consumer_id = f"{config.MONGODB_COLLECTION_ENRICHED}->weather_observations"
+        self.batch_window_sec = config.CDC_BATCH_WINDOW_SEC
+        self.batch_max_docs = config.CDC_BATCH_MAX_DOCS
+        self.aggregate_interval_sec = config.CDC_AGGREGATE_INTERVAL_SEC
+        self._last_aggregate_time = 0.0
+
+    def _watch(self, resume_token: Optional[Dict] = None):
+        return self.mongodb_etl.enriched_collection.watch(
+            [{'$match': {'operationType': 'insert'}}],
+            resume_after=resume_token,
+            max_await_time_ms=250
+        )
+
+    def _load_resume_token(self) -> Optional[Dict]:
+        state = self.state_collection.find_one({'_id': self.consumer_id})
+        return state.get('resume_token') if state else None
+
+    def _save_resume_token(self, resume_token: Dict, docs_loaded: int):
+        self.state_collection.update_one(
+            {'_id': self.consumer_id},
+            {
+                '$set': {'resume_token': resume_token, 'updated_at_utc': datetime.utcnow()},
+                '$inc': {'documents_processed': docs_loaded}
+            },
+            upsert=True
+        )
+
+    def _ingest_lag_sec(self, enriched_docs: List[Dict]) -> Optional[float]:
+        """Seconds between the oldest document's enrichment and now"""
+        ingest_times = []
+        for doc in enriched_docs:
+            try:
+                ingest_times.append(datetime.fromisoformat(doc['ingest_time_utc'].rstrip('Z')))
+            except (KeyError, AttributeError, ValueError):
+                continue
+        if not ingest_times:
+            return None
+        return (datetime.utcnow() - min(ingest_times)).total_seconds()
+
+    def record_start_position(self) -> bool:
+        """Save the current stream position if none is saved yet. Call before the initial full sync, so
+        documents inserted while it runs are picked up by the consumer rather than lost."""
+        if self._load_resume_token() is not None:
+            return False
+        # Opening a stream returns a token for "now" (postBatchResumeToken) without consuming changes
+        with self._watch() as stream:
+            resume_token = stream.resume_token
+        if resume_token is None:
+            print("Warning: MongoDB returned no initial resume token; CDC will start from when it runs")
+            return False
+        self._save_resume_token(resume_token, 0)
+        return True
+
+    def flush(self, enriched_docs: List[Dict]) -> int:
+        """Load the raw batches referenced by a micro-batch of enriched documents into ClickHouse"""
+        raw_ids = [doc['raw_doc_id'] for doc in enriched_docs if doc.get('raw_doc_id') is not None]
+        legacy_docs = [doc for doc in enriched_docs if 'date' in doc and 'max_temp_c' in doc]
+        raw_docs = list(self.mongodb_etl.raw_collection.find({'_id': {'$in': raw_ids}})) if raw_ids else []
+
+        rows = self.clickhouse_etl.load_documents(raw_docs, legacy_docs)
+        if rows:
+            self.clickhouse_etl.detect_anomalies()
+        lag = self._ingest_lag_sec(enriched_docs)
+        print(f"[{datetime.now()}] CDC loaded {rows} observations from {len(enriched_docs)} documents"
+              + (f" (end-to-end lag {lag:.1f}s)" if lag is not None else ""))
+
+        # Aggregates are refreshed on their own, slower cadence
+        if rows and time.monotonic() - self._last_aggregate_time >= self.aggregate_interval_sec:
+            self.clickhouse_etl.compute_aggregates(config.SYNC_INTERVAL_MONGODB_TO_CLICKHOUSE)
+            self._last_aggregate_time = time.monotonic()
+        return rows
+
+    def run(self, stop_event: Optional[threading.Event] = None):
+        """Consume inserts on the enriched collection, flushing every batch window or batch size"""
+        stop_event = stop_event or threading.Event()
+        resume_token = self._load_resume_token()
+        print(f"Starting CDC consumer on {config.MONGODB_COLLECTION_ENRICHED} "
+              f"({'resuming' if resume_token else 'from now'}, window {self.batch_window_sec}s)")
+
+        backoff_sec = config.CDC_RETRY_BACKOFF_SEC
+        while not stop_event.is_set():
+            try:
+                # After an error the stream reopens at the last saved token; unsaved batches are replayed
+                resume_token = self._load_resume_token()
+                with self._watch(resume_token) as stream:
+                    buffer = []
+                    first_buffered_at = None
+                    while not stop_event.is_set() and stream.alive:
+                        change = stream.try_next()
+                        if change is not None:
+                            buffer.append(change['fullDocument'])
+                            first_buffered_at = first_buffered_at or time.monotonic()
+
+                        window_elapsed = first_buffered_at and time.monotonic() - first_buffered_at >= self.batch_window_sec
+                        if buffer and (len(buffer) >= self.batch_max_docs or window_elapsed):
+                            self.flush(buffer)
+                            # Token is saved only after the load succeeded: at-least-once delivery, and a
+                            # replayed batch is harmless since loads skip observations already loaded
+                            resume_token = stream.resume_token
+                            self._save_resume_token(resume_token, len(buffer))
+                            buffer = []
+                            first_buffered_at = None
+                            backoff_sec = config.CDC_RETRY_BACKOFF_SEC
+            except Exception as e:
+                if isinstance(e, OperationFailure) and e.code == CHANGE_STREAM_HISTORY_LOST:
+                    print("Warning: CDC resume token is no longer in the oplog; run a full sync_from_mongodb "
+                          "to backfill, continuing from now")
+                    self.state_collection.delete_one({'_id': self.consumer_id})
+                    continue
+                # ClickHouse or MongoDB unavailable, pool exhausted, ...: keep the consumer alive
+                print(f"[{datetime.now()}] CDC consumer error: {e!r}; retrying from the last saved "
+                      f"resume token in {backoff_sec:.0f}s")
+                stop_event.wait(backoff_sec)
+                backoff_sec = min(backoff_sec * 2, config.CDC_RETRY_MAX_BACKOFF_SEC)
+
+    def start_background(self) -> threading.Event:
+        """Run the consumer on a daemon thread; set the returned event to stop it"""
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self.run, args=(stop_event,), daemon=True, name="cdc-consumer")
+        thread.start()
+        return stop_event
+
+if __name__ == '__main__':
+    consumer = ChangeStreamCDC()
+    try:
+        consumer.run()
+    except KeyboardInterrupt:
+        print("\n\nCDC consumer stopped by user")
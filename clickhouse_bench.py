@@ -0,0 +1,101 @@
+"""
+ClickHouse Bench - Measures bulk insert and wide read throughput per wire compression and block size
+Uses a scratch copy of the weather_observations schema filled with synthetic rows
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List
+from clickhouse_etl import OBSERVATIONS_TABLE_DDL, create_client
+
+BENCH_TABLE = "bench_weather_observations"
+
+def synthetic_rows(count: int, seed: int = 42) -> List[tuple]:
+    """Observation rows shaped like the real ones: a few stations, 5-minute spacing, noisy measures"""
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    now = datetime.utcnow()
+    rows = []
+    for i in range(count):
+        station = f"K{'ABCDEFGH'[i % 8]}{'XYZ'[i % 3]}"
+        timestamp = start + timedelta(minutes=5 * i)
+        rows.append((
+            f"{station}_{int(timestamp.timestamp())}",
+            station,
+            timestamp,
+            round(15 + rng.gauss(0, 6), 1),
+            round(max(0.0, rng.gauss(0, 0.5)), 2) if rng.random() < 0.2 else None,
+            round(min(100.0, max(5.0, rng.gauss(60, 15))), 1),
+            round(abs(rng.gauss(3, 2)), 1),
+            round(101325 + rng.gauss(0, 400)),
+            now,
+            now,
+            f"req_{i // 1000}",
+            f"batch_{i // 1000}"
+        ))
+    return rows
+
+def run_case(compression: str, block_size: int, rows: List[tuple], read_runs: int) -> Dict:
+    client = create_client(compression=compression, insert_block_size=block_size)
+    client.execute(f"TRUNCATE TABLE {BENCH_TABLE}")
+
+    started = time.perf_counter()
+    client.execute(f"INSERT INTO {BENCH_TABLE} VALUES", rows)
+    insert_sec = time.perf_counter() - started
+
+    # Wide read: every column of every row, buffered vs streamed
+    buffered, streamed = [], []
+    for _ in range(read_runs):
+        started = time.perf_counter()
+        client.execute(f"SELECT * FROM {BENCH_TABLE}")
+        buffered.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        for _row in client.execute_iter(f"SELECT * FROM {BENCH_TABLE}", settings={'max_block_size': block_size}):
+            pass
+        streamed.append(time.perf_counter() - started)
+    client.disconnect()
+
+    return {
+        'compression': compression,
+        'block_size': block_size,
+        'insert_rows_per_sec': len(rows) / insert_sec,
+        'read_rows_per_sec': len(rows) / min(buffered),
+        'stream_rows_per_sec': len(rows) / min(streamed)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ClickHouse wire compression and block sizes")
+    parser.add_argument("--rows", type=int, default=500000)
+    parser.add_argument("--compression", nargs="+", default=["none", "lz4", "zstd"])
+    parser.add_argument("--block-sizes", nargs="+", type=int, default=[10000, 100000, 1000000])
+    parser.add_argument("--read-runs", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"Generating {args.rows} synthetic observation rows...")
+    rows = synthetic_rows(args.rows)
+
+    setup = create_client(compression="none")
+    setup.execute(f"DROP TABLE IF EXISTS {BENCH_TABLE}")
+    setup.execute(OBSERVATIONS_TABLE_DDL.format(table=BENCH_TABLE))
+
+    results = []
+    try:
+        for compression in args.compression:
+            for block_size in args.block_sizes:
+                result = run_case(compression, block_size, rows, args.read_runs)
+                results.append(result)
+                print(f"{compression:>6} block {block_size:>8}: insert {result['insert_rows_per_sec']:>10.0f} rows/s, "
+                      f"read {result['read_rows_per_sec']:>10.0f} rows/s, stream {result['stream_rows_per_sec']:>10.0f} rows/s")
+    finally:
+        setup.execute(f"DROP TABLE IF EXISTS {BENCH_TABLE}")
+        setup.disconnect()
+
+    best_insert = max(results, key=lambda r: r['insert_rows_per_sec'])
+    best_read = max(results, key=lambda r: r['stream_rows_per_sec'])
+    print(f"\nFastest insert: {best_insert['compression']} with block size {best_insert['block_size']}")
+    print(f"Fastest streamed read: {best_read['compression']} with block size {best_read['block_size']}")
+
+if __name__ == '__main__':
+    main()
@@ -2,62 +2,289 @@
 ClickHouse ETL - Performs structured transformations and stores aggregated data
 """
 from clickhouse_driver import Client
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Iterable, Iterator, List, Optional
+import calendar
+import math
+import os
+import re
+import time
 import config
+from anomaly_detection import ANOMALY_BASELINES_DDL, OBSERVATION_ANOMALIES_DDL, AnomalyDetector
+from clickhouse_pool import ClickHousePool, create_client
 from mongodb_etl import MongoDBETL
+from nws_api_fetcher_v2 import measurement, observation_properties
+from query_stats import QUERY_STATS_DDL, profiled_stage, query_stage
+from raw_archive import MANIFEST_FILE, RawArchiver
+
+try:
+    import pyarrow as pa  # Optional: only needed for Arrow/Parquet exports
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Monthly partitions let old data be dropped or archived per part; codecs suit the column shapes:
+# DoubleDelta for near-regular observation times, Gorilla for slowly changing floats,
+# LowCardinality for the handful of distinct station and batch identifiers.
+# Column order must stay in sync with insert_observations, which inserts positionally.
+OBSERVATIONS_TABLE_DDL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        observation_id String CODEC(ZSTD(1)),
+        station_id LowCardinality(String),
+        timestamp DateTime CODEC(DoubleDelta, ZSTD(1)),
+        temperature_c Nullable(Float64) CODEC(Gorilla, ZSTD(1)),
+        rainfall_mm Nullable(Float64) CODEC(Gorilla, ZSTD(1)),
+        humidity_percent Nullable(Float64) CODEC(Gorilla, ZSTD(1)),
+        wind_speed_ms Nullable(Float64) CODEC(Gorilla, ZSTD(1)),
+        pressure_pa Nullable(Float64) CODEC(Gorilla, ZSTD(1)),
+        ingest_time_utc DateTime CODEC(Delta, ZSTD(1)),
+        source_timestamp DateTime CODEC(Delta, ZSTD(1)),
+        api_request_id LowCardinality(String),
+        etl_batch_id LowCardinality(String),
+        INDEX idx_station_id station_id TYPE set(256) GRANULARITY 4
+    ) ENGINE = MergeTree()
+    PARTITION BY toYYYYMM(timestamp)
+    ORDER BY (timestamp, station_id)
+"""
+
+# Base layer for every rollup: one row per hour, rainfall deduplicated as the max per hour.
+# Rows are re-inserted when an hour receives new observations; the latest version wins.
+HOURLY_AGGREGATE_SELECT = """
+    SELECT
+        toStartOfHour(timestamp) as hour,
+        toDate(timestamp) as date,
+        avg(temperature_c) as avg_temperature_c,
+        max(rainfall_mm) as max_rainfall_mm,  -- Max per hour to avoid double-counting
+        avg(humidity_percent) as avg_humidity_percent,
+        max(temperature_c) as max_temperature_c,
+        min(temperature_c) as min_temperature_c,
+        count() as observation_count,
+        max(timestamp) as latest_obs_time,
+        {version} as version,
+        quantileTDigestState(assumeNotNull(temperature_c)) as temperature_tdigest,
+        quantileTDigestStateIf(assumeNotNull(humidity_percent), humidity_percent IS NOT NULL) as humidity_tdigest,
+        -- 10% humidity buckets; readings at or above 90% (including 100%) share the top bucket
+        sumMapStateIf(
+            map(toUInt8(least(intDiv(toUInt16(greatest(assumeNotNull(humidity_percent), 0)), 10), 9) * 10), toUInt64(1)),
+            humidity_percent IS NOT NULL
+        ) as humidity_histogram
+    FROM weather_observations
+    WHERE temperature_c IS NOT NULL {condition}
+    GROUP BY hour, date
+"""
+
+# Mergeable distribution states carried by every aggregate table (appended after the existing columns).
+# A t-digest state is independent of the quantile levels, so any percentile can be read back with
+# quantilesTDigestMerge(...), and a year of percentiles merges ~365 daily states instead of scanning raw rows.
+DISTRIBUTION_COLUMNS = {
+    'temperature_tdigest': 'AggregateFunction(quantileTDigest, Float64)',
+    'humidity_tdigest': 'AggregateFunction(quantileTDigest, Float64)',
+    # Observation counts per 10% humidity bucket (0, 10, ..., 90)
+    'humidity_histogram': 'AggregateFunction(sumMap, Map(UInt8, UInt64))'
+}
+DISTRIBUTION_COLUMNS_DDL = ',\n'.join(f"{name} {type_}" for name, type_ in DISTRIBUTION_COLUMNS.items())
+
+# Re-aggregates the states of a finer table (hourly -> daily -> monthly/yearly)
+DISTRIBUTION_MERGE_SELECT = """
+    quantileTDigestMergeState(temperature_tdigest) as temperature_tdigest,
+    quantileTDigestMergeState(humidity_tdigest) as humidity_tdigest,
+    sumMapMergeState(humidity_histogram) as humidity_histogram
+"""
+
+QUANTILE_LEVELS = (0.1, 0.5, 0.9)
+
+# Hours per refresh statement, keeps the IN list bounded
+HOURLY_REFRESH_CHUNK = 1000
+# Observation ids per already-loaded check or replacing delete
+LOADED_CHECK_CHUNK = 10000
+# Incremental loads re-read this far behind their watermark, for observations written while the last load read
+INCREMENTAL_LOAD_OVERLAP = timedelta(minutes=10)
+INCREMENTAL_LOAD_STATE_ID = "observations->weather_observations"
+
+# Hours that received observations and still have to be processed by a consumer ('aggregates' or
+# 'anomalies'). Kept in ClickHouse so a crash between loading and processing loses nothing: a
+# processed hour gets a pending = 0 row whose version wins unless the hour was queued again since.
+PENDING_HOURS_DDL = """
+    CREATE TABLE IF NOT EXISTS pending_hours (
+        consumer LowCardinality(String),
+        hour DateTime,
+        pending UInt8,
+        version UInt64
+    ) ENGINE = ReplacingMergeTree(version)
+    ORDER BY (consumer, hour)
+"""
+PENDING_HOURS_CONSUMERS = ('aggregates', 'anomalies')
+
+# Raw batch fields needed to flatten hourly forecasts; the periods may sit behind a blob reference
+FORECAST_SOURCE_PROJECTION = {'location': 1, 'hourly_forecast': 1, 'hourly_forecast_ref': 1,
+                              'source_timestamp': 1, 'etl_batch_id': 1}
+
+# Exportable datasets: source, a DateTime expression for the [start, end) filter, and the columns
+# (distribution states are internal and not exported)
+AGGREGATE_EXPORT_COLUMNS = ['avg_temperature_c', 'total_rainfall_mm', 'avg_humidity_percent', 'max_temperature_c',
+                            'min_temperature_c', 'observation_count', 'warehouse_load_time']
+EXPORT_DATASETS = {
+    'observations': ('weather_observations', 'timestamp', ['*']),
+    'hourly': ('hourly_weather_aggregates FINAL', 'hour',
+               ['hour', 'date', 'avg_temperature_c', 'max_rainfall_mm', 'avg_humidity_percent', 'max_temperature_c',
+                'min_temperature_c', 'observation_count', 'latest_obs_time']),
+    'daily': ('daily_weather_aggregates', 'toDateTime(date)', ['date'] + AGGREGATE_EXPORT_COLUMNS),
+    'monthly': ('monthly_weather_aggregates', 'toDateTime(makeDate(year, month, 1))',
+                ['year', 'month'] + AGGREGATE_EXPORT_COLUMNS),
+    'yearly': ('yearly_weather_aggregates', 'toDateTime(makeDate(year, 1, 1))', ['year'] + AGGREGATE_EXPORT_COLUMNS),
+    'forecasts': ('forecasts FINAL', 'valid_time', ['*']),
+    'anomalies': ('observation_anomalies FINAL', 'hour', ['*'])
+}
+
+def _type_arguments(clickhouse_type: str) -> List[str]:
+    """Top-level arguments of a parametrized type: 'Map(String, Array(UInt8))' -> ['String', 'Array(UInt8)']"""
+    arguments, depth, current = [], 0, ''
+    for char in clickhouse_type[clickhouse_type.index('(') + 1:-1]:
+        depth += {'(': 1, ')': -1}.get(char, 0)
+        if char == ',' and depth == 0:
+            arguments.append(current.strip())
+            current = ''
+        else:
+            current += char
+    return arguments + [current.strip()]
+
+def _arrow_type(clickhouse_type: str):
+    """Arrow type for a ClickHouse column type; None lets pyarrow infer it from the first block"""
+    # LowCardinality(Nullable(String)) nests both wrappers
+    for wrapper in ('LowCardinality(', 'Nullable('):
+        if clickhouse_type.startswith(wrapper):
+            clickhouse_type = clickhouse_type[len(wrapper):-1]
+    if clickhouse_type.startswith('DateTime'):
+        return pa.timestamp('s')
+    if clickhouse_type == 'Date':
+        return pa.date32()
+    if clickhouse_type in ('String', 'UUID') or clickhouse_type.startswith('Enum'):
+        return pa.string()
+    if clickhouse_type == 'Bool':
+        return pa.bool_()
+    if clickhouse_type in ('Float32', 'Float64', 'UInt8', 'UInt16', 'UInt32', 'UInt64', 'Int8', 'Int16', 'Int32', 'Int64'):
+        return getattr(pa, clickhouse_type.lower())()
+    if clickhouse_type.startswith('Decimal('):
+        precision, scale = (int(argument) for argument in _type_arguments(clickhouse_type))
+        return pa.decimal128(precision, scale) if precision <= 38 else pa.decimal256(precision, scale)
+    if clickhouse_type.startswith('Array('):
+        item = _arrow_type(_type_arguments(clickhouse_type)[0])
+        return pa.list_(item) if item is not None else None
+    if clickhouse_type.startswith('Map('):
+        key, value = (_arrow_type(argument) for argument in _type_arguments(clickhouse_type))
+        return pa.map_(key, value) if key is not None and value is not None else None
+    return None
+
+class _ExportSink:
+    """Write-only file object that hands written bytes to a streaming response between batches"""
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+        self.closed = False
+    
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+    
+    def tell(self) -> int:
+        return self._position
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        self.closed = True
+    
+    def drain(self) -> bytes:
+        data, self._chunks = b''.join(self._chunks), []
+        return data
+
+def _parse_time(value: Optional[str]) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return None
+
+def _forecast_wind_speed_ms(text: Optional[str]) -> Optional[float]:
+    """NWS forecast wind speeds are text like '5 mph' or '10 to 15 mph'; ranges use the midpoint"""
+    speeds = [float(n) for n in re.findall(r'\d+(?:\.\d+)?', text or '')]
+    if not speeds:
+        return None
+    speed = sum(speeds) / len(speeds)
+    return speed / 3.6 if 'km/h' in text else speed * 0.44704
 
 class ClickHouseETL:
     def __init__(self):
         # First connect to default database to create our database
-        temp_client = Client(
-            host=config.CLICKHOUSE_HOST,
-            port=config.CLICKHOUSE_PORT,
-            database='default',  # Connect to default database first
-            user=config.CLICKHOUSE_USER,
-            password=config.CLICKHOUSE_PASSWORD
-        )
+        temp_client = create_client('default')
         
         # Create database if not exists
         temp_client.execute(f"CREATE DATABASE IF NOT EXISTS {config.CLICKHOUSE_DB}")
+        temp_client.disconnect()
         
-        # Now create client connected to our database
-        self.client = Client(
-            host=config.CLICKHOUSE_HOST,
-            port=config.CLICKHOUSE_PORT,
-            database=config.CLICKHOUSE_DB,
-            user=config.CLICKHOUSE_USER,
-            password=config.CLICKHOUSE_PASSWORD
-        )
+        # Now create the connection pool for our database. The pool has the same execute() as a
+        # Client, so self.client.execute stays valid and is safe to call from several threads.
+        self.pool = ClickHousePool()
+        self.client = self.pool
+        self.bulk_timeout_sec = config.CLICKHOUSE_BULK_QUERY_TIMEOUT_SEC
         self.mongodb_etl = MongoDBETL()
+        self.anomaly_detector = AnomalyDetector(self.pool)
         self._initialize_schema()
     
+    def execute_bulk(self, query: str, params=None, **kwargs):
+        """Run a rebuild, backfill, mutation or bulk insert under CLICKHOUSE_BULK_QUERY_TIMEOUT_SEC
+        instead of the interactive query timeout"""
+        return self.pool.execute(query, params, timeout_sec=self.bulk_timeout_sec, **kwargs)
+    
+    @profiled_stage
     def _initialize_schema(self):
         """Initialize ClickHouse database and tables"""
         # Database already created in __init__, just create tables
         # Only create tables if they don't exist (don't drop existing data)
         
+        # Per-query cost log written by the connection pool; first, so no profiled query is lost
+        self.client.execute(QUERY_STATS_DDL)
+        
+        # Hours waiting for the aggregate refresh and anomaly detection
+        self.client.execute(PENDING_HOURS_DDL)
+        
         # Create raw observations table
-        self.client.execute("""
-            CREATE TABLE IF NOT EXISTS weather_observations (
-                observation_id String,
-                station_id String,
-                timestamp DateTime,
-                temperature_c Nullable(Float64),
-                rainfall_mm Nullable(Float64),
-                humidity_percent Nullable(Float64),
-                wind_speed_ms Nullable(Float64),
-                pressure_pa Nullable(Float64),
-                ingest_time_utc DateTime,
-                source_timestamp DateTime,
-                api_request_id String,
-                etl_batch_id String
-            ) ENGINE = MergeTree()
-            ORDER BY (timestamp, station_id)
+        self.client.execute(OBSERVATIONS_TABLE_DDL.format(table="weather_observations"))
+        partition_key = self.client.execute(
+            "SELECT partition_key FROM system.tables WHERE database = currentDatabase() AND name = 'weather_observations'"
+        )
+        if partition_key and not partition_key[0][0]:
+            print("Note: weather_observations uses the old unpartitioned schema; "
+                  "run python3 schema_migration.py to upgrade it online")
+        
+        # Create hourly aggregates table
+        self.client.execute(f"""
+            CREATE TABLE IF NOT EXISTS hourly_weather_aggregates (
+                hour DateTime,
+                date Date,
+                avg_temperature_c Nullable(Float64),
+                max_rainfall_mm Nullable(Float64),
+                avg_humidity_percent Nullable(Float64),
+                max_temperature_c Nullable(Float64),
+                min_temperature_c Nullable(Float64),
+                observation_count UInt32,
+                latest_obs_time DateTime,
+                version UInt64,
+                {DISTRIBUTION_COLUMNS_DDL}
+            ) ENGINE = ReplacingMergeTree(version)
+            PARTITION BY toYYYYMM(hour)
+            ORDER BY hour
         """)
+        self._add_distribution_columns("hourly_weather_aggregates")
+        if (self.client.execute("SELECT count() FROM hourly_weather_aggregates")[0][0] == 0
+                and self.client.execute("SELECT count() FROM weather_observations")[0][0] > 0):
+            print("Backfilling hourly_weather_aggregates from weather_observations...")
+            self.rebuild_hourly_aggregates()
         
         # Create daily aggregates table
-        self.client.execute("""
+        self.client.execute(f"""
             CREATE TABLE IF NOT EXISTS daily_weather_aggregates (
                 date Date,
                 avg_temperature_c Nullable(Float64),
@@ -69,13 +296,15 @@ class ClickHouseETL:
                 warehouse_load_time DateTime,
                 rows_loaded UInt32,
                 sync_interval_min UInt16,
-                load_mode String
+                load_mode String,
+                {DISTRIBUTION_COLUMNS_DDL}
             ) ENGINE = SummingMergeTree()
             ORDER BY date
         """)
+        self._add_distribution_columns("daily_weather_aggregates")
         
         # Create monthly aggregates table
-        self.client.execute("""
+        self.client.execute(f"""
             CREATE TABLE IF NOT EXISTS monthly_weather_aggregates (
                 year UInt16,
                 month UInt8,
@@ -88,38 +317,136 @@ class ClickHouseETL:
                 warehouse_load_time DateTime,
                 rows_loaded UInt32,
                 sync_interval_min UInt16,
-                load_mode String
+                load_mode String,
+                {DISTRIBUTION_COLUMNS_DDL}
             ) ENGINE = SummingMergeTree()
             ORDER BY (year, month)
         """)
+        self._add_distribution_columns("monthly_weather_aggregates")
+        
+        # Create yearly aggregates table
+        self.client.execute(f"""
+            CREATE TABLE IF NOT EXISTS yearly_weather_aggregates (
+                year UInt16,
+                avg_temperature_c Nullable(Float64),
+                total_rainfall_mm Nullable(Float64),
+                avg_humidity_percent Nullable(Float64),
+                max_temperature_c Nullable(Float64),
+                min_temperature_c Nullable(Float64),
+                observation_count UInt32,
+                warehouse_load_time DateTime,
+                rows_loaded UInt32,
+                sync_interval_min UInt16,
+                load_mode String,
+                {DISTRIBUTION_COLUMNS_DDL}
+            ) ENGINE = SummingMergeTree()
+            ORDER BY year
+        """)
+        self._add_distribution_columns("yearly_weather_aggregates")
+        
+        # Running per-station baselines and the readings flagged against them (see anomaly_detection.py)
+        self.client.execute(ANOMALY_BASELINES_DDL)
+        self.client.execute(OBSERVATION_ANOMALIES_DDL)
+        
+        # Create forecasts table: one row per hourly forecast period, per forecast issue.
+        # Re-fetches of an unchanged forecast carry the same key and collapse on merge.
+        self.client.execute("""
+            CREATE TABLE IF NOT EXISTS forecasts (
+                location_id LowCardinality(String),
+                issue_time DateTime CODEC(Delta, ZSTD(1)),
+                valid_time DateTime CODEC(DoubleDelta, ZSTD(1)),
+                lead_hours Int16,
+                temperature_c Nullable(Float64) CODEC(Gorilla, ZSTD(1)),
+                precipitation_probability Nullable(UInt8),
+                humidity_percent Nullable(Float64) CODEC(Gorilla, ZSTD(1)),
+                wind_speed_ms Nullable(Float64) CODEC(Gorilla, ZSTD(1)),
+                short_forecast LowCardinality(String),
+                etl_batch_id LowCardinality(String),
+                ingest_time_utc DateTime
+            ) ENGINE = ReplacingMergeTree(ingest_time_utc)
+            PARTITION BY toYYYYMM(valid_time)
+            ORDER BY (location_id, issue_time, valid_time)
+        """)
+        
+        if self.distribution_states_missing():
+            print("Note: aggregate rows written before the quantile/histogram columns existed have empty states; "
+                  "run python3 distribution_backfill.py to recompute them")
         
         print("ClickHouse schema initialized")
     
-    def extract_observations_from_mongodb(self) -> List[Dict]:
-        """Extract observation data from MongoDB enriched collection"""
-        enriched_docs = self.mongodb_etl.get_all_enriched_data()
-        observations = []
+    def _add_distribution_columns(self, table: str):
+        """Add the distribution state columns to an aggregate table created by an older version"""
+        existing = {row[0] for row in self.client.execute(
+            "SELECT name FROM system.columns WHERE database = currentDatabase() AND table = %(table)s",
+            {'table': table}
+        )}
+        for name in DISTRIBUTION_COLUMNS:
+            if name not in existing:
+                self.client.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {name} {DISTRIBUTION_COLUMNS[name]}")
+    
+    def distribution_states_missing(self) -> bool:
+        """Whether hourly rows predate the distribution columns. Every hourly row has a temperature,
+        so an empty t-digest state (NaN median) only comes from the column default."""
+        return bool(self.client.execute(
+            "SELECT 1 FROM hourly_weather_aggregates FINAL WHERE isNaN(finalizeAggregation(temperature_tdigest)) LIMIT 1"
+        ))
+    
+    def _parse_stored_observation(self, doc: Dict) -> Optional[Dict]:
+        """Parse a document of the MongoDB observation collection into a warehouse row"""
+        source_timestamp = doc.get('source_timestamp') or doc['first_seen_utc'].isoformat() + "Z"
+        return self._parse_observation(doc['properties'], dict(doc, source_timestamp=source_timestamp), doc['station_id'])
+    
+    def extract_observations_from_documents(self, raw_docs: List[Dict]) -> List[Dict]:
+        """Parse the observations of raw batch documents into warehouse rows, once per observation.
+        Batches reference their observations by id; older and archived batches embed the arrays."""
+        observations = {}
+        referenced_ids = set()
         
-        for doc in enriched_docs:
-            # Extract from NWS API observations (new format)
-            for obs in doc.get('observations', []):
-                props = obs.get('properties', {})
-                obs_data = self._parse_observation(props, doc)
-                if obs_data:
-                    observations.append(obs_data)
-            
-            # Extract from historical observations
-            for obs in doc.get('historical_observations', []):
-                props = obs.get('properties', {})
-                obs_data = self._parse_observation(props, doc)
-                if obs_data:
-                    observations.append(obs_data)
-            
-            # Extract from daily aggregate format (legacy format)
-            if 'date' in doc and 'max_temp_c' in doc:
-                obs_data = self._parse_daily_aggregate(doc)
+        for doc in raw_docs:
+            referenced_ids.update(doc.get('observation_ids', []))
+            # Extract from NWS API observations (new format) and historical observations
+            for obs in doc.get('observations', []) + doc.get('historical_observations', []):
+                props = observation_properties(obs)
+                obs_data = self._parse_observation(props, doc, obs.get('station_id'))
                 if obs_data:
-                    observations.append(obs_data)
+                    observations.setdefault(obs_data['observation_id'], obs_data)
+        
+        for stored in self.mongodb_etl.get_observations_by_id(referenced_ids):
+            obs_data = self._parse_stored_observation(stored)
+            if obs_data:
+                observations.setdefault(obs_data['observation_id'], obs_data)
+        
+        return list(observations.values())
+    
+    def extract_observations_from_mongodb(self, include_archive: bool = False, start: Optional[datetime] = None,
+                                          end: Optional[datetime] = None) -> List[Dict]:
+        """Extract observations in [start, end) (default: all) from the MongoDB observation collection,
+        plus raw batches that predate it and legacy enriched daily aggregates.
+        include_archive=True also reads raw batches already moved to the Parquet archive."""
+        # Each observation is stored once; the timestamp index serves the range
+        observations = {}
+        for doc in self.mongodb_etl.iter_observations(start, end):
+            obs_data = self._parse_stored_observation(doc)
+            if obs_data:
+                observations[obs_data['observation_id']] = obs_data
+        
+        # Batches stored before the observation collection still embed their arrays
+        legacy_batches = self.mongodb_etl.raw_collection.find({'observations': {'$exists': True}})
+        sources = [legacy_batches]
+        if include_archive and os.path.exists(os.path.join(config.ARCHIVE_DIR, MANIFEST_FILE)):
+            sources.append(RawArchiver(self.mongodb_etl).iter_documents())
+        for raw_docs in sources:
+            for obs_data in self.extract_observations_from_documents(raw_docs):
+                timestamp = obs_data['timestamp'].replace(tzinfo=None)  # UTC, like the stored bounds
+                if (start is None or timestamp >= start) and (end is None or timestamp < end):
+                    observations.setdefault(obs_data['observation_id'], obs_data)
+        observations = list(observations.values())
+        
+        # Extract from daily aggregate format (legacy format)
+        for doc in self.mongodb_etl.get_legacy_daily_aggregates():
+            obs_data = self._parse_daily_aggregate(doc)
+            if obs_data:
+                observations.append(obs_data)
         
         return observations
     
@@ -204,8 +531,8 @@ class ClickHouseETL:
             print(f"Error parsing Open-Meteo daily data: {e}")
             return None
     
-    def _parse_observation(self, props: Dict, doc: Dict) -> Optional[Dict]:
-        """Parse a single observation from NWS API format"""
+    def _parse_observation(self, props: Dict, doc: Dict, station_id: Optional[str] = None) -> Optional[Dict]:
+        """Parse a single observation from NWS API format; station_id overrides the station URL tag"""
         try:
             timestamp_str = props.get('timestamp')
             if not timestamp_str:
@@ -215,27 +542,28 @@ class ClickHouseETL:
             timestamp = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
             
             # Extract temperature (convert from Kelvin if needed)
-            temp = props.get('temperature', {}).get('value')
+            temp = measurement(props, 'temperature')
             temp_c = None
             if temp is not None:
                 temp_c = temp - 273.15 if temp > 100 else temp
             
             # Extract other fields
-            rainfall = props.get('precipitationLastHour', {}).get('value')
+            rainfall = measurement(props, 'precipitationLastHour')
             # Convert from meters to millimeters if needed (NWS uses meters)
             if rainfall is not None and rainfall < 1:
                 rainfall = rainfall * 1000  # Convert meters to mm
             
-            humidity = props.get('relativeHumidity', {}).get('value')
-            wind_speed = props.get('windSpeed', {}).get('value')
+            humidity = measurement(props, 'relativeHumidity')
+            wind_speed = measurement(props, 'windSpeed')
             # Convert wind speed from m/s if needed (NWS typically uses m/s)
             if wind_speed is not None and wind_speed < 50:  # Likely m/s, keep as is
                 pass  # Already in m/s
             
-            pressure = props.get('seaLevelPressure', {}).get('value')
+            pressure = measurement(props, 'seaLevelPressure')
             # Convert from Pa to Pa (NWS uses Pascals, which is what we want)
             
-            station_id = props.get('station', '').split('/')[-1] if props.get('station') else None
+            if not station_id:
+                station_id = props.get('station', '').split('/')[-1] if props.get('station') else None
             
             return {
                 'observation_id': f"{station_id}_{int(timestamp.timestamp())}",
@@ -255,17 +583,13 @@ class ClickHouseETL:
             print(f"Error parsing observation: {e}")
             return None
     
-    def load_observations(self, load_mode: str = "incremental") -> int:
-        """Load observations into ClickHouse"""
-        print("Extracting observations from MongoDB...")
-        observations = self.extract_observations_from_mongodb()
-        
+    @profiled_stage
+    def insert_observations(self, observations: List[Dict], table: str = "weather_observations",
+                            client: Optional[Client] = None) -> int:
+        """Insert parsed observation rows into weather_observations (or a table with the same schema)"""
         if not observations:
-            print("No observations to load")
             return 0
         
-        print(f"Loading {len(observations)} observations into ClickHouse...")
-        
         # Prepare data for insertion
         data = [
             (
@@ -285,194 +609,435 @@ class ClickHouseETL:
             for obs in observations
         ]
         
-        if load_mode == "overwrite":
-            # Clear existing data (for full refresh)
-            self.client.execute("TRUNCATE TABLE weather_observations")
-        
         # Insert data
-        self.client.execute(
-            "INSERT INTO weather_observations VALUES",
+        (client.execute if client else self.execute_bulk)(
+            f"INSERT INTO {table} VALUES",
             data
         )
+        if table == "weather_observations":
+            hours = {calendar.timegm(obs['timestamp'].utctimetuple()) // 3600 * 3600 for obs in observations}
+            self.queue_hours(hours, client=client)
+        return len(data)
+    
+    def unloaded_observations(self, observations: List[Dict], table: str = "weather_observations") -> List[Dict]:
+        """Drop rows whose observation_id the table already holds, so a replayed or overlapping load
+        (CDC after a crash, or right after the initial sync) inserts nothing twice"""
+        if not observations:
+            return observations
+        timestamps = [calendar.timegm(obs['timestamp'].utctimetuple()) for obs in observations]
+        ids = [obs['observation_id'] for obs in observations]
+        loaded = set()
+        for i in range(0, len(ids), LOADED_CHECK_CHUNK):
+            # The time bounds let the primary key skip everything outside the batch
+            loaded.update(row[0] for row in self.execute_bulk(
+                f"SELECT observation_id FROM {table} "
+                "WHERE timestamp BETWEEN toDateTime(%(start)s) AND toDateTime(%(end)s) AND observation_id IN %(ids)s",
+                {'start': min(timestamps), 'end': max(timestamps), 'ids': ids[i:i + LOADED_CHECK_CHUNK]}
+            ))
+        return [obs for obs in observations if obs['observation_id'] not in loaded]
+    
+    @profiled_stage
+    def replace_observations(self, observations: List[Dict]) -> int:
+        """Insert parsed rows in place of loaded rows with the same observation_id, e.g. when reparsing archived batches"""
+        if not observations:
+            return 0
+        timestamps = [calendar.timegm(obs['timestamp'].utctimetuple()) for obs in observations]
+        ids = [obs['observation_id'] for obs in observations]
+        for i in range(0, len(ids), LOADED_CHECK_CHUNK):
+            self.execute_bulk(
+                "ALTER TABLE weather_observations DELETE "
+                "WHERE timestamp BETWEEN toDateTime(%(start)s) AND toDateTime(%(end)s) AND observation_id IN %(ids)s",
+                {'start': min(timestamps), 'end': max(timestamps), 'ids': ids[i:i + LOADED_CHECK_CHUNK]},
+                settings={'mutations_sync': 1}
+            )
+        # The hours are queued again, so the next aggregate refresh picks up the reparsed values
+        return self.insert_observations(observations)
+    
+    def queue_hours(self, hours: Iterable[int], consumers=PENDING_HOURS_CONSUMERS, client: Optional[Client] = None):
+        """Mark hours (unix seconds) as pending for the aggregate refresh and anomaly detection"""
+        # Versioned after the observations are written, so a concurrent run that missed them cannot mark them done
+        version = time.time_ns()
+        rows = [(consumer, datetime.fromtimestamp(hour, timezone.utc), 1, version) for consumer in consumers for hour in hours]
+        if rows:
+            (client or self.client).execute("INSERT INTO pending_hours VALUES", rows)
+    
+    def queue_all_hours(self, consumers=PENDING_HOURS_CONSUMERS):
+        """Mark every hour with observations as pending, e.g. after a rebuild"""
+        for consumer in consumers:
+            self.execute_bulk(
+                "INSERT INTO pending_hours SELECT DISTINCT %(consumer)s, toStartOfHour(timestamp), 1, %(version)s "
+                "FROM weather_observations",
+                {'consumer': consumer, 'version': time.time_ns()}
+            )
+    
+    def pending_hours(self, consumer: str) -> tuple:
+        """(pending hours as sorted unix seconds, version to mark them done with)"""
+        # Taken before the read: hours queued after this point keep a newer pending row
+        version = time.time_ns()
+        hours = [row[0] for row in self.client.execute(
+            "SELECT toUnixTimestamp(hour) FROM pending_hours FINAL "
+            "WHERE consumer = %(consumer)s AND pending = 1 ORDER BY hour",
+            {'consumer': consumer}
+        )]
+        return hours, version
+    
+    def mark_hours_done(self, consumer: str, hours: Iterable[int], version: int):
+        rows = [(consumer, datetime.fromtimestamp(hour, timezone.utc), 0, version) for hour in hours]
+        if rows:
+            self.client.execute("INSERT INTO pending_hours VALUES", rows)
+    
+    @profiled_stage
+    def _load_state(self):
+        # Kept next to the CDC consumer's resume token, one document per consumer
+        return self.mongodb_etl.db[config.MONGODB_COLLECTION_CDC_STATE]
+    
+    def extract_observations_stored_since(self, since: datetime) -> List[Dict]:
+        """Extract observations first stored in MongoDB at or after since"""
+        observations = {}
+        for doc in self.mongodb_etl.iter_observations_stored_since(since):
+            obs_data = self._parse_stored_observation(doc)
+            if obs_data:
+                observations[obs_data['observation_id']] = obs_data
+        return list(observations.values())
+    
+    def load_observations(self, load_mode: str = "incremental") -> int:
+        """Load observations into ClickHouse. An incremental load reads the observations stored since the
+        previous load (everything on the first run) and inserts only those not loaded yet."""
+        # Taken before reading, so observations stored while this load runs are read again next time
+        load_started = datetime.utcnow()
+        state = self._load_state().find_one({'_id': INCREMENTAL_LOAD_STATE_ID}) if load_mode == "incremental" else None
         
-        print(f"Loaded {len(observations)} observations")
+        print("Extracting observations from MongoDB...")
+        if state:
+            observations = self.extract_observations_stored_since(state['watermark'] - INCREMENTAL_LOAD_OVERLAP)
+        else:
+            # A full refresh truncates the table, so archived batches have to be reloaded too
+            observations = self.extract_observations_from_mongodb(include_archive=load_mode == "overwrite")
+        if load_mode != "overwrite":
+            observations = self.unloaded_observations(observations)
+        
+        if observations:
+            print(f"Loading {len(observations)} observations into ClickHouse...")
+            if load_mode == "overwrite":
+                # Clear existing data (for full refresh)
+                self.client.execute("TRUNCATE TABLE weather_observations")
+            # Only the hours of these rows are queued for the aggregates
+            self.insert_observations(observations)
+            if load_mode == "overwrite":
+                # Hours that disappeared with the truncate must not survive in the hourly table
+                self.rebuild_hourly_aggregates()
+        
+        self._load_state().update_one(
+            {'_id': INCREMENTAL_LOAD_STATE_ID},
+            {'$set': {'watermark': load_started, 'updated_at_utc': datetime.utcnow()},
+             '$inc': {'observations_loaded': len(observations)}},
+            upsert=True
+        )
+        print(f"Loaded {len(observations)} observations" if observations else "No new observations to load")
         return len(observations)
     
-    def compute_aggregates(self, sync_interval_min: int = 60) -> Dict:
-        """Compute daily and monthly aggregates"""
-        load_time = datetime.utcnow()
-        load_mode = "incremental"
-        
-        # Compute daily aggregates
-        # For rainfall: aggregate by hour first (max per hour) to avoid double-counting duplicate observations
-        # Then sum hourly values to get daily total
-        daily_query = """
-            SELECT 
-                date,
-                avg(avg_temperature_c) as avg_temperature_c,
-                sum(max_rainfall_per_hour) as total_rainfall_mm,
-                avg(avg_humidity_percent) as avg_humidity_percent,
-                max(max_temperature_c) as max_temperature_c,
-                min(min_temperature_c) as min_temperature_c,
-                sum(observation_count) as observation_count
-            FROM (
-                SELECT 
-                    toDate(timestamp) as date,
-                    toStartOfHour(timestamp) as hour,
-                    avg(temperature_c) as avg_temperature_c,
-                    max(rainfall_mm) as max_rainfall_per_hour,  -- Max per hour to avoid double-counting
-                    avg(humidity_percent) as avg_humidity_percent,
-                    max(temperature_c) as max_temperature_c,
-                    min(temperature_c) as min_temperature_c,
-                    count() as observation_count
-                FROM weather_observations
-                WHERE temperature_c IS NOT NULL
-                GROUP BY date, hour
-            )
-            GROUP BY date
-            ORDER BY date DESC
-        """
+    @profiled_stage
+    def load_documents(self, raw_docs: List[Dict], legacy_docs: Optional[List[Dict]] = None) -> int:
+        """Load only the given raw batch documents (and legacy daily aggregate documents), e.g. from CDC.
+        Observations already in weather_observations are skipped, so loading a batch twice is harmless."""
+        observations = self.extract_observations_from_documents(raw_docs)
+        for doc in legacy_docs or []:
+            obs_data = self._parse_daily_aggregate(doc)
+            if obs_data:
+                observations.append(obs_data)
+        rows = self.insert_observations(self.unloaded_observations(observations))
+        self.load_forecasts(raw_docs)
+        return rows
+    
+    def _parse_forecast_period(self, period: Dict, location_id: str, issue_time: datetime, doc: Dict) -> Optional[Dict]:
+        """Parse one hourly forecast period (NWS units) into a forecasts row"""
+        valid_time = _parse_time(period.get('startTime'))
+        if valid_time is None:
+            return None
         
-        daily_results = self.client.execute(daily_query)
-        rows_loaded_daily = len(daily_results)
+        temperature = measurement(period, 'temperature')
+        unit = period.get('temperatureUnit') or ''
+        if isinstance(period.get('temperature'), dict):
+            unit = period['temperature'].get('unitCode', unit)
+        temp_c = None
+        if temperature is not None:
+            temp_c = (temperature - 32) * 5 / 9 if unit.endswith('F') else float(temperature)
         
-        if daily_results:
-            # Get list of dates to delete old aggregates for
-            dates_to_update = [row[0] for row in daily_results]
+        precipitation = measurement(period, 'probabilityOfPrecipitation')
+        humidity = measurement(period, 'relativeHumidity')
+        return {
+            'location_id': location_id,
+            'issue_time': issue_time,
+            'valid_time': valid_time,
+            'lead_hours': math.floor((valid_time - issue_time).total_seconds() / 3600),
+            'temperature_c': temp_c,
+            'precipitation_probability': int(precipitation) if precipitation is not None else None,
+            'humidity_percent': float(humidity) if humidity is not None else None,
+            'wind_speed_ms': _forecast_wind_speed_ms(period.get('windSpeed')),
+            'short_forecast': period.get('shortForecast') or '',
+            'etl_batch_id': doc.get('etl_batch_id', ''),
+            'ingest_time_utc': datetime.utcnow()
+        }
+    
+    def extract_forecasts_from_documents(self, raw_docs: Iterable[Dict], loaded_issues: Optional[set] = None) -> List[Dict]:
+        """Flatten the hourly forecast periods of raw batches into forecasts rows, once per forecast issue.
+        loaded_issues holds (location_id, unix issue time) pairs already in the table."""
+        forecasts = []
+        seen_issues = set(loaded_issues or ())
+        seen_blobs = set()
+        for doc in raw_docs:
+            location_id = (doc.get('location') or {}).get('location_id') or ''
+            ref = doc.get('hourly_forecast_ref')
+            if ref and doc.get('hourly_forecast') is None:
+                # Batches of an unchanged forecast share one blob; resolve and parse it once
+                if (location_id, ref['hash']) in seen_blobs:
+                    continue
+                seen_blobs.add((location_id, ref['hash']))
+                doc = self.mongodb_etl.resolve_payloads(doc)
             
-            # Delete old aggregates for these dates to prevent SummingMergeTree from summing averages
-            if dates_to_update:
-                dates_str = ','.join([f"'{d}'" for d in dates_to_update])
-                self.client.execute(f"ALTER TABLE daily_weather_aggregates DELETE WHERE date IN ({dates_str})")
+            props = (doc.get('hourly_forecast') or {}).get('properties') or {}
+            # updateTime is when NWS last revised the forecast; generatedAt changes on every request
+            issue_time = _parse_time(props.get('updateTime')) or _parse_time(doc.get('source_timestamp'))
+            if not props.get('periods') or issue_time is None:
+                continue
+            issue_key = (location_id, int(issue_time.timestamp()))
+            if issue_key in seen_issues:
+                continue
+            seen_issues.add(issue_key)
             
-            daily_data = [
-                (
-                    row[0],  # date
-                    row[1],  # avg_temperature_c
-                    row[2],  # total_rainfall_mm
-                    row[3],  # avg_humidity_percent
-                    row[4],  # max_temperature_c
-                    row[5],  # min_temperature_c
-                    row[6],  # observation_count
-                    load_time,
-                    rows_loaded_daily,
-                    sync_interval_min,
-                    load_mode
+            for period in props['periods']:
+                row = self._parse_forecast_period(period, location_id, issue_time, doc)
+                if row:
+                    forecasts.append(row)
+        
+        return forecasts
+    
+    @profiled_stage
+    def insert_forecasts(self, forecasts: List[Dict]) -> int:
+        """Insert parsed hourly forecast rows into the forecasts table"""
+        if not forecasts:
+            return 0
+        columns = ['location_id', 'issue_time', 'valid_time', 'lead_hours', 'temperature_c',
+                   'precipitation_probability', 'humidity_percent', 'wind_speed_ms', 'short_forecast',
+                   'etl_batch_id', 'ingest_time_utc']
+        self.execute_bulk(
+            f"INSERT INTO forecasts ({', '.join(columns)}) VALUES",
+            [tuple(row[column] for column in columns) for row in forecasts]
+        )
+        return len(forecasts)
+    
+    @profiled_stage
+    def load_forecasts(self, raw_docs: Optional[Iterable[Dict]] = None) -> int:
+        """Load hourly forecasts from raw batches (default: those fetched since the loaded forecasts) that are not loaded yet"""
+        # An issue is fetched after it was issued, so a batch fetched before a location's newest loaded issue
+        # holds nothing newer; reading from the oldest of those per-location watermarks loses nothing
+        latest_issues = self.client.execute(
+            "SELECT location_id, toUnixTimestamp(max(issue_time)) FROM forecasts GROUP BY location_id"
+        )
+        watermark = min((issue_time for _, issue_time in latest_issues), default=None)
+        loaded_issues = set()
+        if watermark is not None:
+            loaded_issues = {
+                (location_id, issue_time) for location_id, issue_time in self.client.execute(
+                    "SELECT DISTINCT location_id, toUnixTimestamp(issue_time) FROM forecasts "
+                    "WHERE issue_time >= toDateTime(%(watermark)s)",
+                    {'watermark': watermark}
                 )
-                for row in daily_results
-            ]
-            
-            self.client.execute(
-                "INSERT INTO daily_weather_aggregates VALUES",
-                daily_data
+            }
+        if raw_docs is None:
+            query = {}
+            if watermark is not None:
+                query['source_timestamp'] = {'$gte': datetime.utcfromtimestamp(watermark).isoformat() + "Z"}
+            raw_docs = self.mongodb_etl.raw_collection.find(query, FORECAST_SOURCE_PROJECTION)
+        forecasts = self.extract_forecasts_from_documents(raw_docs, loaded_issues)
+        rows = self.insert_forecasts(forecasts)
+        if rows:
+            print(f"Loaded {rows} hourly forecast periods")
+        return rows
+    
+    @profiled_stage
+    def detect_anomalies(self) -> int:
+        """Score the hours loaded since the last run against the per-station baselines"""
+        if not config.ANOMALY_DETECTION_ENABLED:
+            return 0
+        hours, version = self.pending_hours('anomalies')
+        flagged = self.anomaly_detector.process(hours)
+        self.mark_hours_done('anomalies', hours, version)
+        return flagged
+    
+    @profiled_stage
+    def rebuild_hourly_aggregates(self):
+        """Recompute the whole hourly table from weather_observations (after truncates or swaps)"""
+        self.client.execute("TRUNCATE TABLE hourly_weather_aggregates")
+        self.execute_bulk(
+            "INSERT INTO hourly_weather_aggregates " +
+            HOURLY_AGGREGATE_SELECT.format(version=time.time_ns(), condition="")
+        )
+        # Everything is fresh, but daily and monthly rows still need to follow
+        self.queue_all_hours(['aggregates'])
+    
+    @profiled_stage
+    def refresh_hourly_aggregates(self, hours: Iterable[int]) -> List[int]:
+        """Recompute only the given hours (unix seconds)"""
+        hours = sorted(hours)
+        for i in range(0, len(hours), HOURLY_REFRESH_CHUNK):
+            chunk = hours[i:i + HOURLY_REFRESH_CHUNK]
+            # The timestamp range lets the primary key skip untouched parts before the IN filter
+            condition = ("AND timestamp >= toDateTime(%(start)s) AND timestamp < toDateTime(%(end)s) "
+                         "AND toUnixTimestamp(toStartOfHour(timestamp)) IN %(hours)s")
+            self.execute_bulk(
+                "INSERT INTO hourly_weather_aggregates " +
+                HOURLY_AGGREGATE_SELECT.format(version=time.time_ns(), condition=condition),
+                {'start': chunk[0], 'end': chunk[-1] + 3600, 'hours': chunk}
             )
+        return hours
+    
+    @profiled_stage
+    def _rollup_from_daily(self, table: str, period_columns: List[str], daily_period_expr: str,
+                           table_period_expr: str, periods: List[int],
+                           load_time: datetime, sync_interval_min: int, load_mode: str) -> int:
+        """Replace the given periods of a monthly/yearly table with a rollup of daily_weather_aggregates"""
+        if not periods:
+            return 0
         
-        # Compute monthly aggregates
-        # For rainfall: aggregate by hour first (max per hour), then by day, then by month to avoid double-counting
-        monthly_query = """
+        # Delete old rows for these periods to prevent SummingMergeTree from summing averages
+        self.execute_bulk(
+            f"ALTER TABLE {table} DELETE WHERE {table_period_expr} IN %(periods)s",
+            {'periods': periods},
+            settings={'mutations_sync': 1}
+        )
+        
+        period_select = ', '.join(f"to{column.capitalize()}(date) as {column}" for column in period_columns)
+        columns = ', '.join(period_columns)
+        self.execute_bulk(
+            f"""
+            INSERT INTO {table} ({columns}, avg_temperature_c, total_rainfall_mm, avg_humidity_percent,
+                max_temperature_c, min_temperature_c, observation_count,
+                warehouse_load_time, rows_loaded, sync_interval_min, load_mode,
+                {', '.join(DISTRIBUTION_COLUMNS)})
             SELECT 
-                year,
-                month,
+                {period_select},
                 avg(avg_temperature_c) as avg_temperature_c,
                 sum(total_rainfall_mm) as total_rainfall_mm,
                 avg(avg_humidity_percent) as avg_humidity_percent,
                 max(max_temperature_c) as max_temperature_c,
                 min(min_temperature_c) as min_temperature_c,
-                sum(observation_count) as observation_count
-            FROM (
+                sum(observation_count) as observation_count,
+                %(load_time)s, %(rows_loaded)s, %(sync_interval_min)s, %(load_mode)s,
+                {DISTRIBUTION_MERGE_SELECT}
+            FROM daily_weather_aggregates
+            WHERE {daily_period_expr} IN %(periods)s
+            GROUP BY {columns}
+            """,
+            {'periods': periods, 'load_time': load_time, 'rows_loaded': len(periods),
+             'sync_interval_min': sync_interval_min, 'load_mode': load_mode}
+        )
+        return len(periods)
+    
+    @profiled_stage
+    def compute_aggregates(self, sync_interval_min: int = 60) -> Dict:
+        """Compute daily and monthly aggregates for the hours touched since the last run"""
+        load_time = datetime.utcnow()
+        load_mode = "incremental"
+        
+        # The hourly rollup (with the max-per-hour rainfall dedup) runs once per touched hour;
+        # daily and monthly values are derived from it
+        hours, pending_version = self.pending_hours('aggregates')
+        self.refresh_hourly_aggregates(hours)
+        dates_to_update = []
+        if hours:
+            dates_to_update = [row[0] for row in self.client.execute(
+                "SELECT DISTINCT date FROM hourly_weather_aggregates WHERE toUnixTimestamp(hour) IN %(hours)s",
+                {'hours': hours}
+            )]
+        
+        # Compute daily aggregates: sum hourly rainfall maxima to get daily totals. INSERT ... SELECT keeps
+        # the distribution states server-side (they cannot round-trip through the client)
+        rows_loaded_daily = len(dates_to_update)
+        if dates_to_update:
+            # Delete old aggregates for these dates to prevent SummingMergeTree from summing averages
+            # mutations_sync: the monthly and yearly rollups below read these rows right away
+            self.execute_bulk(
+                "ALTER TABLE daily_weather_aggregates DELETE WHERE date IN %(dates)s",
+                {'dates': dates_to_update},
+                settings={'mutations_sync': 1}
+            )
+            
+            self.execute_bulk(
+                f"""
+                INSERT INTO daily_weather_aggregates (date, avg_temperature_c, total_rainfall_mm,
+                    avg_humidity_percent, max_temperature_c, min_temperature_c, observation_count,
+                    warehouse_load_time, rows_loaded, sync_interval_min, load_mode,
+                    {', '.join(DISTRIBUTION_COLUMNS)})
                 SELECT 
-                    toYear(date) as year,
-                    toMonth(date) as month,
                     date,
                     avg(avg_temperature_c) as avg_temperature_c,
-                    sum(max_rainfall_per_hour) as total_rainfall_mm,
+                    sum(max_rainfall_mm) as total_rainfall_mm,
                     avg(avg_humidity_percent) as avg_humidity_percent,
                     max(max_temperature_c) as max_temperature_c,
                     min(min_temperature_c) as min_temperature_c,
-                    sum(observation_count) as observation_count
-                FROM (
-                    SELECT 
-                        toDate(timestamp) as date,
-                        toStartOfHour(timestamp) as hour,
-                        avg(temperature_c) as avg_temperature_c,
-                        max(rainfall_mm) as max_rainfall_per_hour,
-                        avg(humidity_percent) as avg_humidity_percent,
-                        max(temperature_c) as max_temperature_c,
-                        min(temperature_c) as min_temperature_c,
-                        count() as observation_count
-                    FROM weather_observations
-                    WHERE temperature_c IS NOT NULL
-                    GROUP BY date, hour
-                )
+                    sum(observation_count) as observation_count,
+                    %(load_time)s, %(rows_loaded)s, %(sync_interval_min)s, %(load_mode)s,
+                    {DISTRIBUTION_MERGE_SELECT}
+                FROM hourly_weather_aggregates FINAL
+                WHERE date IN %(dates)s
                 GROUP BY date
+                """,
+                {'dates': dates_to_update, 'load_time': load_time, 'rows_loaded': rows_loaded_daily,
+                 'sync_interval_min': sync_interval_min, 'load_mode': load_mode}
             )
-            GROUP BY year, month
-            ORDER BY year DESC, month DESC
-        """
         
-        monthly_results = self.client.execute(monthly_query)
-        rows_loaded_monthly = len(monthly_results)
+        # Monthly and yearly rollups are derived from the daily rows, only for periods with changed days
+        months_to_update = sorted({d.year * 100 + d.month for d in dates_to_update})
+        years_to_update = sorted({d.year for d in dates_to_update})
+        rows_loaded_monthly = self._rollup_from_daily(
+            "monthly_weather_aggregates", ["year", "month"], "toYYYYMM(date)", "year * 100 + month", months_to_update,
+            load_time, sync_interval_min, load_mode
+        )
+        rows_loaded_yearly = self._rollup_from_daily(
+            "yearly_weather_aggregates", ["year"], "toYear(date)", "year", years_to_update,
+            load_time, sync_interval_min, load_mode
+        )
         
-        if monthly_results:
-            # Get list of year-month combinations to delete old aggregates for
-            periods_to_update = [(row[0], row[1]) for row in monthly_results]
-            
-            # Delete old aggregates for these periods to prevent SummingMergeTree from summing averages
-            if periods_to_update:
-                periods_conditions = ' OR '.join([f"(year = {y} AND month = {m})" for y, m in periods_to_update])
-                self.client.execute(f"ALTER TABLE monthly_weather_aggregates DELETE WHERE {periods_conditions}")
-            
-            monthly_data = [
-                (
-                    row[0],  # year
-                    row[1],  # month
-                    row[2],  # avg_temperature_c
-                    row[3],  # total_rainfall_mm
-                    row[4],  # avg_humidity_percent
-                    row[5],  # max_temperature_c
-                    row[6],  # min_temperature_c
-                    row[7],  # observation_count
-                    load_time,
-                    rows_loaded_monthly,
-                    sync_interval_min,
-                    load_mode
-                )
-                for row in monthly_results
-            ]
-            
-            self.client.execute(
-                "INSERT INTO monthly_weather_aggregates VALUES",
-                monthly_data
-            )
+        # Only now, so hours of an interrupted run are refreshed again by the next one
+        self.mark_hours_done('aggregates', hours, pending_version)
         
-        print(f"Computed aggregates: {rows_loaded_daily} daily, {rows_loaded_monthly} monthly")
+        print(f"Computed aggregates: {len(hours)} hourly, {rows_loaded_daily} daily, "
+              f"{rows_loaded_monthly} monthly, {rows_loaded_yearly} yearly")
         
         return {
             'warehouse_load_time': load_time.isoformat(),
+            'rows_loaded_hourly': len(hours),
             'rows_loaded_daily': rows_loaded_daily,
             'rows_loaded_monthly': rows_loaded_monthly,
+            'rows_loaded_yearly': rows_loaded_yearly,
             'sync_interval_min': sync_interval_min,
             'load_mode': load_mode
         }
     
+    @profiled_stage
     def sync_from_mongodb(self, load_mode: str = "incremental") -> Dict:
         """Full sync from MongoDB to ClickHouse"""
         print("Starting ClickHouse sync from MongoDB...")
         
         # Load observations
         rows_loaded = self.load_observations(load_mode)
+        anomalies_flagged = self.detect_anomalies()
+        forecast_rows_loaded = self.load_forecasts()
         
         # Compute aggregates
         aggregate_metadata = self.compute_aggregates(config.SYNC_INTERVAL_MONGODB_TO_CLICKHOUSE)
         aggregate_metadata['rows_loaded'] = rows_loaded
+        aggregate_metadata['forecast_rows_loaded'] = forecast_rows_loaded
+        aggregate_metadata['anomalies_flagged'] = anomalies_flagged
         
         print("ClickHouse sync completed")
         return aggregate_metadata
     
+    @profiled_stage
     def get_monthly_averages(self, months: int = 12) -> List[Dict]:
         """Get monthly average temperature and rainfall for the last N months"""
-        # Aggregate by hour first (max per hour) to avoid double-counting duplicate observations
-        # Then aggregate by day, then by month
+        # Hourly rows already carry the max-per-hour rainfall; aggregate by day, then by month
         query = f"""
             SELECT 
                 year,
@@ -487,21 +1052,10 @@ class ClickHouseETL:
                     toMonth(date) as month,
                     date,
                     avg(avg_temperature_c) as avg_temperature_c,
-                    sum(max_rainfall_per_hour) as total_rainfall_mm,
+                    sum(max_rainfall_mm) as total_rainfall_mm,
                     avg(avg_humidity_percent) as avg_humidity_percent,
                     sum(observation_count) as observation_count
-                FROM (
-                    SELECT 
-                        toDate(timestamp) as date,
-                        toStartOfHour(timestamp) as hour,
-                        avg(temperature_c) as avg_temperature_c,
-                        max(rainfall_mm) as max_rainfall_per_hour,
-                        avg(humidity_percent) as avg_humidity_percent,
-                        count() as observation_count
-                    FROM weather_observations
-                    WHERE temperature_c IS NOT NULL
-                    GROUP BY date, hour
-                )
+                FROM hourly_weather_aggregates FINAL
                 GROUP BY date
             )
             GROUP BY year, month
@@ -523,40 +1077,28 @@ class ClickHouseETL:
             for row in results
         ]
     
+    @profiled_stage
     def get_daily_averages(self, days: int = 90) -> List[Dict]:
         """Get daily average temperature and rainfall for the last N days"""
-        # Aggregate by hour first (max per hour) to avoid double-counting duplicate observations
+        # Hourly rows already carry the max-per-hour rainfall dedup
         query = f"""
             SELECT 
                 date,
                 avg(avg_temperature_c) as avg_temperature_c,
-                sum(max_rainfall_per_hour) as total_rainfall_mm,
+                sum(max_rainfall_mm) as total_rainfall_mm,
                 avg(avg_humidity_percent) as avg_humidity_percent,
                 max(max_temperature_c) as max_temperature_c,
                 min(min_temperature_c) as min_temperature_c,
                 sum(observation_count) as observation_count,
                 max(latest_obs_time) as latest_obs_time
-            FROM (
-                SELECT 
-                    toDate(timestamp) as date,
-                    toStartOfHour(timestamp) as hour,
-                    avg(temperature_c) as avg_temperature_c,
-                    max(rainfall_mm) as max_rainfall_per_hour,
-                    avg(humidity_percent) as avg_humidity_percent,
-                    max(temperature_c) as max_temperature_c,
-                    min(temperature_c) as min_temperature_c,
-                    count() as observation_count,
-                    max(timestamp) as latest_obs_time
-                FROM weather_observations
-                WHERE temperature_c IS NOT NULL
-                GROUP BY date, hour
-            )
+            FROM hourly_weather_aggregates FINAL
             GROUP BY date
             ORDER BY date DESC
             LIMIT {days}
         """
         
-        results = self.client.execute(query)
+        # Rows are streamed block by block (CLICKHOUSE_READ_BLOCK_SIZE) and converted as they arrive
+        results = self.client.execute_iter(query)
         
         return [
             {
@@ -572,3 +1114,241 @@ class ClickHouseETL:
             for row in results
         ]
 
+    
+    def _distribution_row(self, levels, temperature_quantiles, humidity_quantiles, histogram) -> Dict:
+        # Merging no states yields NaN quantiles
+        temperature = [None if value is None or math.isnan(value) else value for value in temperature_quantiles]
+        humidity = [None if value is None or math.isnan(value) else min(value, 100.0)  # Cap humidity at 100%
+                    for value in humidity_quantiles]
+        return {
+            'temperature_percentiles_c': {f"p{level * 100:g}": value for level, value in zip(levels, temperature)},
+            'humidity_percentiles': {f"p{level * 100:g}": value for level, value in zip(levels, humidity)},
+            'humidity_histogram': {f"{bucket}-{bucket + 10}%": count for bucket, count in sorted(histogram.items())}
+        }
+    
+    @profiled_stage
+    def get_monthly_distributions(self, months: int = 12, levels=QUANTILE_LEVELS) -> List[Dict]:
+        """Approximate temperature/humidity percentiles and the humidity histogram for the last N months"""
+        levels_sql = ', '.join(str(float(level)) for level in levels)
+        query = f"""
+            SELECT 
+                year,
+                month,
+                quantilesTDigestMerge({levels_sql})(temperature_tdigest),
+                quantilesTDigestMerge({levels_sql})(humidity_tdigest),
+                sumMapMerge(humidity_histogram),
+                sum(observation_count)
+            FROM monthly_weather_aggregates
+            GROUP BY year, month
+            ORDER BY year DESC, month DESC
+            LIMIT {int(months)}
+        """
+        
+        return [
+            {'year': row[0], 'month': row[1], 'observation_count': row[5],
+             **self._distribution_row(levels, row[2], row[3], row[4])}
+            for row in self.client.execute(query)
+        ]
+    
+    @profiled_stage
+    def get_distribution(self, start_date, end_date, levels=QUANTILE_LEVELS) -> Dict:
+        """Percentiles and humidity histogram over a date range, merged from one daily state per day"""
+        levels_sql = ', '.join(str(float(level)) for level in levels)
+        row = self.client.execute(f"""
+            SELECT 
+                quantilesTDigestMerge({levels_sql})(temperature_tdigest),
+                quantilesTDigestMerge({levels_sql})(humidity_tdigest),
+                sumMapMerge(humidity_histogram),
+                sum(observation_count),
+                count()
+            FROM daily_weather_aggregates
+            WHERE date >= %(start)s AND date <= %(end)s
+        """, {'start': start_date, 'end': end_date})[0]
+        
+        return {'start_date': str(start_date), 'end_date': str(end_date), 'observation_count': row[3],
+                'days': row[4], **self._distribution_row(levels, row[0], row[1], row[2])}
+    
+    @profiled_stage
+    def get_forecast_accuracy(self, days: int = 90, lead_bucket_hours: int = 1, max_lead_hours: int = 168,
+                              location_id: Optional[str] = None) -> List[Dict]:
+        """Forecast error by lead time over the last N days: each location's hourly forecasts joined to the
+        hourly means of the stations its batches report from (every station weighs the same)"""
+        since = datetime.utcnow() - timedelta(days=int(days))
+        pairs = self.mongodb_etl.get_location_stations(since, [location_id] if location_id else None)
+        if not pairs:
+            return []
+        location_filter = "AND f.location_id = %(location_id)s" if location_id else ""
+        bucket = max(int(lead_bucket_hours), 1)
+        query = f"""
+            SELECT 
+                intDiv(f.lead_hours, {bucket}) * {bucket} as lead_hours,
+                count() as pairs,
+                avg(f.temperature_c - h.avg_temperature_c) as temperature_bias_c,
+                avg(abs(f.temperature_c - h.avg_temperature_c)) as temperature_mae_c,
+                sqrt(avg(pow(f.temperature_c - h.avg_temperature_c, 2))) as temperature_rmse_c,
+                avg(abs(f.humidity_percent - least(h.avg_humidity_percent, 100))) as humidity_mae,
+                -- Brier score of the precipitation probability against "any rain that hour"
+                avg(pow(f.precipitation_probability / 100 - if(h.max_rainfall_mm > 0, 1, 0), 2)) as precipitation_brier
+            FROM forecasts AS f FINAL
+            INNER JOIN (
+                SELECT
+                    m.location_id as location_id,
+                    s.hour as hour,
+                    avg(s.avg_temperature_c) as avg_temperature_c,
+                    avg(s.avg_humidity_percent) as avg_humidity_percent,
+                    max(s.max_rainfall_mm) as max_rainfall_mm
+                FROM (
+                    SELECT
+                        station_id,
+                        toStartOfHour(timestamp) as hour,
+                        avg(temperature_c) as avg_temperature_c,
+                        avg(humidity_percent) as avg_humidity_percent,
+                        max(rainfall_mm) as max_rainfall_mm
+                    FROM weather_observations
+                    WHERE timestamp >= toDateTime(%(since)s) AND station_id IN %(stations)s
+                    GROUP BY station_id, hour
+                ) AS s
+                INNER JOIN (
+                    SELECT pair.1 as location_id, pair.2 as station_id
+                    FROM (SELECT arrayJoin(arrayZip(%(pair_locations)s, %(pair_stations)s)) as pair)
+                ) AS m ON s.station_id = m.station_id
+                GROUP BY location_id, hour
+            ) AS h ON f.location_id = h.location_id AND f.valid_time = h.hour
+            WHERE f.valid_time >= toDateTime(%(since)s)
+              AND f.lead_hours >= 0 AND f.lead_hours <= {int(max_lead_hours)}
+              {location_filter}
+            GROUP BY lead_hours
+            ORDER BY lead_hours
+        """
+        params = {
+            'location_id': location_id,
+            'since': int(calendar.timegm(since.utctimetuple())),
+            'stations': sorted({station_id for _, station_id in pairs}),
+            'pair_locations': [location for location, _ in pairs],
+            'pair_stations': [station_id for _, station_id in pairs]
+        }
+        
+        return [
+            {
+                'lead_hours': row[0],
+                'pairs': row[1],
+                'temperature_bias_c': row[2],
+                'temperature_mae_c': row[3],
+                'temperature_rmse_c': row[4],
+                'humidity_mae': row[5],
+                'precipitation_brier': row[6]
+            }
+            for row in self.client.execute(query, params)
+        ]
+    
+    def iter_export_batches(self, dataset: str, start, end, batch_rows: Optional[int] = None) -> Iterator:
+        """Stream a dataset's rows with start <= time < end as Arrow record batches of at most batch_rows rows.
+        Rows are read block by block from ClickHouse, so memory stays bounded by one batch."""
+        if pa is None:
+            raise RuntimeError("Arrow/Parquet exports need the pyarrow package (pip install pyarrow)")
+        if dataset not in EXPORT_DATASETS:
+            raise ValueError(f"Unknown export dataset {dataset!r}; choose from {', '.join(EXPORT_DATASETS)}")
+        source, time_expr, columns = EXPORT_DATASETS[dataset]
+        batch_rows = batch_rows or config.EXPORT_BATCH_ROWS
+        # Whole days for date bounds
+        start, end = [datetime.combine(bound, datetime.min.time()) if type(bound) is date else bound
+                      for bound in (start, end)]
+        
+        rows = self.client.execute_iter(
+            f"""
+            SELECT {', '.join(columns)}
+            FROM {source}
+            WHERE {time_expr} >= %(start)s AND {time_expr} < %(end)s
+            ORDER BY {time_expr}
+            """,
+            {'start': start, 'end': end},
+            # Large ranges and slow readers outlast the interactive query timeout
+            timeout_sec=config.EXPORT_QUERY_TIMEOUT_SEC,
+            with_column_types=True
+        )
+        # The first item is the column names and types
+        column_types = next(rows)
+        arrow_types = [_arrow_type(type_) for _, type_ in column_types]
+        schema = None
+        
+        def to_batch(chunk: List[tuple]):
+            nonlocal schema
+            values = list(zip(*chunk)) if chunk else [[] for _ in column_types]
+            if schema is None:
+                # Types without a fixed mapping are inferred from the first block and kept for the rest
+                arrays = []
+                for column, arrow_type, (name, type_) in zip(values, arrow_types, column_types):
+                    try:
+                        arrays.append(pa.array(column, type=arrow_type))
+                    except (pa.ArrowException, OverflowError) as e:
+                        raise ValueError(f"Cannot export column {name} of type {type_}: {e}") from e
+                schema = pa.schema([(name, array.type) for (name, _), array in zip(column_types, arrays)])
+                return pa.RecordBatch.from_arrays(arrays, schema=schema)
+            return pa.RecordBatch.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(values, schema)], schema=schema
+            )
+        
+        chunk = []
+        batches = 0
+        try:
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) >= batch_rows:
+                    yield to_batch(chunk)
+                    batches += 1
+                    chunk = []
+        finally:
+            # An abandoned export releases (and discards) its pooled connection right away
+            rows.close()
+        if chunk or not batches:
+            # An empty export still carries the schema
+            yield to_batch(chunk)
+    
+    def _write_export(self, dataset: str, start, end, sink, export_format: str) -> Iterator[int]:
+        """Write the export to a file object batch by batch, yielding the running row count after each batch"""
+        if export_format not in ('parquet', 'arrow'):
+            raise ValueError(f"Unknown export format {export_format!r}; choose parquet or arrow")
+        writer = None
+        rows = 0
+        try:
+            for batch in self.iter_export_batches(dataset, start, end):
+                if writer is None:
+                    writer = (pq.ParquetWriter(sink, batch.schema, compression=config.EXPORT_COMPRESSION)
+                              if export_format == 'parquet' else pa.ipc.new_stream(sink, batch.schema))
+                # Every batch becomes its own Parquet row group / Arrow IPC message
+                writer.write_batch(batch)
+                rows += batch.num_rows
+                yield rows
+        finally:
+            if writer is not None:
+                writer.close()
+    
+    @profiled_stage
+    def export_to_file(self, dataset: str, start, end, path: str, export_format: Optional[str] = None) -> int:
+        """Export a dataset time range to a .parquet or .arrow (IPC stream) file; returns the row count"""
+        export_format = export_format or ('arrow' if path.endswith(('.arrow', '.arrows')) else 'parquet')
+        rows = 0
+        with open(path, 'wb') as f:
+            for rows in self._write_export(dataset, start, end, f, export_format):
+                pass
+        print(f"Exported {rows} {dataset} rows to {path}")
+        return rows
+    
+    def stream_export(self, dataset: str, start, end, export_format: str = 'parquet') -> Iterator[bytes]:
+        """Yield the encoded export in chunks as batches are written, e.g. for a streaming HTTP response"""
+        sink = _ExportSink()
+        batches = self._write_export(dataset, start, end, sink, export_format)
+        try:
+            while True:
+                # A decorator would only cover creating the generator; the stage is entered for each step
+                # instead of across yields, since the consumer may resume it on another thread
+                with query_stage('stream_export'):
+                    rows = next(batches, None)
+                # Footer / end-of-stream marker are written by the last step, on close
+                chunk = sink.drain()
+                if chunk:
+                    yield chunk
+                if rows is None:
+                    break
+        finally:
+            batches.close()
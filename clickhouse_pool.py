@@ -0,0 +1,249 @@
+"""
+ClickHouse Pool - Bounded, thread-safe pool of clickhouse_driver connections
+clickhouse_driver.Client is one socket and must not be shared between threads; the pool hands each
+caller its own connection for the duration of a query.
+"""
+import atexit
+import queue
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+from clickhouse_driver import Client
+from clickhouse_driver.errors import NetworkError, SocketTimeoutError, UnknownCompressionMethod
+import config
+from query_stats import QueryStatsRecorder, current_stage, new_query_id
+
+# Errors after which a connection's socket state is unknown; such connections are discarded
+CONNECTION_ERRORS = (NetworkError, SocketTimeoutError, EOFError, socket.timeout, ConnectionError)
+
+def create_client(database: Optional[str] = None, query_timeout_sec: Optional[float] = None,
+                  compression: Optional[str] = None, insert_block_size: Optional[int] = None) -> Client:
+    """Open a ClickHouse connection; clients are not thread-safe, so each thread needs its own"""
+    query_timeout_sec = config.CLICKHOUSE_QUERY_TIMEOUT_SEC if query_timeout_sec is None else query_timeout_sec
+    compression = (compression or config.CLICKHOUSE_COMPRESSION).lower()
+    kwargs = dict(
+        host=config.CLICKHOUSE_HOST,
+        port=config.CLICKHOUSE_PORT,
+        database=database or config.CLICKHOUSE_DB,
+        user=config.CLICKHOUSE_USER,
+        password=config.CLICKHOUSE_PASSWORD,
+        connect_timeout=config.CLICKHOUSE_CONNECT_TIMEOUT_SEC,
+        # The socket waits a little longer than the server-side limit so the server's error wins
+        send_receive_timeout=query_timeout_sec + 5,
+        # Rows per native block sent by INSERT ... VALUES
+        settings={'insert_block_size': insert_block_size or config.CLICKHOUSE_INSERT_BLOCK_SIZE}
+    )
+    if compression == "none":
+        return Client(**kwargs)
+    try:
+        return Client(compression=compression, compress_block_size=config.CLICKHOUSE_COMPRESS_BLOCK_SIZE, **kwargs)
+    except UnknownCompressionMethod:
+        # lz4/zstd need clickhouse-driver's optional extras (clickhouse-driver[lz4,zstd])
+        print(f"Warning: ClickHouse {compression} compression is unavailable, using an uncompressed connection")
+        return Client(**kwargs)
+
+class ClickHousePool:
+    def __init__(self, size: Optional[int] = None, checkout_timeout_sec: Optional[float] = None,
+                 query_timeout_sec: Optional[float] = None, database: Optional[str] = None,
+                 profile: Optional[bool] = None):
+        self.size = size or config.CLICKHOUSE_POOL_SIZE
+        self.checkout_timeout_sec = config.CLICKHOUSE_POOL_TIMEOUT_SEC if checkout_timeout_sec is None else checkout_timeout_sec
+        self.query_timeout_sec = config.CLICKHOUSE_QUERY_TIMEOUT_SEC if query_timeout_sec is None else query_timeout_sec
+        self.health_check_sec = config.CLICKHOUSE_HEALTH_CHECK_SEC
+        self.database = database
+        # LIFO keeps recently used (warm) connections in use and lets idle ones age out
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self.stats = {'checkouts': 0, 'waits': 0, 'created': 0, 'discarded': 0}
+        # Per-query stats go to pipeline_query_stats (see query_stats.py)
+        profile = config.CLICKHOUSE_QUERY_PROFILING if profile is None else profile
+        self.recorder = QueryStatsRecorder() if profile else None
+        if self.recorder:
+            atexit.register(self.flush_query_stats)
+
+    def _discard(self, client: Client):
+        try:
+            client.disconnect()
+        except Exception:
+            pass
+        with self._lock:
+            self._created -= 1
+            self.stats['discarded'] += 1
+
+    def _healthy(self, client: Client, idle_since: float) -> bool:
+        """Ping connections that sat idle long enough for the server or a proxy to have dropped them"""
+        if time.monotonic() - idle_since < self.health_check_sec:
+            return True
+        try:
+            client.execute("SELECT 1")
+            return True
+        except Exception:
+            return False
+
+    def _checkout(self) -> Client:
+        deadline = time.monotonic() + self.checkout_timeout_sec
+        with self._lock:
+            self.stats['checkouts'] += 1
+        waited = False
+        while True:
+            try:
+                client, idle_since = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_create = self._created < self.size
+                    if can_create:
+                        self._created += 1
+                        self.stats['created'] += 1
+                if can_create:
+                    try:
+                        return create_client(self.database, self.query_timeout_sec)
+                    except Exception:
+                        with self._lock:
+                            self._created -= 1
+                        raise
+                if not waited:
+                    waited = True
+                    with self._lock:
+                        self.stats['waits'] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No ClickHouse connection available within {self.checkout_timeout_sec}s "
+                                       f"(pool size {self.size})")
+                try:
+                    # Short waits so a slot freed by a discarded connection is noticed too
+                    client, idle_since = self._idle.get(timeout=min(remaining, 0.1))
+                except queue.Empty:
+                    continue
+            if self._healthy(client, idle_since):
+                return client
+            self._discard(client)
+
+    def _return(self, client: Client):
+        self._idle.put((client, time.monotonic()))
+
+    def _set_socket_timeout(self, client: Client, query_timeout_sec: float):
+        """Match the socket timeout to a query's server-side limit (0: no limit), like create_client does"""
+        timeout = query_timeout_sec + 5 if query_timeout_sec else None
+        connection = client.connection
+        connection.send_receive_timeout = timeout
+        if connection.connected and connection.socket is not None:
+            connection.socket.settimeout(timeout)
+
+    @contextmanager
+    def _query_timeout(self, client: Client, timeout_sec: Optional[float]):
+        """Apply a per-call timeout for the duration of one query, then restore the pool's"""
+        if timeout_sec is None or timeout_sec == self.query_timeout_sec:
+            yield
+            return
+        self._set_socket_timeout(client, timeout_sec)
+        try:
+            yield
+        finally:
+            self._set_socket_timeout(client, self.query_timeout_sec)
+
+    @contextmanager
+    def connection(self) -> Iterator[Client]:
+        """Check out a connection for exclusive use; it goes back to the pool afterwards"""
+        client = self._checkout()
+        try:
+            yield client
+        except CONNECTION_ERRORS:
+            self._discard(client)
+            raise
+        except Exception:
+            # Server-side errors leave the connection usable
+            self._return(client)
+            raise
+        except BaseException:
+            # Interrupted mid-query: unread packets may still be on the socket
+            self._discard(client)
+            raise
+        else:
+            self._return(client)
+
+    def execute(self, query: str, params=None, settings: Optional[Dict] = None, query_id: Optional[str] = None,
+                timeout_sec: Optional[float] = None, **kwargs):
+        """Drop-in for Client.execute, with the pool's per-query timeout and query profiling applied.
+        timeout_sec overrides the timeout for this call (0: no limit), e.g. for bulk ETL statements."""
+        timeout_sec = self.query_timeout_sec if timeout_sec is None else timeout_sec
+        query_settings = {'max_execution_time': timeout_sec}
+        query_settings.update(settings or {})
+        stage, root_stage = current_stage()
+        query_id = query_id or new_query_id(stage)
+        with self.connection() as client, self._query_timeout(client, timeout_sec):
+            started = time.perf_counter()
+            try:
+                result = client.execute(query, params, settings=query_settings, query_id=query_id, **kwargs)
+            except Exception as e:
+                if self.recorder:
+                    self.recorder.record(query_id, stage, root_stage, query, time.perf_counter() - started,
+                                         getattr(client, 'last_query', None), exception=str(e)[:500])
+                raise
+            if self.recorder:
+                self.recorder.record(query_id, stage, root_stage, query, time.perf_counter() - started,
+                                     getattr(client, 'last_query', None),
+                                     result_rows=len(result) if isinstance(result, list) else 0)
+                if self.recorder.should_flush():
+                    self.recorder.flush(client.execute)
+            return result
+
+    def execute_iter(self, query: str, params=None, settings: Optional[Dict] = None,
+                     query_id: Optional[str] = None, timeout_sec: Optional[float] = None, **kwargs) -> Iterator:
+        """Stream result rows block by block; the connection stays checked out until iteration ends"""
+        timeout_sec = self.query_timeout_sec if timeout_sec is None else timeout_sec
+        query_settings = {'max_execution_time': timeout_sec,
+                          'max_block_size': config.CLICKHOUSE_READ_BLOCK_SIZE}
+        query_settings.update(settings or {})
+        stage, root_stage = current_stage()
+        query_id = query_id or new_query_id(stage)
+        client = self._checkout()
+        started = time.perf_counter()
+        rows = 0
+        try:
+            with self._query_timeout(client, timeout_sec):
+                for row in client.execute_iter(query, params, settings=query_settings, query_id=query_id, **kwargs):
+                    rows += 1
+                    yield row
+        except CONNECTION_ERRORS:
+            self._discard(client)
+            raise
+        except GeneratorExit:
+            # Abandoned mid-stream: the rest of the result is still on the socket
+            self._discard(client)
+            raise
+        except Exception as e:
+            if self.recorder:
+                self.recorder.record(query_id, stage, root_stage, query, time.perf_counter() - started,
+                                     getattr(client, 'last_query', None), exception=str(e)[:500])
+            self._return(client)
+            raise
+        except BaseException:
+            self._discard(client)
+            raise
+        if self.recorder:
+            self.recorder.record(query_id, stage, root_stage, query, time.perf_counter() - started,
+                                 getattr(client, 'last_query', None), result_rows=rows)
+        self._return(client)
+
+    def flush_query_stats(self):
+        """Write all buffered query stats now (also runs at interpreter exit); the size/interval
+        threshold only applies on the query path"""
+        if self.recorder and self.recorder.has_pending():
+            try:
+                with self.connection() as client:
+                    self.recorder.flush(client.execute)
+            except Exception as e:
+                print(f"Warning: could not flush query stats: {e}")
+
+    def close(self):
+        """Flush query stats and disconnect all idle connections"""
+        self.flush_query_stats()
+        while True:
+            try:
+                client, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(client)
@@ -18,6 +18,19 @@ MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017/")
 MONGODB_DB = os.getenv("MONGODB_DB", "Project2")
 MONGODB_COLLECTION_RAW = os.getenv("MONGODB_COLLECTION_RAW", "raw_observations")
 MONGODB_COLLECTION_ENRICHED = os.getenv("MONGODB_COLLECTION_ENRICHED", "enriched_observations")
+MONGODB_COLLECTION_OBSERVATIONS = os.getenv("MONGODB_COLLECTION_OBSERVATIONS", "observations")  # One doc per observation
+MONGODB_COLLECTION_COLD = os.getenv("MONGODB_COLLECTION_COLD", "raw_cold_storage")
+MONGODB_COLLECTION_RUNNING_AGGREGATES = os.getenv("MONGODB_COLLECTION_RUNNING_AGGREGATES", "daily_running_aggregates")
+MONGODB_RUNNING_AGGREGATES = os.getenv("MONGODB_RUNNING_AGGREGATES", "true").lower() == "true"
+# Store forecasts once per distinct content in a shared blob store and reference them from raw batches
+MONGODB_COLLECTION_BLOBS = os.getenv("MONGODB_COLLECTION_BLOBS", "payload_blobs")
+MONGODB_CONTENT_ADDRESSED_FORECASTS = os.getenv("MONGODB_CONTENT_ADDRESSED_FORECASTS", "false").lower() == "true"
+# Store compact observation records instead of full GeoJSON features
+MONGODB_SLIM_SCHEMA = os.getenv("MONGODB_SLIM_SCHEMA", "false").lower() == "true"
+# In slim mode, also keep the untouched payload zlib-compressed in the cold storage collection
+MONGODB_KEEP_COLD_RAW = os.getenv("MONGODB_KEEP_COLD_RAW", "true").lower() == "true"
+# "python" computes batch metrics client-side, "aggregation" runs them as a MongoDB pipeline
+MONGODB_ENRICH_MODE = os.getenv("MONGODB_ENRICH_MODE", "python")
 
 # ClickHouse connection
 CLICKHOUSE_HOST = os.getenv("CLICKHOUSE_HOST", "localhost")
@@ -25,6 +38,24 @@ CLICKHOUSE_PORT = int(os.getenv("CLICKHOUSE_PORT", "9000"))
 CLICKHOUSE_DB = os.getenv("CLICKHOUSE_DB", "weather_warehouse")
 CLICKHOUSE_USER = os.getenv("CLICKHOUSE_USER", "default")
 CLICKHOUSE_PASSWORD = os.getenv("CLICKHOUSE_PASSWORD", "default")
+# Connection pool shared by all ClickHouse access paths (dashboard threads, ETL, CDC)
+CLICKHOUSE_POOL_SIZE = int(os.getenv("CLICKHOUSE_POOL_SIZE", "8"))
+CLICKHOUSE_POOL_TIMEOUT_SEC = float(os.getenv("CLICKHOUSE_POOL_TIMEOUT_SEC", "10"))
+CLICKHOUSE_QUERY_TIMEOUT_SEC = int(os.getenv("CLICKHOUSE_QUERY_TIMEOUT_SEC", "60"))
+# Rebuilds, backfills, aggregate mutations and bulk inserts (0: no limit)
+CLICKHOUSE_BULK_QUERY_TIMEOUT_SEC = int(os.getenv("CLICKHOUSE_BULK_QUERY_TIMEOUT_SEC", "3600"))
+CLICKHOUSE_CONNECT_TIMEOUT_SEC = float(os.getenv("CLICKHOUSE_CONNECT_TIMEOUT_SEC", "10"))
+CLICKHOUSE_HEALTH_CHECK_SEC = float(os.getenv("CLICKHOUSE_HEALTH_CHECK_SEC", "30"))
+# Wire compression (none, lz4, lz4hc, zstd) and block sizes for bulk transfers
+CLICKHOUSE_COMPRESSION = os.getenv("CLICKHOUSE_COMPRESSION", "lz4")
+CLICKHOUSE_COMPRESS_BLOCK_SIZE = int(os.getenv("CLICKHOUSE_COMPRESS_BLOCK_SIZE", "1048576"))
+CLICKHOUSE_INSERT_BLOCK_SIZE = int(os.getenv("CLICKHOUSE_INSERT_BLOCK_SIZE", "100000"))
+CLICKHOUSE_READ_BLOCK_SIZE = int(os.getenv("CLICKHOUSE_READ_BLOCK_SIZE", "65536"))
+# Query profiling: every pooled query is tagged with a stage and query_id and logged to pipeline_query_stats
+CLICKHOUSE_QUERY_PROFILING = os.getenv("CLICKHOUSE_QUERY_PROFILING", "true").lower() == "true"
+CLICKHOUSE_QUERY_STATS_FLUSH_SIZE = int(os.getenv("CLICKHOUSE_QUERY_STATS_FLUSH_SIZE", "50"))
+CLICKHOUSE_QUERY_STATS_FLUSH_SEC = float(os.getenv("CLICKHOUSE_QUERY_STATS_FLUSH_SEC", "30"))
+CLICKHOUSE_QUERY_STATS_TTL_DAYS = int(os.getenv("CLICKHOUSE_QUERY_STATS_TTL_DAYS", "90"))
 
 # Redis connection
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
@@ -35,13 +66,69 @@ REDIS_TTL = int(os.getenv("REDIS_TTL", "3600"))  # 1 hour in seconds
 # NWS API
 NWS_API_BASE = os.getenv("NWS_API_BASE", "https://api.weather.gov")
 NWS_USER_AGENT = os.getenv("NWS_USER_AGENT", "StocktonWeatherPipeline/1.0 (contact@example.com)")
+NWS_PAGE_LIMIT_MIN = int(os.getenv("NWS_PAGE_LIMIT_MIN", "50"))  # Smallest observations page requested
+NWS_PAGE_LIMIT_MAX = int(os.getenv("NWS_PAGE_LIMIT_MAX", "500"))  # NWS rejects limits above 500
+NWS_MAX_REQUESTS_PER_SEC = float(os.getenv("NWS_MAX_REQUESTS_PER_SEC", "3"))  # Shared across all fetch threads
+# Collect the N nearest stations in parallel; 0 keeps the first station that returns data
+NWS_OBSERVATION_STATIONS = int(os.getenv("NWS_OBSERVATION_STATIONS", "0"))
+# Parse observation responses incrementally (requires ijson) and keep only the fields the pipeline uses
+NWS_STREAMING_DECODE = os.getenv("NWS_STREAMING_DECODE", "false").lower() == "true"
+# Merge latest and historical observations so each (station, timestamp) is kept once
+NWS_DEDUPE_OBSERVATIONS = os.getenv("NWS_DEDUPE_OBSERVATIONS", "true").lower() == "true"
+
+# NWS record/replay transport for offline benchmarking
+NWS_TRANSPORT = os.getenv("NWS_TRANSPORT", "live")  # "live", "record" or "replay"
+NWS_FIXTURE_DIR = os.getenv("NWS_FIXTURE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "nws"))
+NWS_REPLAY_LATENCY_MS = float(os.getenv("NWS_REPLAY_LATENCY_MS", "0"))
+NWS_REPLAY_ERROR_RATE = float(os.getenv("NWS_REPLAY_ERROR_RATE", "0"))
+NWS_REPLAY_ERROR_KIND = os.getenv("NWS_REPLAY_ERROR_KIND", "http")  # "http" (503) or "timeout"
+NWS_REPLAY_SCALE = int(os.getenv("NWS_REPLAY_SCALE", "1"))  # Multiply observation features per page
+NWS_REPLAY_SEED = int(os.getenv("NWS_REPLAY_SEED", "42"))
+
+# Multi-location fan-out ingestion
+LOCATIONS_SOURCE = os.getenv("LOCATIONS_SOURCE", "file")  # "file" or "mongodb"
+LOCATIONS_FILE = os.getenv("LOCATIONS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "locations.json"))
+MONGODB_COLLECTION_LOCATIONS = os.getenv("MONGODB_COLLECTION_LOCATIONS", "locations")
+FANOUT_ENABLED = os.getenv("FANOUT_ENABLED", "false").lower() == "true"
+FANOUT_MAX_WORKERS = int(os.getenv("FANOUT_MAX_WORKERS", "8"))
 
 # Sync intervals (in minutes)
 SYNC_INTERVAL_API_TO_MONGODB = int(os.getenv("SYNC_INTERVAL_API_TO_MONGODB", "30"))
 SYNC_INTERVAL_MONGODB_TO_CLICKHOUSE = int(os.getenv("SYNC_INTERVAL_MONGODB_TO_CLICKHOUSE", "60"))
 SYNC_INTERVAL_CLICKHOUSE_TO_REDIS = int(os.getenv("SYNC_INTERVAL_CLICKHOUSE_TO_REDIS", "30"))
 
+# Change-stream CDC from MongoDB to ClickHouse (replaces the MongoDB -> ClickHouse timer when enabled)
+CDC_ENABLED = os.getenv("CDC_ENABLED", "false").lower() == "true"
+CDC_BATCH_WINDOW_SEC = float(os.getenv("CDC_BATCH_WINDOW_SEC", "5"))
+CDC_BATCH_MAX_DOCS = int(os.getenv("CDC_BATCH_MAX_DOCS", "50"))
+CDC_AGGREGATE_INTERVAL_SEC = float(os.getenv("CDC_AGGREGATE_INTERVAL_SEC", "60"))
+MONGODB_COLLECTION_CDC_STATE = os.getenv("MONGODB_COLLECTION_CDC_STATE", "cdc_state")
+CDC_RETRY_BACKOFF_SEC = float(os.getenv("CDC_RETRY_BACKOFF_SEC", "5"))  # Doubles per consecutive error
+CDC_RETRY_MAX_BACKOFF_SEC = float(os.getenv("CDC_RETRY_MAX_BACKOFF_SEC", "300"))
+
+# Raw batch archival: batches older than ARCHIVE_AFTER_DAYS move to monthly Parquet files
+ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "false").lower() == "true"
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "archive", "raw"))
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+ARCHIVE_COMPRESSION = os.getenv("ARCHIVE_COMPRESSION", "zstd")
+
+# Warehouse replay: rebuild weather_observations from raw batches in parallel chunks
+REPLAY_WORKERS = int(os.getenv("REPLAY_WORKERS", "4"))
+REPLAY_CHUNK_DOCS = int(os.getenv("REPLAY_CHUNK_DOCS", "200"))
+
+# Anomaly detection on newly loaded hours: z-score against per-station running baselines by season and hour of day
+ANOMALY_DETECTION_ENABLED = os.getenv("ANOMALY_DETECTION_ENABLED", "true").lower() == "true"
+ANOMALY_Z_THRESHOLD = float(os.getenv("ANOMALY_Z_THRESHOLD", "3.0"))
+ANOMALY_MIN_SAMPLES = int(os.getenv("ANOMALY_MIN_SAMPLES", "24"))  # Samples a baseline needs before it scores
+ANOMALY_CACHE_DAYS = int(os.getenv("ANOMALY_CACHE_DAYS", "7"))  # Window of flagged readings cached in Redis
+
+# Arrow/Parquet exports (ClickHouseETL.export_to_file / stream_export, GET /api/export/<dataset>)
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "65536"))  # Rows per record batch / Parquet row group
+EXPORT_COMPRESSION = os.getenv("EXPORT_COMPRESSION", "zstd")  # Parquet codec
+EXPORT_MAX_CONCURRENT = int(os.getenv("EXPORT_MAX_CONCURRENT", "2"))  # Simultaneous dashboard exports
+EXPORT_QUERY_TIMEOUT_SEC = int(os.getenv("EXPORT_QUERY_TIMEOUT_SEC", "3600"))  # Per export query (0: no limit)
+
 # Dashboard
 DASHBOARD_HOST = os.getenv("DASHBOARD_HOST", "127.0.0.1")
 DASHBOARD_PORT = int(os.getenv("DASHBOARD_PORT", "5001"))
-
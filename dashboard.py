@@ -2,12 +2,13 @@
 Web Dashboard - Visualizes weather data from Redis/ClickHouse
 Redesigned with glassmorphism and Team_Supra layout
 """
-from flask import Flask, render_template_string, jsonify, request
+from flask import Flask, Response, render_template_string, jsonify, request
 import json
-from datetime import datetime
+import threading
+from datetime import date, datetime, timedelta
 import config
 from redis_etl import RedisETL
-from clickhouse_etl import ClickHouseETL
+from clickhouse_etl import EXPORT_DATASETS, ClickHouseETL
 from mongodb_etl import MongoDBETL
 
 app = Flask(__name__)
@@ -16,6 +17,9 @@ redis_etl = RedisETL()
 clickhouse_etl = ClickHouseETL()
 mongodb_etl = MongoDBETL()
 
+# Each running export holds a request thread and a pooled ClickHouse connection until it finishes
+export_slots = threading.BoundedSemaphore(config.EXPORT_MAX_CONCURRENT)
+
 # HTML Template with Glassmorphism Design
 DASHBOARD_HTML = """
 <!DOCTYPE html>
@@ -707,9 +711,9 @@ DASHBOARD_HTML = """
                 updateSyncStatus(data.sync_status || 'out-of-sync');
                 
                 // Update today's temperature - show the date of the weather data itself
-                if (data.daily_data && data.daily_data.length > 0) {
-                    // Get the most recent data point (first in array as it's sorted DESC)
-                    const todayData = data.daily_data[0];
+                if (data.today || (data.daily_data && data.daily_data.length > 0)) {
+                    // Current day's running stats, else the most recent warehouse day (first as it's sorted DESC)
+                    const todayData = data.today || data.daily_data[0];
                     
                     if (todayData && todayData.date) {
                         // Format the date of the weather observation (not fetch date)
@@ -1073,6 +1077,14 @@ DASHBOARD_HTML = """
 </html>
 """
 
+def _today_stats():
+    """Current UTC day's statistics from the MongoDB running aggregate, in the daily_data row format"""
+    today = mongodb_etl.get_daily_stats()
+    if not today:
+        return None
+    latest_obs_time = today.pop('latest_obs_time')
+    return {**today, 'latest_obs_timestamp': latest_obs_time.isoformat() if latest_obs_time else None}
+
 @app.route('/')
 def dashboard():
     return render_template_string(DASHBOARD_HTML)
@@ -1097,6 +1109,7 @@ def get_dashboard_data():
                 'overall_averages': overall_avg,
                 'monthly_data': cached_data.get('monthly_data', []),
                 'daily_data': daily_data,
+                'today': _today_stats(),
                 'sync_status': sync_status,
                 'data_source': 'redis',
                 'cache_timestamp': cached_data.get('cache_timestamp')
@@ -1126,6 +1139,7 @@ def get_dashboard_data():
                     },
                     'monthly_data': monthly_data,
                     'daily_data': daily_data,
+                    'today': _today_stats(),
                     'sync_status': 'partial',
                     'data_source': 'clickhouse'
                 })
@@ -1140,6 +1154,141 @@ def get_dashboard_data():
             'sync_status': 'out-of-sync'
         })
 
+@app.route('/api/distributions')
+def get_distributions():
+    """Approximate temperature/humidity percentiles and humidity histograms per month, or for a date range"""
+    try:
+        start_date = request.args.get('start')
+        end_date = request.args.get('end')
+        if start_date and end_date:
+            return jsonify(clickhouse_etl.get_distribution(date.fromisoformat(start_date), date.fromisoformat(end_date)))
+        months = request.args.get('months', 12, type=int)
+        return jsonify({'monthly_distributions': clickhouse_etl.get_monthly_distributions(months)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/forecast-accuracy')
+def get_forecast_accuracy():
+    """Hourly forecast error by lead time (?days=90&bucket=6 groups lead times into 6-hour buckets)"""
+    try:
+        days = request.args.get('days', 90, type=int)
+        bucket = request.args.get('bucket', 1, type=int)
+        location_id = request.args.get('location_id')
+        return jsonify({'accuracy_by_lead_time': clickhouse_etl.get_forecast_accuracy(days, bucket, location_id=location_id)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def _time_window(default_days: int = 7) -> tuple:
+    """[start, end) from ?start=&end= ISO dates or datetimes (UTC), defaulting to the last default_days days"""
+    end = datetime.fromisoformat(request.args['end']) if 'end' in request.args else datetime.utcnow()
+    start = datetime.fromisoformat(request.args['start']) if 'start' in request.args else end - timedelta(days=default_days)
+    return start, end
+
+@app.route('/api/window-metrics')
+def get_window_metrics():
+    """Metrics recomputed in MongoDB over any window (?start=&end=&bucket=hour|day|month|all&station_id=)"""
+    bucket = request.args.get('bucket', 'day')
+    if bucket not in ('hour', 'day', 'month', 'all'):
+        return jsonify({'error': 'bucket must be one of hour, day, month, all'}), 400
+    try:
+        start, end = _time_window()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        station_id = request.args.get('station_id')
+        return jsonify({
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'bucket': bucket,
+            'metrics': mongodb_etl.compute_window_metrics(start, end, station_id, bucket)
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/rolling-metrics')
+def get_rolling_metrics():
+    """Per-observation rolling averages over the preceding hours (?start=&end=&window_hours=24&station_id=)"""
+    try:
+        start, end = _time_window(default_days=1)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        window_hours = request.args.get('window_hours', 24, type=int)
+        station_id = request.args.get('station_id')
+        return jsonify({
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'window_hours': window_hours,
+            'observations': mongodb_etl.compute_rolling_metrics(start, end, window_hours, station_id)
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/blob-dedup')
+def get_blob_dedup():
+    """How much forecast storage the content-addressed blob store saves, per forecast kind"""
+    try:
+        return jsonify({
+            'enabled': mongodb_etl.content_addressed,
+            'blob_dedup': mongodb_etl.blob_dedup_report()
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/anomalies')
+def get_anomalies():
+    """Recently flagged readings, from Redis or ClickHouse"""
+    try:
+        days = request.args.get('days', config.ANOMALY_CACHE_DAYS, type=int)
+        cached_data = redis_etl.get_cached_data("weather:stockton:anomalies")
+        # The cache holds one period; other periods go to ClickHouse
+        if cached_data and cached_data.get('period_days') == days:
+            return jsonify({**cached_data, 'data_source': 'redis'})
+        return jsonify({
+            'period_days': days,
+            'anomalies': clickhouse_etl.anomaly_detector.get_recent_anomalies(days),
+            'data_source': 'clickhouse'
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/export/<dataset>')
+def export_dataset(dataset):
+    """Stream a dataset as Parquet or an Arrow IPC stream (?start=YYYY-MM-DD&end=YYYY-MM-DD&format=parquet|arrow)"""
+    export_format = request.args.get('format', 'parquet')
+    if dataset not in EXPORT_DATASETS or export_format not in ('parquet', 'arrow'):
+        return jsonify({'error': f"Unknown dataset or format; datasets: {', '.join(EXPORT_DATASETS)}; "
+                                 f"formats: parquet, arrow"}), 400
+    try:
+        end = date.fromisoformat(request.args['end']) if 'end' in request.args else date.today() + timedelta(days=1)
+        start = date.fromisoformat(request.args['start']) if 'start' in request.args else end - timedelta(days=30)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if not export_slots.acquire(blocking=False):
+        return jsonify({'error': 'Too many exports running, retry shortly'}), 429
+    chunks = clickhouse_etl.stream_export(dataset, start, end, export_format)
+    try:
+        # Run the query before answering, so errors still get a proper status code
+        first_chunk = next(chunks, b'')
+    except Exception as e:
+        export_slots.release()
+        return jsonify({'error': str(e)}), 500
+    
+    def generate():
+        yield first_chunk
+        yield from chunks
+    
+    extension = 'parquet' if export_format == 'parquet' else 'arrows'
+    response = Response(
+        generate(),
+        mimetype='application/vnd.apache.parquet' if export_format == 'parquet' else 'application/vnd.apache.arrow.stream',
+        headers={'Content-Disposition': f'attachment; filename={dataset}_{start}_{end}.{extension}'}
+    )
+    # Also runs when the client disconnects mid-download (which closes the ClickHouse stream)
+    response.call_on_close(export_slots.release)
+    return response
+
 @app.route('/api/sync', methods=['POST'])
 def trigger_sync():
     """Trigger a full sync across all layers"""
@@ -1160,5 +1309,6 @@ def trigger_sync():
 
 if __name__ == '__main__':
     print(f"Starting dashboard on http://{config.DASHBOARD_HOST}:{config.DASHBOARD_PORT}")
-    app.run(host=config.DASHBOARD_HOST, port=config.DASHBOARD_PORT, debug=True)
+    # ClickHouse access goes through a connection pool, so requests can be served concurrently
+    app.run(host=config.DASHBOARD_HOST, port=config.DASHBOARD_PORT, debug=True, threaded=True)
 
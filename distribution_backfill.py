@@ -0,0 +1,38 @@
+"""
+Distribution Backfill - Recomputes the quantile and histogram states of the aggregate tables
+Aggregate rows written before the distribution columns were added hold empty states. This refreshes
+every hour once through the regular incremental path. Run it once after upgrading.
+"""
+import argparse
+import time
+from datetime import datetime
+from typing import Dict, Optional
+from clickhouse_etl import ClickHouseETL
+
+class DistributionBackfill:
+    def __init__(self, clickhouse_etl: Optional[ClickHouseETL] = None, timeout_sec: int = 0):
+        self.clickhouse_etl = clickhouse_etl or ClickHouseETL()
+        # Every hour, day, month and year is rewritten, so the statements get their own limit (0: none)
+        self.clickhouse_etl.bulk_timeout_sec = timeout_sec
+
+    def run(self, force: bool = False) -> Optional[Dict]:
+        if not force and not self.clickhouse_etl.distribution_states_missing():
+            print("Distribution states are complete; nothing to backfill")
+            return None
+        print(f"[{datetime.now()}] Recomputing quantile and histogram states in the aggregate tables...")
+        started = time.perf_counter()
+        # Pending until compute_aggregates finishes, so an interrupted backfill resumes with the next sync
+        self.clickhouse_etl.queue_all_hours(['aggregates'])
+        metadata = self.clickhouse_etl.compute_aggregates()
+        print(f"Backfilled distribution states in {time.perf_counter() - started:.1f}s")
+        return metadata
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute the distribution states of the aggregate tables")
+    parser.add_argument("--timeout-sec", type=int, default=0, help="Per-statement limit in seconds (0: no limit)")
+    parser.add_argument("--force", action="store_true", help="Recompute even if no empty states are found")
+    args = parser.parse_args()
+    DistributionBackfill(timeout_sec=args.timeout_sec).run(force=args.force)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Location Registry - Lists the locations ingested by the fan-out pipeline
+Locations come from a JSON file or a MongoDB collection
+"""
+import json
+from typing import Dict, List
+import config
+
+REQUIRED_FIELDS = ("location_id", "city", "state", "latitude", "longitude")
+
+class LocationRegistry:
+    def __init__(self, source: str = None, mongodb_db=None):
+        self.source = source or config.LOCATIONS_SOURCE
+        self.mongodb_db = mongodb_db
+    
+    def _validate(self, locations: List[Dict]) -> List[Dict]:
+        """Drop entries missing required fields and duplicate location IDs"""
+        valid = []
+        seen = set()
+        for location in locations:
+            missing = [field for field in REQUIRED_FIELDS if location.get(field) is None]
+            if missing:
+                print(f"Skipping location {location.get('location_id', '?')}: missing {', '.join(missing)}")
+                continue
+            if location['location_id'] in seen:
+                continue
+            seen.add(location['location_id'])
+            valid.append({field: location[field] for field in REQUIRED_FIELDS})
+        return valid
+    
+    def load_from_file(self, path: str = None) -> List[Dict]:
+        """Load locations from a JSON array file"""
+        with open(path or config.LOCATIONS_FILE) as f:
+            return self._validate(json.load(f))
+    
+    def load_from_mongodb(self) -> List[Dict]:
+        """Load enabled locations from the MongoDB locations collection"""
+        collection = self.mongodb_db[config.MONGODB_COLLECTION_LOCATIONS]
+        return self._validate(list(collection.find({"enabled": {"$ne": False}}, {"_id": 0})))
+    
+    def get_locations(self) -> List[Dict]:
+        """Get all registered locations from the configured source"""
+        if self.source == "mongodb":
+            return self.load_from_mongodb()
+        return self.load_from_file()
+    
+    def seed_mongodb_from_file(self, path: str = None) -> int:
+        """Upsert the locations from a JSON file into the MongoDB locations collection"""
+        collection = self.mongodb_db[config.MONGODB_COLLECTION_LOCATIONS]
+        collection.create_index("location_id", unique=True)
+        locations = self.load_from_file(path)
+        for location in locations:
+            collection.update_one(
+                {"location_id": location['location_id']},
+                {"$set": location},
+                upsert=True
+            )
+        return len(locations)
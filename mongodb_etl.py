@@ -1,11 +1,25 @@
 """
 MongoDB ETL - Stores raw and enriched weather data
 """
-from pymongo import MongoClient
-from datetime import datetime
-from typing import Dict, Optional
+from bson import Binary
+from pymongo import ASCENDING, MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+import hashlib
+import json
+import time
+import zlib
 import config
-from nws_api_fetcher_v2 import NWSAPIFetcher
+from location_registry import LocationRegistry
+from nws_api_fetcher_v2 import (NWSAPIFetcher, StationCache, measurement, observation_id, observation_properties,
+                                slim_forecast, slim_observation)
+
+# Sub-payloads stored once in the blob store when content addressing is enabled
+CONTENT_ADDRESSED_FIELDS = ('forecast', 'hourly_forecast')
+# Forecast properties that change on every request even when the forecast itself does not
+CONTENT_VOLATILE_FIELDS = ('generatedAt',)
 
 class MongoDBETL:
     def __init__(self):
@@ -17,12 +31,228 @@ class MongoDBETL:
         self.db = self.client[config.MONGODB_DB]
         self.raw_collection = self.db[config.MONGODB_COLLECTION_RAW]
         self.enriched_collection = self.db[config.MONGODB_COLLECTION_ENRICHED]
+        self.observations_collection = self.db[config.MONGODB_COLLECTION_OBSERVATIONS]
+        self.cold_collection = self.db[config.MONGODB_COLLECTION_COLD]
+        self.running_aggregates_collection = self.db[config.MONGODB_COLLECTION_RUNNING_AGGREGATES]
+        self.blobs_collection = self.db[config.MONGODB_COLLECTION_BLOBS]
+        self.content_addressed = config.MONGODB_CONTENT_ADDRESSED_FORECASTS
+        self.slim_schema = config.MONGODB_SLIM_SCHEMA
+        self.keep_cold_raw = config.MONGODB_KEEP_COLD_RAW
+        self.enrich_mode = config.MONGODB_ENRICH_MODE
         self.api_fetcher = NWSAPIFetcher()
+        self._ensure_indexes()
+    
+    def _ensure_indexes(self):
+        """Create the indexes the observation-level store relies on"""
+        # One document per (station, timestamp); also serves station + time range queries
+        self.observations_collection.create_index(
+            [("station_id", ASCENDING), ("timestamp", ASCENDING)], unique=True
+        )
+        self.observations_collection.create_index([("timestamp", ASCENDING)])
+        # Raw batches reference their observations by the same id the warehouse uses
+        self.observations_collection.create_index([("observation_id", ASCENDING)])
+        # Incremental warehouse loads read only observations stored since their watermark
+        self.observations_collection.create_index([("first_seen_utc", ASCENDING)])
+        # Forecast loads read only the raw batches fetched since their watermark
+        self.raw_collection.create_index([("source_timestamp", ASCENDING)])
+        self.running_aggregates_collection.create_index(
+            [("date", ASCENDING), ("station_id", ASCENDING)], unique=True
+        )
+    
+    def _observation_record(self, feature: Dict, raw_data: Dict) -> Optional[Dict]:
+        """Turn an NWS observation feature into an observation-level document"""
+        props = observation_properties(feature)
+        timestamp_str = props.get('timestamp')
+        station_id = feature.get('station_id') or (props.get('station') or '').split('/')[-1]
+        if not timestamp_str or not station_id:
+            return None
+        timestamp = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
+        return {
+            'observation_id': observation_id(station_id, timestamp),
+            'station_id': station_id,
+            'timestamp': timestamp,
+            'properties': props,
+            'location_id': raw_data.get('location', {}).get('location_id'),
+            'etl_batch_id': raw_data.get('etl_batch_id'),
+            'api_request_id': raw_data.get('api_request_id'),
+            'source_timestamp': raw_data.get('source_timestamp'),
+            'first_seen_utc': datetime.utcnow()
+        }
+    
+    def _upsert_observations(self, records: List[Dict]) -> Dict:
+        """Upsert observation records; only ones stored for the first time count as new"""
+        operations = []
+        for record in records:
+            inserted = {k: v for k, v in record.items() if k != 'observation_id'}
+            operations.append(UpdateOne(
+                {'station_id': record['station_id'], 'timestamp': record['timestamp']},
+                # Documents stored before observation ids existed get theirs on the next sighting
+                {'$setOnInsert': inserted, '$set': {'observation_id': record['observation_id']}},
+                upsert=True
+            ))
+        if not operations:
+            return {'new_observations': 0, 'existing_observations': 0}
+        
+        try:
+            result = self.observations_collection.bulk_write(operations, ordered=False)
+            details = result.bulk_api_result
+        except BulkWriteError as e:
+            # Concurrent fan-out workers can race on the same upsert; the loser hits the unique index.
+            # Anything other than that duplicate-key error is a real failure.
+            if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                raise
+            details = e.details
+        new_count = details.get('nUpserted', 0)
+        
+        # Only observations stored for the first time feed the running aggregates
+        if config.MONGODB_RUNNING_AGGREGATES:
+            self.update_running_aggregates([records[item['index']] for item in details.get('upserted', [])])
+        return {'new_observations': new_count, 'existing_observations': len(operations) - new_count}
     
-    def enrich_data(self, raw_data: Dict) -> Dict:
-        """Enrich raw data with calculated fields and metadata"""
-        enriched = raw_data.copy()
+    def store_observations(self, raw_data: Dict, station_cache: Optional[StationCache] = None) -> Dict:
+        """Upsert each observation of a batch once, keyed by (station_id, timestamp).
+        With a fan-out cycle's station cache, a station's observations that another location of the cycle
+        already stored are only referenced. Returns the ids of the batch's observations with the counts."""
+        records = []
+        for feature in raw_data.get('observations', []) + raw_data.get('historical_observations', []):
+            record = self._observation_record(feature, raw_data)
+            if record:
+                records.append(record)
+        stats = {'new_observations': 0, 'existing_observations': 0, 'shared_observations': 0,
+                 'observation_ids': [record['observation_id'] for record in records]}
         
+        if station_cache is None:
+            stats.update(self._upsert_observations(records))
+            return stats
+        by_station: Dict[str, List[Dict]] = {}
+        for record in records:
+            by_station.setdefault(record['station_id'], []).append(record)
+        for station_id, station_records in by_station.items():
+            station_stats, stored = station_cache.store_once(
+                station_id, [record['observation_id'] for record in station_records],
+                lambda: self._upsert_observations(station_records)
+            )
+            if stored:
+                stats['new_observations'] += station_stats['new_observations']
+                stats['existing_observations'] += station_stats['existing_observations']
+            else:
+                stats['shared_observations'] += len(station_records)
+        return stats
+    
+    @staticmethod
+    def _converted_values(props: Dict) -> tuple:
+        """Temperature (C), hourly precipitation (mm) and humidity (%) with the pipeline's unit conversions"""
+        temp = measurement(props, 'temperature')
+        precip = measurement(props, 'precipitationLastHour')
+        temp_c = temp - 273.15 if temp is not None and temp > 100 else temp  # Kelvin to Celsius
+        precip_mm = precip * 1000 if precip is not None and precip < 1 else precip  # Meters to millimeters
+        return temp_c, precip_mm, measurement(props, 'relativeHumidity')
+    
+    def update_running_aggregates(self, records: List[Dict]) -> int:
+        """Fold newly stored observations into per-day running aggregates with atomic $inc/$min/$max upserts.
+        Each day gets one document per station plus one across all stations (station_id "*")."""
+        updates = {}
+        for record in records:
+            temp_c, precip_mm, humidity = self._converted_values(record['properties'])
+            date = record['timestamp'].strftime('%Y-%m-%d')
+            hour = record['timestamp'].strftime('%H')
+            for station_id in (record['station_id'], '*'):
+                update = updates.setdefault((date, station_id), {
+                    '$inc': {'observation_count': 0, 'temperature_sum': 0.0, 'temperature_count': 0,
+                             'humidity_sum': 0.0, 'humidity_count': 0},
+                    '$min': {},
+                    '$max': {}
+                })
+                update['$inc']['observation_count'] += 1
+                update['$max']['latest_obs_time'] = max(record['timestamp'], update['$max'].get('latest_obs_time', record['timestamp']))
+                if temp_c is not None:
+                    update['$inc']['temperature_sum'] += temp_c
+                    update['$inc']['temperature_count'] += 1
+                    update['$min']['min_temperature_c'] = min(temp_c, update['$min'].get('min_temperature_c', temp_c))
+                    update['$max']['max_temperature_c'] = max(temp_c, update['$max'].get('max_temperature_c', temp_c))
+                if humidity is not None:
+                    update['$inc']['humidity_sum'] += humidity
+                    update['$inc']['humidity_count'] += 1
+                if precip_mm is not None:
+                    # Max per hour, same as the warehouse, so hourly reports are not double-counted
+                    key = f'rainfall_by_hour.{hour}'
+                    update['$max'][key] = max(precip_mm, update['$max'].get(key, precip_mm))
+        
+        if not updates:
+            return 0
+        operations = []
+        for (date, station_id), update in updates.items():
+            update = {op: fields for op, fields in update.items() if fields}
+            update['$set'] = {'updated_at_utc': datetime.utcnow()}
+            operations.append(UpdateOne({'date': date, 'station_id': station_id}, update, upsert=True))
+        self.running_aggregates_collection.bulk_write(operations, ordered=False)
+        return len(operations)
+    
+    def get_daily_stats(self, date: Optional[str] = None, station_id: str = '*') -> Optional[Dict]:
+        """Read a day's running statistics (today in UTC by default) from its single aggregate document"""
+        date = date or datetime.utcnow().strftime('%Y-%m-%d')
+        doc = self.running_aggregates_collection.find_one({'date': date, 'station_id': station_id}, {'_id': 0})
+        if not doc:
+            return None
+        rainfall_by_hour = doc.get('rainfall_by_hour', {})
+        return {
+            'date': date,
+            'station_id': station_id,
+            'observation_count': doc.get('observation_count', 0),
+            'avg_temperature_c': doc['temperature_sum'] / doc['temperature_count'] if doc.get('temperature_count') else None,
+            'min_temperature_c': doc.get('min_temperature_c'),
+            'max_temperature_c': doc.get('max_temperature_c'),
+            'total_rainfall_mm': sum(rainfall_by_hour.values()) if rainfall_by_hour else None,
+            'avg_humidity_percent': doc['humidity_sum'] / doc['humidity_count'] if doc.get('humidity_count') else None,
+            'latest_obs_time': doc.get('latest_obs_time'),
+            'updated_at_utc': doc.get('updated_at_utc')
+        }
+    
+    def iter_observations(self, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                          station_id: Optional[str] = None):
+        """Cursor over stored observations in [start, end) (either bound optional), optionally for one station,
+        oldest first; served by the timestamp indexes"""
+        query = {}
+        if start or end:
+            query['timestamp'] = {**({'$gte': start} if start else {}), **({'$lt': end} if end else {})}
+        if station_id:
+            query['station_id'] = station_id
+        return self.observations_collection.find(query, {'_id': 0}).sort('timestamp', ASCENDING)
+    
+    def iter_observations_stored_since(self, since: datetime):
+        """Cursor over observations first stored at or after since; served by the first_seen_utc index"""
+        return self.observations_collection.find({'first_seen_utc': {'$gte': since}}, {'_id': 0})
+    
+    def get_observations(self, start: datetime, end: datetime, station_id: Optional[str] = None) -> List[Dict]:
+        """Get stored observations in [start, end), optionally for one station, oldest first"""
+        return list(self.iter_observations(start, end, station_id))
+    
+    def get_observations_by_id(self, observation_ids: List[str]) -> List[Dict]:
+        """Get the stored observations with the given ids (unknown ids are skipped)"""
+        if not observation_ids:
+            return []
+        return list(self.observations_collection.find({'observation_id': {'$in': list(observation_ids)}}, {'_id': 0}))
+    
+    def stored_observation_ids(self, observation_ids: List[str]) -> set:
+        """Which of the given observation ids the observation collection holds"""
+        return {doc['observation_id'] for doc in self.observations_collection.find(
+            {'observation_id': {'$in': list(observation_ids)}}, {'observation_id': 1}
+        )}
+    
+    def resolve_observations(self, raw_doc: Dict) -> Dict:
+        """Return the raw batch with its referenced observations inlined as an observations array"""
+        if 'observation_ids' not in raw_doc:
+            return raw_doc
+        resolved = {k: v for k, v in raw_doc.items() if k != 'observation_ids'}
+        resolved['observations'] = [
+            dict(doc['properties'], station_id=doc['station_id'])
+            for doc in self.get_observations_by_id(raw_doc['observation_ids'])
+        ]
+        resolved['historical_observations'] = []
+        return resolved
+    
+    def calculate_metrics(self, raw_data: Dict) -> Dict:
+        """Calculate batch metrics in Python from the observation and forecast arrays"""
         # Extract metrics from NWS API observations
         observations = raw_data.get('observations', []) + raw_data.get('historical_observations', [])
         
@@ -32,24 +262,12 @@ class MongoDBETL:
         
         # Extract from NWS observations
         for obs in observations:
-            props = obs.get('properties', {})
-            
-            # Temperature (convert from Kelvin to Celsius if needed)
-            temp = props.get('temperature', {}).get('value')
-            if temp is not None:
-                # Convert from Kelvin to Celsius (NWS uses Kelvin)
-                temp_c = temp - 273.15 if temp > 100 else temp
+            # Temperature from Kelvin to Celsius and precipitation from meters to mm where needed
+            temp_c, precip_mm, rel_humidity = self._converted_values(observation_properties(obs))
+            if temp_c is not None:
                 temperatures.append(temp_c)
-            
-            # Precipitation (convert from meters to mm)
-            precip = props.get('precipitationLastHour', {}).get('value')
-            if precip is not None:
-                # Convert from meters to millimeters
-                precip_mm = precip * 1000 if precip < 1 else precip
+            if precip_mm is not None:
                 rainfall.append(precip_mm)
-            
-            # Humidity
-            rel_humidity = props.get('relativeHumidity', {}).get('value')
             if rel_humidity is not None:
                 humidity.append(rel_humidity)
         
@@ -65,7 +283,7 @@ class MongoDBETL:
                     temperatures.append(temp_c)
         
         # Calculate averages
-        enriched['calculated_metrics'] = {
+        return {
             'avg_temperature_c': sum(temperatures) / len(temperatures) if temperatures else None,
             'total_rainfall_mm': sum(rainfall) if rainfall else None,
             'avg_rainfall_mm': sum(rainfall) / len(rainfall) if rainfall else None,
@@ -75,6 +293,22 @@ class MongoDBETL:
             'rainfall_count': len(rainfall),
             'humidity_count': len(humidity)
         }
+    
+    def enrich_data(self, raw_data: Dict, calculated_metrics: Optional[Dict] = None) -> Dict:
+        """Enrich raw data with calculated fields and metadata.
+        The payloads stay with the raw document and the observation store; the enriched document only references them.
+        calculated_metrics can be passed in when they were computed server-side."""
+        enriched = {
+            'raw_doc_id': raw_data.get('_id'),
+            'source_timestamp': raw_data.get('source_timestamp'),
+            'source_database': raw_data.get('source_database'),
+            'api_request_id': raw_data.get('api_request_id'),
+            'etl_batch_id': raw_data.get('etl_batch_id'),
+            'location': raw_data.get('location'),
+            'observation_stations': raw_data.get('observation_stations')
+        }
+        
+        enriched['calculated_metrics'] = calculated_metrics or self.calculate_metrics(raw_data)
         
         # Add enrichment metadata
         enriched['ingest_time_utc'] = datetime.utcnow().isoformat() + "Z"
@@ -92,16 +326,310 @@ class MongoDBETL:
         
         return enriched
     
-    def sync_from_api(self, sync_type: str = "full") -> Optional[str]:
-        """Fetch data from API and store in MongoDB"""
-        etl_batch_id = f"batch_{int(datetime.utcnow().timestamp() * 1000)}"
+    @staticmethod
+    def _measurement_expr(props: str, field: str) -> Dict:
+        """Aggregation expression for a measurement stored as {'value': v} or flat; non-numbers become null"""
+        return {'$let': {
+            'vars': {'v': {'$ifNull': [f'{props}.{field}.value', f'{props}.{field}']}},
+            'in': {'$cond': [{'$isNumber': '$$v'}, '$$v', None]}
+        }}
+    
+    def _converted_measurements_stage(self, props: str) -> Dict:
+        """$addFields stage applying the same unit conversions as calculate_metrics"""
+        return {'$addFields': {
+            'temp_raw': self._measurement_expr(props, 'temperature'),
+            'precip_raw': self._measurement_expr(props, 'precipitationLastHour'),
+            'humidity': self._measurement_expr(props, 'relativeHumidity')
+        }}
+    
+    def _conversion_fields(self) -> Dict:
+        # Kelvin to Celsius when the value looks like Kelvin; meters to millimeters below 1
+        return {
+            'temp_c': {'$cond': [{'$gt': ['$temp_raw', 100]}, {'$subtract': ['$temp_raw', 273.15]}, '$temp_raw']},
+            'precip_mm': {'$cond': [
+                {'$and': [{'$isNumber': '$precip_raw'}, {'$lt': ['$precip_raw', 1]}]},
+                {'$multiply': ['$precip_raw', 1000]}, '$precip_raw'
+            ]}
+        }
+    
+    def _measurement_group_fields(self) -> Dict:
+        return {
+            'temp_sum': {'$sum': '$temp_c'},
+            'temp_count': {'$sum': {'$cond': [{'$isNumber': '$temp_c'}, 1, 0]}},
+            'temp_min': {'$min': '$temp_c'},
+            'temp_max': {'$max': '$temp_c'},
+            'rain_sum': {'$sum': '$precip_mm'},
+            'rain_count': {'$sum': {'$cond': [{'$isNumber': '$precip_mm'}, 1, 0]}},
+            'humidity_avg': {'$avg': '$humidity'},
+            'humidity_count': {'$sum': {'$cond': [{'$isNumber': '$humidity'}, 1, 0]}}
+        }
+    
+    def calculate_metrics_aggregation(self, raw_doc_id) -> Optional[Dict]:
+        """Calculate the same metrics as calculate_metrics with an aggregation pipeline on the raw document"""
+        pipeline = [
+            {'$match': {'_id': raw_doc_id}},
+            # Content-addressed batches keep the forecast in the blob store
+            {'$lookup': {
+                'from': config.MONGODB_COLLECTION_BLOBS,
+                'localField': 'forecast_ref.hash',
+                'foreignField': '_id',
+                'as': 'forecast_blob'
+            }},
+            {'$addFields': {'forecast': {'$ifNull': ['$forecast', {'$arrayElemAt': ['$forecast_blob.payload', 0]}]}}},
+            # Current batches reference their observations; older ones embed the arrays
+            {'$lookup': {
+                'from': config.MONGODB_COLLECTION_OBSERVATIONS,
+                'localField': 'observation_ids',
+                'foreignField': 'observation_id',
+                'as': 'referenced_observations'
+            }},
+            {'$project': {
+                'obs': {'$concatArrays': [
+                    {'$ifNull': ['$observations', []]},
+                    {'$ifNull': ['$historical_observations', []]},
+                    '$referenced_observations'
+                ]},
+                # First 7 forecast periods, Fahrenheit to Celsius
+                'forecast_temps': {'$map': {
+                    'input': {'$filter': {
+                        'input': {'$slice': [{'$ifNull': ['$forecast.properties.periods', []]}, 7]},
+                        'as': 'p',
+                        'cond': {'$isNumber': '$$p.temperature'}
+                    }},
+                    'as': 'p',
+                    'in': {'$multiply': [{'$subtract': ['$$p.temperature', 32]}, 5 / 9]}
+                }}
+            }},
+            {'$unwind': {'path': '$obs', 'preserveNullAndEmptyArrays': True}},
+            {'$addFields': {'props': {'$ifNull': ['$obs.properties', '$obs']}}},
+            self._converted_measurements_stage('$props'),
+            {'$addFields': self._conversion_fields()},
+            {'$group': {
+                '_id': None,
+                'observation_count': {'$sum': {'$cond': [{'$ifNull': ['$obs', False]}, 1, 0]}},
+                'forecast_temps': {'$first': '$forecast_temps'},
+                **self._measurement_group_fields()
+            }},
+            {'$project': {
+                '_id': 0,
+                'observation_count': 1,
+                'temperature_count': {'$add': ['$temp_count', {'$size': '$forecast_temps'}]},
+                'temperature_sum': {'$add': ['$temp_sum', {'$sum': '$forecast_temps'}]},
+                'rainfall_count': '$rain_count',
+                'total_rainfall_mm': {'$cond': [{'$gt': ['$rain_count', 0]}, '$rain_sum', None]},
+                'avg_rainfall_mm': {'$cond': [{'$gt': ['$rain_count', 0]}, {'$divide': ['$rain_sum', '$rain_count']}, None]},
+                'avg_humidity_percent': '$humidity_avg',
+                'humidity_count': 1
+            }},
+            {'$addFields': {
+                'avg_temperature_c': {'$cond': [
+                    {'$gt': ['$temperature_count', 0]},
+                    {'$divide': ['$temperature_sum', '$temperature_count']}, None
+                ]}
+            }},
+            {'$project': {'temperature_sum': 0}}
+        ]
+        results = list(self.raw_collection.aggregate(pipeline))
+        if not results:
+            return None
+        metrics = results[0]
+        return {
+            'avg_temperature_c': metrics['avg_temperature_c'],
+            'total_rainfall_mm': metrics['total_rainfall_mm'],
+            'avg_rainfall_mm': metrics['avg_rainfall_mm'],
+            'avg_humidity_percent': metrics['avg_humidity_percent'],
+            'observation_count': metrics['observation_count'],
+            'temperature_count': metrics['temperature_count'],
+            'rainfall_count': metrics['rainfall_count'],
+            'humidity_count': metrics['humidity_count']
+        }
+    
+    def compute_window_metrics(self, start: datetime, end: datetime, station_id: Optional[str] = None,
+                               bucket: str = "day") -> List[Dict]:
+        """Recompute metrics over an arbitrary time window across all batches, inside MongoDB.
+        Buckets are "hour", "day", "month" or "all"; reads the deduplicated observations collection."""
+        match = {'timestamp': {'$gte': start, '$lt': end}}
+        if station_id:
+            match['station_id'] = station_id
+        formats = {'hour': '%Y-%m-%dT%H:00', 'day': '%Y-%m-%d', 'month': '%Y-%m'}
+        bucket_expr = {'$dateToString': {'format': formats[bucket], 'date': '$timestamp'}} if bucket in formats else None
         
-        print(f"Fetching weather data from NWS API (batch: {etl_batch_id})...")
-        raw_data = self.api_fetcher.fetch_stockton_weather_data(etl_batch_id)
+        pipeline = [
+            {'$match': match},
+            self._converted_measurements_stage('$properties'),
+            {'$addFields': self._conversion_fields()},
+            {'$group': {
+                '_id': bucket_expr,
+                'observation_count': {'$sum': 1},
+                'stations': {'$addToSet': '$station_id'},
+                **self._measurement_group_fields()
+            }},
+            {'$sort': {'_id': 1}},
+            {'$project': {
+                '_id': 0,
+                'period': '$_id',
+                'observation_count': 1,
+                'station_count': {'$size': '$stations'},
+                'avg_temperature_c': {'$cond': [{'$gt': ['$temp_count', 0]}, {'$divide': ['$temp_sum', '$temp_count']}, None]},
+                'min_temperature_c': '$temp_min',
+                'max_temperature_c': '$temp_max',
+                'total_rainfall_mm': {'$cond': [{'$gt': ['$rain_count', 0]}, '$rain_sum', None]},
+                'avg_humidity_percent': '$humidity_avg',
+                'temperature_count': '$temp_count',
+                'rainfall_count': '$rain_count',
+                'humidity_count': 1
+            }}
+        ]
+        return list(self.observations_collection.aggregate(pipeline))
+    
+    def compute_rolling_metrics(self, start: datetime, end: datetime, window_hours: int = 24,
+                                station_id: Optional[str] = None) -> List[Dict]:
+        """Per-observation rolling averages over the preceding window_hours, per station ($setWindowFields)"""
+        match = {'timestamp': {'$gte': start - timedelta(hours=window_hours), '$lt': end}}
+        if station_id:
+            match['station_id'] = station_id
+        window = {'range': [-window_hours, 0], 'unit': 'hour'}
         
-        if not raw_data:
-            print("Failed to fetch data from API")
+        pipeline = [
+            {'$match': match},
+            self._converted_measurements_stage('$properties'),
+            {'$addFields': self._conversion_fields()},
+            {'$setWindowFields': {
+                'partitionBy': '$station_id',
+                'sortBy': {'timestamp': 1},
+                'output': {
+                    'rolling_avg_temperature_c': {'$avg': '$temp_c', 'window': window},
+                    'rolling_max_temperature_c': {'$max': '$temp_c', 'window': window},
+                    'rolling_min_temperature_c': {'$min': '$temp_c', 'window': window},
+                    'rolling_rainfall_mm': {'$sum': '$precip_mm', 'window': window},
+                    'rolling_avg_humidity_percent': {'$avg': '$humidity', 'window': window}
+                }
+            }},
+            # The lookback rows were only needed to fill the first windows
+            {'$match': {'timestamp': {'$gte': start}}},
+            {'$project': {
+                '_id': 0,
+                'station_id': 1,
+                'timestamp': 1,
+                'temperature_c': '$temp_c',
+                'rolling_avg_temperature_c': 1,
+                'rolling_max_temperature_c': 1,
+                'rolling_min_temperature_c': 1,
+                'rolling_rainfall_mm': 1,
+                'rolling_avg_humidity_percent': 1
+            }}
+        ]
+        return list(self.observations_collection.aggregate(pipeline))
+    
+    def slim_batch(self, raw_data: Dict) -> Dict:
+        """Project a fetched batch to the slim schema: compact observations and forecasts without geometry"""
+        slim = dict(raw_data)
+        slim['observations'] = [slim_observation(obs) for obs in raw_data.get('observations', [])]
+        slim['historical_observations'] = [slim_observation(obs) for obs in raw_data.get('historical_observations', [])]
+        slim['forecast'] = slim_forecast(raw_data.get('forecast'))
+        slim['hourly_forecast'] = slim_forecast(raw_data.get('hourly_forecast'))
+        slim['data_quality'] = "slim"
+        return slim
+    
+    def _store_cold_payload(self, raw_data: Dict, raw_doc_id) -> None:
+        """Keep the untouched API payload zlib-compressed in the cold storage collection"""
+        payload = json.dumps(raw_data, default=str).encode()
+        compressed = zlib.compress(payload, 6)
+        self.cold_collection.insert_one({
+            'raw_doc_id': raw_doc_id,
+            'etl_batch_id': raw_data.get('etl_batch_id'),
+            'stored_at_utc': datetime.utcnow(),
+            'encoding': 'json+zlib',
+            'original_bytes': len(payload),
+            'compressed_bytes': len(compressed),
+            'payload': Binary(compressed)
+        })
+    
+    def get_cold_payload(self, etl_batch_id: str) -> Optional[Dict]:
+        """Decompress the original API payload of a slim-schema batch"""
+        doc = self.cold_collection.find_one({'etl_batch_id': etl_batch_id})
+        if not doc:
+            return None
+        return json.loads(zlib.decompress(doc['payload']))
+    
+    def _store_blob(self, kind: str, payload: Optional[Dict]) -> Optional[Dict]:
+        """Store a sub-payload once under the SHA-256 of its canonical JSON and return a reference to it.
+        Volatile fields (regenerated on every request) are kept on the reference, not hashed."""
+        if payload is None:
             return None
+        props = payload.get('properties') or {}
+        volatile = {field: props[field] for field in CONTENT_VOLATILE_FIELDS if field in props}
+        stable = dict(payload, properties={k: v for k, v in props.items() if k not in volatile}) if volatile else payload
+        canonical = json.dumps(stable, sort_keys=True, separators=(',', ':'), default=str)
+        digest = hashlib.sha256(canonical.encode()).hexdigest()
+        now = datetime.utcnow()
+        result = self.blobs_collection.update_one(
+            {'_id': digest},
+            {
+                '$setOnInsert': {'kind': kind, 'payload': stable, 'size_bytes': len(canonical), 'first_seen_utc': now},
+                '$set': {'last_seen_utc': now},
+                '$inc': {'ref_count': 1}
+            },
+            upsert=True
+        )
+        return {'hash': digest, 'reused': result.upserted_id is None, **volatile}
+    
+    def resolve_payloads(self, raw_doc: Dict) -> Dict:
+        """Return the raw document with content-addressed forecasts replaced by their payloads"""
+        resolved = raw_doc
+        for kind in CONTENT_ADDRESSED_FIELDS:
+            ref = raw_doc.get(f'{kind}_ref')
+            if not ref or raw_doc.get(kind) is not None:
+                continue
+            blob = self.blobs_collection.find_one({'_id': ref['hash']})
+            if blob is None:
+                continue
+            payload = blob['payload']
+            volatile = {field: ref[field] for field in CONTENT_VOLATILE_FIELDS if field in ref}
+            if volatile:
+                payload = dict(payload, properties={**payload.get('properties', {}), **volatile})
+            if resolved is raw_doc:
+                resolved = dict(raw_doc)
+            resolved[kind] = payload
+        return resolved
+    
+    def blob_dedup_report(self) -> Dict:
+        """How much forecast storage content addressing saves: references vs unique blobs, per kind"""
+        report = {}
+        for row in self.blobs_collection.aggregate([
+            {'$group': {
+                '_id': '$kind',
+                'unique_blobs': {'$sum': 1},
+                'references': {'$sum': '$ref_count'},
+                'stored_bytes': {'$sum': '$size_bytes'},
+                'referenced_bytes': {'$sum': {'$multiply': ['$size_bytes', '$ref_count']}}
+            }}
+        ]):
+            report[row['_id']] = {
+                'unique_blobs': row['unique_blobs'],
+                'references': row['references'],
+                'dedup_ratio': round(row['references'] / row['unique_blobs'], 2) if row['unique_blobs'] else None,
+                'stored_bytes': row['stored_bytes'],
+                'bytes_saved': row['referenced_bytes'] - row['stored_bytes']
+            }
+        for kind, stats in report.items():
+            print(f"{kind}: {stats['references']} references to {stats['unique_blobs']} blobs "
+                  f"(dedup ratio {stats['dedup_ratio']}x, {stats['bytes_saved']} bytes saved)")
+        return report
+    
+    @staticmethod
+    def reference_observations(raw_data: Dict, observation_ids: List[str]) -> Dict:
+        """Raw batch document that references its stored observations instead of embedding them"""
+        stored_doc = {k: v for k, v in raw_data.items() if k not in ('observations', 'historical_observations')}
+        stored_doc['observation_ids'] = observation_ids
+        return stored_doc
+    
+    def _store_batch(self, raw_data: Dict, sync_type: str, station_cache: Optional[StationCache] = None) -> Dict:
+        """Store one fetched batch as raw and enriched documents"""
+        original_payload = None
+        if self.slim_schema:
+            original_payload = raw_data if self.keep_cold_raw else None
+            raw_data = self.slim_batch(raw_data)
         
         # Store raw data with metadata
         raw_data['sync_type'] = sync_type
@@ -111,16 +639,117 @@ class MongoDBETL:
             'data_source': raw_data.get('source_database', 'NWS_API'),
             'sync_type': sync_type
         }
-        raw_doc_id = self.raw_collection.insert_one(raw_data).inserted_id
+        
+        # Observations are stored once in the observation collection, before anything that references them
+        observation_stats = self.store_observations(raw_data, station_cache)
+        print(f"Stored {observation_stats['new_observations']} new observations "
+              f"({observation_stats['existing_observations']} already stored, "
+              f"{observation_stats['shared_observations']} stored for another location this cycle)")
+        stored_doc = self.reference_observations(raw_data, observation_stats.pop('observation_ids'))
+        
+        if self.content_addressed:
+            # Unchanged forecasts become references to an existing blob instead of being rewritten
+            reused = []
+            for kind in CONTENT_ADDRESSED_FIELDS:
+                ref = self._store_blob(kind, stored_doc.pop(kind, None))
+                if ref:
+                    if ref.pop('reused'):
+                        reused.append(kind)
+                    stored_doc[f'{kind}_ref'] = ref
+            if reused:
+                print(f"Reused unchanged payloads: {', '.join(reused)}")
+        raw_doc_id = self.raw_collection.insert_one(stored_doc).inserted_id
+        raw_data['_id'] = raw_doc_id
         print(f"Stored raw data with ID: {raw_doc_id}")
+        if original_payload is not None:
+            self._store_cold_payload(original_payload, raw_doc_id)
         
         # Enrich and store enriched data
-        enriched_data = self.enrich_data(raw_data)
+        calculated_metrics = None
+        if self.enrich_mode == "aggregation":
+            calculated_metrics = self.calculate_metrics_aggregation(raw_doc_id)
+        enriched_data = self.enrich_data(raw_data, calculated_metrics)
         enriched_doc_id = self.enriched_collection.insert_one(enriched_data).inserted_id
         print(f"Stored enriched data with ID: {enriched_doc_id}")
         
+        return {'raw_doc_id': raw_doc_id, 'enriched_doc_id': enriched_doc_id, **observation_stats}
+    
+    def sync_from_api(self, sync_type: str = "full") -> Optional[str]:
+        """Fetch data from API and store in MongoDB"""
+        etl_batch_id = f"batch_{int(datetime.utcnow().timestamp() * 1000)}"
+        
+        print(f"Fetching weather data from NWS API (batch: {etl_batch_id})...")
+        raw_data = self.api_fetcher.fetch_stockton_weather_data(etl_batch_id)
+        
+        if not raw_data:
+            print("Failed to fetch data from API")
+            return None
+        
+        self._store_batch(raw_data, sync_type)
+        if self.content_addressed:
+            self.blob_dedup_report()
         return etl_batch_id
     
+    def sync_locations(self, sync_type: str = "partial", locations: Optional[List[Dict]] = None,
+                       max_workers: Optional[int] = None) -> Dict:
+        """Fan out fetches over every registered location, storing one batch per location"""
+        locations = locations if locations is not None else LocationRegistry(mongodb_db=self.db).get_locations()
+        max_workers = max_workers or config.FANOUT_MAX_WORKERS
+        cycle_id = int(datetime.utcnow().timestamp() * 1000)
+        
+        # Workers share the fetcher's session and rate limiter, plus one station cache for this cycle:
+        # a station near several locations is fetched once and its observations are stored once
+        station_cache = StationCache()
+        
+        def ingest(location: Dict) -> Dict:
+            etl_batch_id = f"batch_{cycle_id}_{location['location_id']}"
+            raw_data = self.api_fetcher.fetch_location_weather_data(location, etl_batch_id, station_cache)
+            if not raw_data:
+                raise RuntimeError(f"No data returned for {location['location_id']}")
+            self._store_batch(raw_data, sync_type, station_cache)
+            return {
+                'etl_batch_id': etl_batch_id,
+                'observations': len(raw_data['observations']) + len(raw_data['historical_observations'])
+            }
+        
+        print(f"Fanning out over {len(locations)} locations with {max_workers} workers...")
+        started = time.monotonic()
+        batch_ids = []
+        failed = []
+        observation_count = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(ingest, location): location for location in locations}
+            for future in as_completed(futures):
+                location = futures[future]
+                try:
+                    result = future.result()
+                    batch_ids.append(result['etl_batch_id'])
+                    observation_count += result['observations']
+                except Exception as e:
+                    print(f"Error ingesting {location['location_id']}: {e}")
+                    failed.append(location['location_id'])
+        elapsed = time.monotonic() - started
+        
+        report = {
+            'locations_total': len(locations),
+            'locations_succeeded': len(batch_ids),
+            'locations_failed': failed,
+            'observations_fetched': observation_count,
+            'station_fetches': station_cache.misses,
+            'station_fetches_shared': station_cache.hits,
+            'observations_shared': station_cache.observations_shared,
+            'elapsed_sec': round(elapsed, 2),
+            'locations_per_min': round(len(batch_ids) / elapsed * 60, 2) if elapsed > 0 else None,
+            'observations_per_sec': round(observation_count / elapsed, 2) if elapsed > 0 else None,
+            'etl_batch_ids': batch_ids
+        }
+        print(f"Fan-out cycle done: {len(batch_ids)}/{len(locations)} locations in {report['elapsed_sec']}s "
+              f"({report['locations_per_min']} locations/min, {report['observations_per_sec']} obs/s, "
+              f"{station_cache.hits} station fetches and {station_cache.observations_shared} observations shared)")
+        if self.content_addressed:
+            report['blob_dedup'] = self.blob_dedup_report()
+        return report
+    
     def get_latest_enriched_data(self) -> Optional[Dict]:
         """Get the most recent enriched data document"""
         return self.enriched_collection.find_one(
@@ -130,4 +759,31 @@ class MongoDBETL:
     def get_all_enriched_data(self) -> list:
         """Get all enriched data documents"""
         return list(self.enriched_collection.find())
+    
+    def get_all_raw_data(self, resolve: bool = False) -> list:
+        """Get all raw batch documents. Observations are referenced by id (see get_observations_by_id);
+        resolve=True fills in content-addressed forecasts from the blob store."""
+        docs = list(self.raw_collection.find())
+        return [self.resolve_payloads(doc) for doc in docs] if resolve else docs
+    
+    def get_location_stations(self, since: Optional[datetime] = None, location_ids: Optional[List[str]] = None) -> List[tuple]:
+        """(location_id, station_id) pairs of the registered locations, from the stations their batches
+        (optionally only those ingested since the given time) reported. Nearby locations can share a station."""
+        if location_ids is None:
+            location_ids = [location['location_id'] for location in LocationRegistry(mongodb_db=self.db).get_locations()]
+        match = {'location.location_id': {'$in': location_ids}, 'observation_stations': {'$type': 'array'}}
+        if since:
+            match['ingest_time_utc'] = {'$gte': since.isoformat() + "Z"}
+        return [
+            (row['_id']['location_id'], row['_id']['station_id'])
+            for row in self.enriched_collection.aggregate([
+                {'$match': match},
+                {'$unwind': '$observation_stations'},
+                {'$group': {'_id': {'location_id': '$location.location_id', 'station_id': '$observation_stations'}}}
+            ])
+        ]
+    
+    def get_legacy_daily_aggregates(self) -> list:
+        """Get enriched documents in the legacy daily aggregate format (date/max_temp_c)"""
+        return list(self.enriched_collection.find({'date': {'$exists': True}, 'max_temp_c': {'$exists': True}}))
 
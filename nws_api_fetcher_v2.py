@@ -3,26 +3,233 @@ NWS API Fetcher - Official National Weather Service API
 Uses the official NWS API from https://api.weather.gov
 """
 import requests
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Callable, Dict, Iterator, List, Optional
+from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
 import config
+from nws_replay import create_session
 
-class NWSAPIFetcher:
+try:
+    import ijson  # Optional: only needed for streaming decode
+except ImportError:
+    ijson = None
+
+# Observation properties the pipeline actually reads; streaming decode drops everything else
+MEASUREMENT_FIELDS = (
+    "temperature", "precipitationLastHour", "relativeHumidity", "windSpeed", "seaLevelPressure"
+)
+OBSERVATION_FIELDS = ("timestamp", "station") + MEASUREMENT_FIELDS
+
+# Hourly/7-day forecast period fields kept by the slim schema
+FORECAST_PERIOD_FIELDS = (
+    "number", "name", "startTime", "endTime", "isDaytime", "temperature", "temperatureUnit",
+    "probabilityOfPrecipitation", "relativeHumidity", "windSpeed", "windDirection", "shortForecast"
+)
+
+def observation_properties(obs: Dict) -> Dict:
+    """Properties of an NWS feature, or the flat record itself for slim-schema observations"""
+    return obs.get('properties', obs)
+
+def measurement(props: Dict, field: str):
+    """Value of a measurement stored either as {'value': v} (NWS GeoJSON) or flat (slim schema)"""
+    value = props.get(field)
+    return value.get('value') if isinstance(value, dict) else value
+
+def observation_key(obs: Dict) -> tuple:
+    """Identity of an observation: (station, timestamp)"""
+    props = observation_properties(obs)
+    station_id = obs.get('station_id') or props.get('station_id') or (props.get('station') or '').split('/')[-1]
+    return (station_id, props.get('timestamp'))
+
+def observation_id(station_id: str, timestamp: datetime) -> str:
+    """Stable id of an observation, shared by the MongoDB observation store and the warehouse"""
+    return f"{station_id}_{int(timestamp.timestamp())}"
+
+def dedupe_observations(*observation_sets: List[Dict]) -> tuple:
+    """Drop repeats of the same (station, timestamp) within and across sets, keeping the first occurrence.
+    Returns the deduplicated sets in order, followed by the number of observations removed."""
+    seen = set()
+    deduped_sets = []
+    removed = 0
+    for observation_set in observation_sets:
+        kept = []
+        for obs in observation_set:
+            key = observation_key(obs)
+            if key in seen:
+                removed += 1
+                continue
+            seen.add(key)
+            kept.append(obs)
+        deduped_sets.append(kept)
+    return (*deduped_sets, removed)
+
+def slim_observation(obs: Dict) -> Dict:
+    """Compact observation record: station, timestamp and the raw measurement values (NWS units)"""
+    props = observation_properties(obs)
+    station_id = obs.get('station_id') or props.get('station_id') or (props.get('station') or '').split('/')[-1]
+    record = {'station_id': station_id or None, 'timestamp': props.get('timestamp')}
+    for field in MEASUREMENT_FIELDS:
+        record[field] = measurement(props, field)
+    return record
+
+def slim_forecast(forecast: Optional[Dict]) -> Optional[Dict]:
+    """Forecast without geometry, keeping only the timing fields and the periods' used fields"""
+    if not forecast:
+        return forecast
+    props = forecast.get('properties', {})
+    return {
+        'properties': {
+            'updateTime': props.get('updateTime'),
+            'generatedAt': props.get('generatedAt'),
+            'periods': [
+                {field: period.get(field) for field in FORECAST_PERIOD_FIELDS}
+                for period in props.get('periods', [])
+            ]
+        }
+    }
+
+class RateLimiter:
+    """Thread-safe limiter that spaces requests evenly; one instance can be shared by many fetchers"""
+    def __init__(self, max_per_second: float):
+        self.interval = 1.0 / max_per_second if max_per_second > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+    
+    def wait(self):
+        """Block until the caller may issue its next request"""
+        with self._lock:
+            slot = max(self._next_slot, time.monotonic())
+            self._next_slot = slot + self.interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+class StationCache:
+    """Per-cycle cache so stations shared by nearby grid points are only fetched and stored once"""
     def __init__(self):
-        self.base_url = "https://api.weather.gov"
+        self._lock = threading.Lock()
+        self._futures: Dict[tuple, Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.observations_shared = 0
+    
+    def _run_once(self, key: tuple, loader: Callable) -> tuple:
+        """(result of loader for key, whether this caller ran it); concurrent callers wait for the first"""
+        with self._lock:
+            future = self._futures.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._futures[key] = future
+        if is_owner:
+            try:
+                future.set_result(loader())
+            except Exception as e:
+                future.set_exception(e)
+        return future.result(), is_owner
+    
+    def get_or_fetch(self, key: tuple, loader: Callable):
+        """Return the cached result for key, running loader once even under concurrent callers"""
+        result, fetched = self._run_once(key, loader)
+        with self._lock:
+            if fetched:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+    
+    def store_once(self, station_id: str, observation_ids: List[str], store: Callable) -> tuple:
+        """Run store once per cycle for a station's set of observations; a location sharing the station
+        waits until the first one has stored them. Returns (store's result, whether this caller stored)."""
+        result, stored = self._run_once(("stored", station_id, frozenset(observation_ids)), store)
+        if not stored:
+            with self._lock:
+                self.observations_shared += len(observation_ids)
+        return result, stored
+
+class NWSAPIFetcher:
+    def __init__(self, rate_limiter: Optional[RateLimiter] = None, session: Optional[requests.Session] = None):
+        self.base_url = config.NWS_API_BASE.rstrip('/')
         self.headers = {
-            "User-Agent": "StocktonWeatherPipeline/1.0 (contact@example.com)",
+            "User-Agent": config.NWS_USER_AGENT,
             "Accept": "application/geo+json"
         }
         self.stockton_lat = config.STOCKTON_LAT
         self.stockton_lon = config.STOCKTON_LON
+        # Live session by default; NWS_TRANSPORT=record/replay swaps in the fixture transport
+        self.session = session or create_session()
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=config.FANOUT_MAX_WORKERS))
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=config.FANOUT_MAX_WORKERS))
+        self.rate_limiter = rate_limiter or RateLimiter(config.NWS_MAX_REQUESTS_PER_SEC)
+        self.page_limit_min = config.NWS_PAGE_LIMIT_MIN
+        self.page_limit_max = config.NWS_PAGE_LIMIT_MAX
+        self.streaming_decode = config.NWS_STREAMING_DECODE
+        if self.streaming_decode and ijson is None:
+            print("Warning: NWS_STREAMING_DECODE needs the ijson package, falling back to response.json()")
+            self.streaming_decode = False
+    
+    def _get(self, url: str, params: Optional[Dict] = None, timeout: int = 10,
+             stream: bool = False) -> requests.Response:
+        """Issue a GET through the shared session, respecting the rate limiter"""
+        self.rate_limiter.wait()
+        return self.session.get(url, headers=self.headers, params=params, timeout=timeout, stream=stream)
+    
+    def _stream_features(self, response: requests.Response, page: Dict) -> Iterator[Dict]:
+        """Incrementally parse a FeatureCollection, yielding features cut down to OBSERVATION_FIELDS"""
+        response.raw.decode_content = True
+        feature = None
+        for prefix, event, value in ijson.parse(response.raw, use_float=True):
+            if prefix == 'features.item':
+                if event == 'start_map':
+                    feature = {'properties': {}}
+                elif event == 'end_map':
+                    yield feature
+                    feature = None
+            elif feature is not None and prefix.startswith('features.item.properties.'):
+                if event in ('start_map', 'end_map', 'start_array', 'end_array', 'map_key'):
+                    continue
+                field, _, rest = prefix[len('features.item.properties.'):].partition('.')
+                if field not in OBSERVATION_FIELDS:
+                    continue
+                if not rest:
+                    feature['properties'][field] = value
+                elif rest == 'value':
+                    feature['properties'][field] = {'value': value}
+            elif prefix == 'pagination.next' and event == 'string':
+                page['next'] = value
+    
+    def _decode_features(self, response: requests.Response, page: Dict) -> Iterator[Dict]:
+        """Yield the features of an observations response; page receives the pagination.next link"""
+        try:
+            if self.streaming_decode:
+                yield from self._stream_features(response, page)
+            else:
+                data = response.json()
+                page['next'] = (data.get('pagination') or {}).get('next')
+                yield from data.get('features', [])
+        finally:
+            response.close()
+    
+    def default_location(self) -> Dict:
+        """The single city the pipeline ingests when no location registry is used"""
+        return {
+            "location_id": "stockton_ca",
+            "city": "Stockton",
+            "state": "CA",
+            "latitude": self.stockton_lat,
+            "longitude": self.stockton_lon
+        }
         
-    def get_grid_point(self) -> Optional[Dict]:
-        """Get grid point information for Stockton coordinates"""
-        url = f"{self.base_url}/points/{self.stockton_lat},{self.stockton_lon}"
+    def get_grid_point(self, latitude: Optional[float] = None, longitude: Optional[float] = None) -> Optional[Dict]:
+        """Get grid point information for the given coordinates (Stockton by default)"""
+        latitude = self.stockton_lat if latitude is None else latitude
+        longitude = self.stockton_lon if longitude is None else longitude
+        url = f"{self.base_url}/points/{latitude},{longitude}"
         try:
-            response = requests.get(url, headers=self.headers, timeout=10)
+            response = self._get(url)
             response.raise_for_status()
             return response.json()
         except Exception as e:
@@ -33,7 +240,7 @@ class NWSAPIFetcher:
         """Get 7-day forecast from grid point"""
         url = f"{self.base_url}/gridpoints/{office}/{grid_x},{grid_y}/forecast"
         try:
-            response = requests.get(url, headers=self.headers, timeout=10)
+            response = self._get(url)
             response.raise_for_status()
             return response.json()
         except Exception as e:
@@ -44,7 +251,7 @@ class NWSAPIFetcher:
         """Get hourly forecast from grid point"""
         url = f"{self.base_url}/gridpoints/{office}/{grid_x},{grid_y}/forecast/hourly"
         try:
-            response = requests.get(url, headers=self.headers, timeout=10)
+            response = self._get(url)
             response.raise_for_status()
             return response.json()
         except Exception as e:
@@ -55,7 +262,7 @@ class NWSAPIFetcher:
         """Get observation stations for the grid point"""
         url = f"{self.base_url}/gridpoints/{office}/{grid_x},{grid_y}/stations"
         try:
-            response = requests.get(url, headers=self.headers, timeout=10)
+            response = self._get(url)
             response.raise_for_status()
             data = response.json()
             return [station['properties']['stationIdentifier'] for station in data.get('features', [])]
@@ -68,51 +275,75 @@ class NWSAPIFetcher:
         url = f"{self.base_url}/stations/{station_id}/observations"
         params = {"limit": limit}
         try:
-            response = requests.get(url, headers=self.headers, params=params, timeout=10)
+            response = self._get(url, params, stream=self.streaming_decode)
             response.raise_for_status()
-            data = response.json()
-            return data.get('features', [])
+            return list(self._decode_features(response, {}))
         except Exception as e:
             print(f"Error fetching observations: {e}")
             return None
     
+    def _initial_page_limit(self, start_date: datetime, end_date: datetime) -> int:
+        """Estimate a page size from the range length (stations report roughly hourly plus specials)"""
+        hours = max((end_date - start_date).total_seconds() / 3600, 1)
+        return int(min(max(hours * 1.5, self.page_limit_min), self.page_limit_max))
+    
+    def _with_limit(self, url: str, limit: int) -> str:
+        """Rewrite the limit query parameter of a pagination URL"""
+        parts = urlsplit(url)
+        query = parse_qs(parts.query)
+        query['limit'] = [str(limit)]
+        return urlunsplit(parts._replace(query=urlencode(query, doseq=True)))
+    
+    def iter_observations(self, station_id: str, start_date: datetime, end_date: datetime,
+                          page_limit: Optional[int] = None) -> Iterator[Dict]:
+        """Yield observations for a station's time range page by page, following pagination cursors"""
+        limit = page_limit or self._initial_page_limit(start_date, end_date)
+        url = f"{self.base_url}/stations/{station_id}/observations"
+        params = {
+            "start": start_date.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "end": end_date.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "limit": limit
+        }
+        visited = set()
+        
+        while url:
+            visited.add(url)
+            response = self._get(url, params, timeout=15, stream=self.streaming_decode)
+            response.raise_for_status()
+            page = {}
+            page_count = 0
+            for feature in self._decode_features(response, page):
+                page_count += 1
+                yield feature
+            
+            next_url = page.get('next')
+            if not page_count or not next_url:
+                break
+            
+            # Grow the page size while pages come back full, shrink it once they thin out
+            if page_count >= limit:
+                limit = min(limit * 2, self.page_limit_max)
+            elif page_count < limit // 2:
+                limit = max(page_count, self.page_limit_min)
+            url = self._with_limit(next_url, limit)
+            params = None
+            if url in visited:
+                break  # Guard against a cursor that does not advance
+    
     def get_historical_observations(self, station_id: str, start_date: datetime, end_date: datetime) -> List[Dict]:
         """Get historical observations (NWS API typically limits to ~7 days)"""
-        observations = []
-        
         # NWS API observations endpoint typically only supports last 7 days
-        # Request in daily chunks
-        current_date = start_date
-        max_days = min((end_date - start_date).days, 7)  # Limit to 7 days
+        start_date = max(start_date, end_date - timedelta(days=7))
+        observations = []
         
-        while current_date <= end_date and (current_date - start_date).days < max_days:
-            day_end = min(current_date + timedelta(days=1), end_date)
-            
-            url = f"{self.base_url}/stations/{station_id}/observations"
-            params = {
-                "start": current_date.strftime("%Y-%m-%dT%H:%M:%SZ"),
-                "end": day_end.strftime("%Y-%m-%dT%H:%M:%SZ"),
-                "limit": 1000
-            }
-            try:
-                response = requests.get(url, headers=self.headers, params=params, timeout=15)
-                response.raise_for_status()
-                data = response.json()
-                chunk_obs = data.get('features', [])
-                observations.extend(chunk_obs)
-                if len(chunk_obs) > 0:
-                    print(f"  Fetched {len(chunk_obs)} observations for {current_date.strftime('%Y-%m-%d')}")
-                time.sleep(0.3)  # Rate limiting
-            except requests.exceptions.HTTPError as e:
-                if e.response.status_code == 400:
-                    pass  # Silently skip unsupported date ranges
-                else:
-                    print(f"  Warning: Could not fetch data for {current_date.strftime('%Y-%m-%d')}: {e}")
-            except Exception as e:
-                if "400" not in str(e):
-                    print(f"  Warning: Could not fetch data for {current_date.strftime('%Y-%m-%d')}: {e}")
-            
-            current_date = day_end
+        try:
+            for feature in self.iter_observations(station_id, start_date, end_date):
+                observations.append(feature)
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code != 400:  # 400 means unsupported date range
+                print(f"  Warning: Could not fetch observations for {station_id}: {e}")
+        except Exception as e:
+            print(f"  Warning: Could not fetch observations for {station_id}: {e}")
         
         if len(observations) > 0:
             print(f"  Total observations fetched: {len(observations)}")
@@ -120,11 +351,50 @@ class NWSAPIFetcher:
     
     def fetch_stockton_weather_data(self, etl_batch_id: str) -> Dict:
         """Main method to fetch all weather data for Stockton with metadata"""
+        return self.fetch_location_weather_data(self.default_location(), etl_batch_id)
+    
+    def _tag_station(self, features: Optional[List[Dict]], station_id: str) -> List[Dict]:
+        """Copy features with a top-level station_id so rows stay attributable per station"""
+        return [dict(feature, station_id=station_id) for feature in features or []]
+    
+    def fetch_stations_parallel(self, station_ids: List[str], start_date: datetime, end_date: datetime,
+                                station_cache: Optional[StationCache] = None) -> tuple:
+        """Fetch latest and historical observations for several stations concurrently"""
+        station_cache = station_cache or StationCache()
+        
+        def fetch_station(station_id: str) -> tuple:
+            latest = station_cache.get_or_fetch(
+                ("latest", station_id),
+                lambda: self.get_station_observations(station_id, limit=100)
+            )
+            history = station_cache.get_or_fetch(
+                ("history", station_id),
+                lambda: self.get_historical_observations(station_id, start_date, end_date)
+            )
+            return self._tag_station(latest, station_id), self._tag_station(history, station_id)
+        
+        print(f"  Fetching observations from {len(station_ids)} stations in parallel: {', '.join(station_ids)}")
+        observations = []
+        historical_obs = []
+        with ThreadPoolExecutor(max_workers=len(station_ids)) as executor:
+            # map() keeps results in station order (nearest first)
+            for station_id, (latest, history) in zip(station_ids, executor.map(fetch_station, station_ids)):
+                observations.extend(latest)
+                historical_obs.extend(history)
+                print(f"  Got {len(latest)} latest and {len(history)} historical observations from {station_id}")
+        return observations, historical_obs
+    
+    def fetch_location_weather_data(self, location: Dict, etl_batch_id: str,
+                                    station_cache: Optional[StationCache] = None,
+                                    station_count: Optional[int] = None) -> Optional[Dict]:
+        """Fetch all weather data for one location; station_cache shares station fetches across locations.
+        station_count > 0 collects the N nearest stations in parallel instead of the first one with data."""
         api_request_id = f"req_{int(time.time() * 1000)}"
         source_timestamp = datetime.utcnow().isoformat() + "Z"
+        station_cache = station_cache or StationCache()
         
-        print("Fetching grid point from NWS API...")
-        grid_point = self.get_grid_point()
+        print(f"Fetching grid point from NWS API for {location['city']}, {location['state']}...")
+        grid_point = self.get_grid_point(location['latitude'], location['longitude'])
         if not grid_point:
             return None
         
@@ -144,29 +414,52 @@ class NWSAPIFetcher:
         print("Fetching observation stations...")
         stations = self.get_stations(office, grid_x, grid_y)
         observations = []
+        historical_obs = []
+        station_count = config.NWS_OBSERVATION_STATIONS if station_count is None else station_count
+        end_date = datetime.utcnow()
+        start_date = end_date - timedelta(days=7)  # NWS typically provides last 7 days
         
         if stations:
             print(f"  Found {len(stations)} stations")
+        
+        if stations and station_count > 0:
+            # Collect every one of the N nearest stations in parallel
+            observations, historical_obs = self.fetch_stations_parallel(
+                stations[:station_count], start_date, end_date, station_cache
+            )
+        elif stations:
             # Get observations from available stations
             for station_id in stations[:3]:  # Try up to 3 stations
                 print(f"  Fetching observations from station {station_id}...")
-                station_obs = self.get_station_observations(station_id, limit=100)
+                station_obs = station_cache.get_or_fetch(
+                    ("latest", station_id),
+                    lambda: self.get_station_observations(station_id, limit=100)
+                )
                 if station_obs:
-                    observations.extend(station_obs)
+                    observations.extend(self._tag_station(station_obs, station_id))
                     print(f"  Got {len(station_obs)} observations from {station_id}")
                     break
-        
-        # Get historical observations (last 7 days - NWS limitation)
-        historical_obs = []
-        if stations:
-            end_date = datetime.utcnow()
-            start_date = end_date - timedelta(days=7)  # NWS typically provides last 7 days
+            
+            # Get historical observations (last 7 days - NWS limitation)
             for station_id in stations[:1]:  # Use first station for historical
                 print(f"  Fetching historical observations (last 7 days) from {station_id}...")
-                hist = self.get_historical_observations(station_id, start_date, end_date)
-                historical_obs.extend(hist)
+                hist = station_cache.get_or_fetch(
+                    ("history", station_id),
+                    lambda: self.get_historical_observations(station_id, start_date, end_date)
+                )
+                historical_obs.extend(self._tag_station(hist, station_id))
                 break
         
+        # Latest and historical sets come from the same stations and overlap heavily;
+        # keep each observation once so it is stored, enriched and parsed only once
+        dedup_stats = None
+        if config.NWS_DEDUPE_OBSERVATIONS:
+            fetched_count = len(observations) + len(historical_obs)
+            observations, historical_obs, removed = dedupe_observations(observations, historical_obs)
+            dedup_stats = {'fetched': fetched_count, 'duplicates_removed': removed}
+            if removed:
+                print(f"  Removed {removed} duplicate observations ({fetched_count} fetched)")
+        
         # Build raw data document
         raw_data = {
             "source_timestamp": source_timestamp,
@@ -175,10 +468,11 @@ class NWSAPIFetcher:
             "api_request_id": api_request_id,
             "etl_batch_id": etl_batch_id,
             "location": {
-                "city": "Stockton",
-                "state": "CA",
-                "latitude": self.stockton_lat,
-                "longitude": self.stockton_lon,
+                "location_id": location.get('location_id'),
+                "city": location['city'],
+                "state": location['state'],
+                "latitude": location['latitude'],
+                "longitude": location['longitude'],
                 "grid_point": {
                     "office": office,
                     "grid_x": grid_x,
@@ -189,8 +483,9 @@ class NWSAPIFetcher:
             "hourly_forecast": hourly_forecast,
             "observations": observations,
             "historical_observations": historical_obs,
-            "stations": stations
+            "stations": stations,
+            "dedup_stats": dedup_stats,
+            "observation_stations": sorted({obs['station_id'] for obs in observations + historical_obs if 'station_id' in obs})
         }
         
         return raw_data
-
@@ -0,0 +1,195 @@
+"""
+NWS Replay - Record/replay HTTP transport for offline benchmarking of the fetcher
+Records real NWS API responses to disk and replays them with simulated latency, errors and scaled payloads
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit
+import requests
+from requests.structures import CaseInsensitiveDict
+import config
+
+# Query parameters whose values change on every run (the history window is derived from utcnow,
+# the page size adapts); only their presence is part of the fixture key
+VOLATILE_PARAMS = {"start", "end", "limit"}
+
+def fixture_key(method: str, url: str, params: Optional[Dict] = None) -> str:
+    """Normalize a request to method + path + stable query parameters, ignoring the host"""
+    prepared_url = requests.Request(method, url, params=params).prepare().url
+    parts = urlsplit(prepared_url)
+    query = sorted((k, "*" if k in VOLATILE_PARAMS else v) for k, v in parse_qsl(parts.query))
+    return f"{method.upper()} {parts.path}?{urlencode(query)}"
+
+def _fixture_path(fixture_dir: str, key: str) -> str:
+    return os.path.join(fixture_dir, hashlib.sha1(key.encode()).hexdigest()[:20] + ".json")
+
+def _build_response(url: str, status_code: int, body: bytes, content_type: str = "application/geo+json") -> requests.Response:
+    """Build a requests.Response that works for both .json() and streamed .raw reads"""
+    response = requests.Response()
+    response.status_code = status_code
+    response.reason = "OK" if status_code < 400 else "Replayed Error"
+    response.url = url
+    response.encoding = "utf-8"
+    response.headers = CaseInsensitiveDict({"Content-Type": content_type, "Content-Length": str(len(body))})
+    response._content = body
+    response.raw = io.BytesIO(body)
+    return response
+
+def _scale_payload(data: Dict, scale: int) -> Dict:
+    """Repeat each observation feature scale times with shifted timestamps so copies stay unique"""
+    features = data.get("features")
+    if scale <= 1 or not features or "timestamp" not in features[0].get("properties", {}):
+        return data
+    scaled = []
+    for feature in features:
+        scaled.append(feature)
+        try:
+            base = datetime.fromisoformat(feature["properties"]["timestamp"].replace("Z", "+00:00"))
+        except (KeyError, ValueError, AttributeError):
+            continue
+        for i in range(1, scale):
+            copy = dict(feature, properties=dict(feature["properties"]))
+            copy["properties"]["timestamp"] = (base - timedelta(minutes=i * 60 / scale)).isoformat()
+            scaled.append(copy)
+    return dict(data, features=scaled)
+
+class RecordingSession(requests.Session):
+    """Session that performs real requests and writes each response to the fixture directory"""
+    def __init__(self, fixture_dir: Optional[str] = None):
+        super().__init__()
+        self.fixture_dir = fixture_dir or config.NWS_FIXTURE_DIR
+        os.makedirs(self.fixture_dir, exist_ok=True)
+        self.recorded = 0
+        self._lock = threading.Lock()
+
+    def request(self, method, url, params=None, **kwargs):
+        kwargs["stream"] = False  # Read the whole body so it can be written and replayed
+        response = super().request(method, url, params=params, **kwargs)
+        key = fixture_key(method, url, params)
+        fixture = {
+            "key": key,
+            "url": response.url,
+            "status_code": response.status_code,
+            "content_type": response.headers.get("Content-Type", "application/geo+json"),
+            "body": response.text
+        }
+        with self._lock:
+            with open(_fixture_path(self.fixture_dir, key), "w") as f:
+                json.dump(fixture, f)
+            self.recorded += 1
+        response.raw = io.BytesIO(response.content)
+        return response
+
+class ReplaySession(requests.Session):
+    """Session that serves recorded fixtures with configurable latency, error injection and payload scaling"""
+    def __init__(self, fixture_dir: Optional[str] = None, latency_ms: Optional[float] = None,
+                 error_rate: Optional[float] = None, error_kind: Optional[str] = None,
+                 scale: Optional[int] = None, seed: Optional[int] = None):
+        super().__init__()
+        self.fixture_dir = fixture_dir or config.NWS_FIXTURE_DIR
+        self.latency_ms = config.NWS_REPLAY_LATENCY_MS if latency_ms is None else latency_ms
+        self.error_rate = config.NWS_REPLAY_ERROR_RATE if error_rate is None else error_rate
+        self.error_kind = error_kind or config.NWS_REPLAY_ERROR_KIND
+        self.scale = config.NWS_REPLAY_SCALE if scale is None else scale
+        self._random = random.Random(config.NWS_REPLAY_SEED if seed is None else seed)
+        self._lock = threading.Lock()
+        self._cache: Dict[str, Dict] = {}
+        self.stats = {"requests": 0, "injected_errors": 0, "missing_fixtures": 0}
+
+    def _load_fixture(self, key: str) -> Optional[Dict]:
+        if key not in self._cache:
+            path = _fixture_path(self.fixture_dir, key)
+            if not os.path.exists(path):
+                return None
+            with open(path) as f:
+                fixture = json.load(f)
+            if fixture.get("body") and fixture.get("status_code", 200) < 400:
+                try:
+                    fixture["body"] = json.dumps(_scale_payload(json.loads(fixture["body"]), self.scale))
+                except ValueError:
+                    pass
+            self._cache[key] = fixture
+        return self._cache[key]
+
+    def request(self, method, url, params=None, **kwargs):
+        key = fixture_key(method, url, params)
+        with self._lock:
+            self.stats["requests"] += 1
+            inject_error = self._random.random() < self.error_rate
+            jitter = self._random.uniform(0.5, 1.5)
+            fixture = self._load_fixture(key)
+
+        if self.latency_ms:
+            time.sleep(self.latency_ms * jitter / 1000)
+
+        if inject_error:
+            with self._lock:
+                self.stats["injected_errors"] += 1
+            if self.error_kind == "timeout":
+                raise requests.exceptions.Timeout(f"Injected timeout for {key}")
+            return _build_response(url, 503, b'{"title": "Injected error"}')
+
+        if fixture is None:
+            with self._lock:
+                self.stats["missing_fixtures"] += 1
+            return _build_response(url, 404, b'{"title": "No recorded fixture"}')
+
+        return _build_response(url, fixture["status_code"], fixture["body"].encode(), fixture["content_type"])
+
+def create_session(mode: Optional[str] = None) -> requests.Session:
+    """Create the HTTP session for the configured transport: live, record or replay"""
+    mode = mode or config.NWS_TRANSPORT
+    if mode == "record":
+        return RecordingSession()
+    if mode == "replay":
+        return ReplaySession()
+    return requests.Session()
+
+def main():
+    from nws_api_fetcher_v2 import NWSAPIFetcher, RateLimiter
+
+    parser = argparse.ArgumentParser(description="Record NWS API fixtures or load-test the fetcher offline")
+    parser.add_argument("command", choices=["record", "bench"])
+    parser.add_argument("--fixture-dir", default=config.NWS_FIXTURE_DIR)
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--latency-ms", type=float, default=config.NWS_REPLAY_LATENCY_MS)
+    parser.add_argument("--error-rate", type=float, default=config.NWS_REPLAY_ERROR_RATE)
+    parser.add_argument("--error-kind", choices=["http", "timeout"], default=config.NWS_REPLAY_ERROR_KIND)
+    parser.add_argument("--scale", type=int, default=config.NWS_REPLAY_SCALE)
+    parser.add_argument("--seed", type=int, default=config.NWS_REPLAY_SEED)
+    args = parser.parse_args()
+
+    if args.command == "record":
+        session = RecordingSession(args.fixture_dir)
+        fetcher = NWSAPIFetcher(session=session)
+        fetcher.fetch_stockton_weather_data("batch_record")
+        print(f"Recorded {session.recorded} responses to {args.fixture_dir}")
+        return
+
+    print(f"Replaying {args.fixture_dir} x{args.iterations} (latency {args.latency_ms}ms, "
+          f"error rate {args.error_rate}, scale x{args.scale})")
+    timings = []
+    for i in range(args.iterations):
+        session = ReplaySession(args.fixture_dir, args.latency_ms, args.error_rate, args.error_kind, args.scale, args.seed + i)
+        fetcher = NWSAPIFetcher(rate_limiter=RateLimiter(0), session=session)
+        started = time.perf_counter()
+        raw_data = fetcher.fetch_stockton_weather_data(f"batch_bench_{i}")
+        elapsed = time.perf_counter() - started
+        timings.append(elapsed)
+        observation_count = len(raw_data["observations"]) + len(raw_data["historical_observations"]) if raw_data else 0
+        print(f"Run {i + 1}: {elapsed:.3f}s, {observation_count} observations, "
+              f"{observation_count / elapsed:.0f} obs/s, stats {session.stats}")
+
+    timings.sort()
+    print(f"min {timings[0]:.3f}s  median {timings[len(timings) // 2]:.3f}s  max {timings[-1]:.3f}s")
+
+if __name__ == '__main__':
+    main()
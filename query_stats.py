@@ -0,0 +1,207 @@
+"""
+Query Stats - Tags pipeline ClickHouse queries with a query ID and stage, records their cost in
+pipeline_query_stats and reports the most expensive stages
+"""
+import argparse
+import functools
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+import config
+
+QUERY_STATS_TABLE = "pipeline_query_stats"
+
+QUERY_STATS_DDL = f"""
+    CREATE TABLE IF NOT EXISTS {QUERY_STATS_TABLE} (
+        event_time DateTime,
+        query_id String,
+        stage LowCardinality(String),
+        root_stage LowCardinality(String),
+        query_kind LowCardinality(String),
+        query_text String CODEC(ZSTD(3)),
+        elapsed_ms Float64,
+        rows_read UInt64,
+        bytes_read UInt64,
+        rows_written UInt64,
+        bytes_written UInt64,
+        result_rows UInt64,
+        exception String
+    ) ENGINE = MergeTree()
+    PARTITION BY toYYYYMM(event_time)
+    ORDER BY (stage, event_time)
+    TTL event_time + INTERVAL {config.CLICKHOUSE_QUERY_STATS_TTL_DAYS} DAY
+"""
+
+# Queries longer than this are truncated in the stats table
+MAX_QUERY_TEXT = 2000
+
+_stages = threading.local()
+
+@contextmanager
+def query_stage(name: str):
+    """Attribute ClickHouse queries issued inside the block (on this thread) to a stage"""
+    stack = _stages.__dict__.setdefault('stack', [])
+    stack.append(name)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+def profiled_stage(func: Callable) -> Callable:
+    """Decorator: queries issued by the function are recorded under its name"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with query_stage(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+def current_stage() -> Tuple[str, str]:
+    """(innermost stage, outermost stage) for the calling thread"""
+    stack = getattr(_stages, 'stack', None)
+    if not stack:
+        return 'adhoc', 'adhoc'
+    return stack[-1], stack[0]
+
+def new_query_id(stage: str) -> str:
+    return f"{stage}-{uuid.uuid4().hex[:16]}"
+
+def _query_kind(query: str) -> str:
+    words = query.lstrip().split(None, 1)
+    return words[0].upper() if words else ''
+
+class QueryStatsRecorder:
+    """Buffers per-query stats and writes them to pipeline_query_stats in batches"""
+    def __init__(self, flush_size: Optional[int] = None, flush_interval_sec: Optional[float] = None):
+        self.flush_size = flush_size or config.CLICKHOUSE_QUERY_STATS_FLUSH_SIZE
+        self.flush_interval_sec = config.CLICKHOUSE_QUERY_STATS_FLUSH_SEC if flush_interval_sec is None else flush_interval_sec
+        self._buffer: List[tuple] = []
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def record(self, query_id: str, stage: str, root_stage: str, query: str, elapsed_sec: float,
+               last_query=None, result_rows: int = 0, exception: str = ''):
+        progress = getattr(last_query, 'progress', None)
+        row = (
+            datetime.utcnow(),
+            query_id,
+            stage,
+            root_stage,
+            _query_kind(query),
+            query.strip()[:MAX_QUERY_TEXT],
+            round(elapsed_sec * 1000, 3),
+            getattr(progress, 'rows', 0) or 0,
+            getattr(progress, 'bytes', 0) or 0,
+            getattr(progress, 'written_rows', 0) or 0,
+            getattr(progress, 'written_bytes', 0) or 0,
+            result_rows,
+            exception
+        )
+        with self._lock:
+            self._buffer.append(row)
+
+    def has_pending(self) -> bool:
+        return bool(self._buffer)
+
+    def should_flush(self) -> bool:
+        return bool(self._buffer) and (len(self._buffer) >= self.flush_size
+                                       or time.monotonic() - self._last_flush >= self.flush_interval_sec)
+
+    def flush(self, execute: Callable):
+        """Write buffered stats with the given execute function (not itself recorded)"""
+        with self._lock:
+            rows, self._buffer = self._buffer, []
+            self._last_flush = time.monotonic()
+        if not rows:
+            return
+        try:
+            execute(f"INSERT INTO {QUERY_STATS_TABLE} VALUES", rows)
+        except Exception as e:
+            print(f"Warning: could not write {len(rows)} query stats rows: {e}")
+
+class QueryStatsReport:
+    def __init__(self, client=None):
+        if client is None:
+            from clickhouse_pool import ClickHousePool
+            client = ClickHousePool(size=1, profile=False)
+        self.client = client
+
+    def top_stages(self, days: int = 7, top: int = 15, order_by: str = 'total_ms') -> List[Dict]:
+        """Stages ranked by total time (or p95, rows read, memory) over the last N days"""
+        # Peak memory is only known server-side, in system.query_log
+        memory_join = f"""
+            LEFT JOIN (
+                SELECT query_id, max(memory_usage) AS memory_usage
+                FROM system.query_log
+                WHERE type = 'QueryFinish' AND event_date >= today() - {int(days)}
+                GROUP BY query_id
+            ) AS log ON stats.query_id = log.query_id
+        """
+        query = """
+            SELECT
+                stats.stage,
+                count() AS calls,
+                sum(stats.elapsed_ms) AS total_ms,
+                quantile(0.5)(stats.elapsed_ms) AS p50_ms,
+                quantile(0.95)(stats.elapsed_ms) AS p95_ms,
+                max(stats.elapsed_ms) AS max_ms,
+                sum(stats.rows_read) AS rows_read,
+                sum(stats.bytes_read) AS bytes_read,
+                countIf(stats.exception != '') AS errors,
+                {memory} AS peak_memory_bytes
+            FROM {table} AS stats
+            {join}
+            WHERE stats.event_time >= now() - INTERVAL {days} DAY
+            GROUP BY stats.stage
+            ORDER BY {order_by} DESC
+            LIMIT {top}
+        """
+        params = dict(table=QUERY_STATS_TABLE, days=int(days), top=int(top), order_by=order_by)
+        try:
+            rows = self.client.execute(query.format(memory="max(log.memory_usage)", join=memory_join, **params))
+        except Exception as e:
+            print(f"Note: peak memory unavailable, system.query_log could not be read ({e})")
+            rows = self.client.execute(query.format(memory="toUInt64(0)", join="", **params))
+        columns = ['stage', 'calls', 'total_ms', 'p50_ms', 'p95_ms', 'max_ms', 'rows_read', 'bytes_read',
+                   'errors', 'peak_memory_bytes']
+        return [dict(zip(columns, row)) for row in rows]
+
+    def stage_trend(self, stage: str, days: int = 30) -> List[Dict]:
+        """Daily latency percentiles for one stage, to spot regressions"""
+        rows = self.client.execute(f"""
+            SELECT toDate(event_time) AS day, count(), quantile(0.5)(elapsed_ms), quantile(0.95)(elapsed_ms), avg(rows_read)
+            FROM {QUERY_STATS_TABLE}
+            WHERE stage = %(stage)s AND event_time >= now() - INTERVAL {int(days)} DAY
+            GROUP BY day
+            ORDER BY day
+        """, {'stage': stage})
+        return [{'day': str(day), 'calls': calls, 'p50_ms': p50, 'p95_ms': p95, 'avg_rows_read': avg_rows}
+                for day, calls, p50, p95, avg_rows in rows]
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the most expensive ClickHouse queries of the pipeline")
+    parser.add_argument("command", choices=["top", "trend"])
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--order-by", choices=["total_ms", "p95_ms", "max_ms", "rows_read", "peak_memory_bytes"],
+                        default="total_ms")
+    parser.add_argument("--stage", help="Stage for the trend report, e.g. get_daily_averages")
+    args = parser.parse_args()
+
+    report = QueryStatsReport()
+    if args.command == "top":
+        print(f"{'stage':32}{'calls':>7}{'total ms':>12}{'p50 ms':>10}{'p95 ms':>10}{'rows read':>14}{'peak mem':>12}{'errors':>8}")
+        for s in report.top_stages(args.days, args.top, args.order_by):
+            print(f"{s['stage'][:31]:32}{s['calls']:>7}{s['total_ms']:>12.0f}{s['p50_ms']:>10.1f}{s['p95_ms']:>10.1f}"
+                  f"{s['rows_read']:>14}{s['peak_memory_bytes']:>12}{s['errors']:>8}")
+        return
+    if not args.stage:
+        parser.error("trend needs --stage")
+    print(f"{'day':12}{'calls':>7}{'p50 ms':>10}{'p95 ms':>10}{'avg rows read':>15}")
+    for d in report.stage_trend(args.stage, args.days):
+        print(f"{d['day']:12}{d['calls']:>7}{d['p50_ms']:>10.1f}{d['p95_ms']:>10.1f}{d['avg_rows_read']:>15.0f}")
+
+if __name__ == '__main__':
+    main()
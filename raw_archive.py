@@ -0,0 +1,252 @@
+"""
+Raw Archive - Moves old raw MongoDB batches into monthly Parquet files and replays them for reprocessing
+Keeps the hot raw collection small; the manifest records every archived file
+"""
+import argparse
+import hashlib
+import json
+import os
+import zlib
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional
+from bson import Binary, ObjectId, json_util
+import config
+from mongodb_etl import CONTENT_ADDRESSED_FIELDS, MongoDBETL
+
+try:
+    import pyarrow as pa  # Optional: only needed for archival and replay
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+MANIFEST_FILE = "manifest.json"
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _batch_time(doc: Dict) -> datetime:
+    """When a raw batch was fetched; legacy documents without source_timestamp fall back to the ObjectId time"""
+    try:
+        return datetime.fromisoformat(doc['source_timestamp'].rstrip('Z'))
+    except (KeyError, AttributeError, ValueError):
+        return doc['_id'].generation_time.replace(tzinfo=None)
+
+class RawArchiver:
+    def __init__(self, mongodb_etl: Optional[MongoDBETL] = None, archive_dir: Optional[str] = None):
+        if pa is None:
+            raise RuntimeError("Raw batch archival needs the pyarrow package (pip install pyarrow)")
+        self.mongodb_etl = mongodb_etl or MongoDBETL()
+        self.archive_dir = archive_dir or config.ARCHIVE_DIR
+        self.batch_size = config.ARCHIVE_BATCH_SIZE
+        self.compression = config.ARCHIVE_COMPRESSION
+        self.manifest_path = os.path.join(self.archive_dir, MANIFEST_FILE)
+
+    def load_manifest(self) -> Dict:
+        if not os.path.exists(self.manifest_path):
+            return {'files': []}
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def _save_manifest(self, manifest: Dict):
+        # Write then rename so a crash never leaves a truncated manifest
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _archive_row(self, doc: Dict) -> Dict:
+        """One Parquet row per raw batch: filterable metadata columns plus the full document"""
+        # Archived files must be self-contained, so content-addressed forecasts and referenced observations are inlined
+        document = dict(self.mongodb_etl.resolve_observations(self.mongodb_etl.resolve_payloads(doc)))
+        for kind in CONTENT_ADDRESSED_FIELDS:
+            document.pop(f'{kind}_ref', None)
+        cold = self.mongodb_etl.cold_collection.find_one({'raw_doc_id': doc['_id']})
+        return {
+            'raw_doc_id': str(doc['_id']),
+            'etl_batch_id': doc.get('etl_batch_id'),
+            'source_time': _batch_time(doc),
+            'location_id': (doc.get('location') or {}).get('location_id'),
+            'data_quality': doc.get('data_quality'),
+            'observation_count': len(document.get('observations', [])) + len(document.get('historical_observations', [])),
+            'document': json_util.dumps(document),
+            'cold_payload': bytes(cold['payload']) if cold else None
+        }
+
+    def _write_partition(self, month: str, rows: List[Dict]) -> Dict:
+        partition_dir = os.path.join(self.archive_dir, f"month={month}")
+        os.makedirs(partition_dir, exist_ok=True)
+        path = os.path.join(partition_dir, f"part-{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}.parquet")
+        table = pa.Table.from_pylist(rows)
+        pq.write_table(table, path, compression=self.compression)
+
+        # Read the file back before anything is deleted from MongoDB
+        if pq.read_metadata(path).num_rows != len(rows):
+            raise RuntimeError(f"Archive file {path} is incomplete")
+        return {
+            'path': os.path.relpath(path, self.archive_dir),
+            'month': month,
+            'rows': len(rows),
+            'observations': sum(row['observation_count'] for row in rows),
+            'first_batch_time': min(row['source_time'] for row in rows).isoformat(),
+            'last_batch_time': max(row['source_time'] for row in rows).isoformat(),
+            'bytes': os.path.getsize(path),
+            'sha256': _file_sha256(path),
+            'archived_at_utc': datetime.utcnow().isoformat()
+        }
+
+    def _release_references(self, docs: List[Dict]):
+        """Drop cold payloads and blob references held by archived raw batches"""
+        raw_ids = [doc['_id'] for doc in docs]
+        self.mongodb_etl.cold_collection.delete_many({'raw_doc_id': {'$in': raw_ids}})
+        for doc in docs:
+            for kind in CONTENT_ADDRESSED_FIELDS:
+                ref = doc.get(f'{kind}_ref')
+                if ref:
+                    self.mongodb_etl.blobs_collection.update_one({'_id': ref['hash']}, {'$inc': {'ref_count': -1}})
+        self.mongodb_etl.blobs_collection.delete_many({'ref_count': {'$lte': 0}})
+
+    def archive(self, older_than_days: Optional[int] = None, dry_run: bool = False) -> Dict:
+        """Move raw batches older than the cutoff into monthly Parquet partitions, then delete them from MongoDB"""
+        older_than_days = config.ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+        cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+        query = {'$or': [
+            {'source_timestamp': {'$lt': cutoff.isoformat() + "Z"}},
+            {'source_timestamp': {'$exists': False}, '_id': {'$lt': ObjectId.from_datetime(cutoff)}}
+        ]}
+        print(f"Archiving raw batches older than {cutoff.isoformat()} to {self.archive_dir}")
+        if dry_run:
+            count = self.mongodb_etl.raw_collection.count_documents(query)
+            print(f"Dry run: {count} raw batches would be archived")
+            return {'batches': count, 'files': []}
+
+        os.makedirs(self.archive_dir, exist_ok=True)
+        manifest = self.load_manifest()
+        written = []
+        archived = 0
+        while True:
+            # Archived documents are deleted, so every pass picks up the next oldest chunk
+            docs = list(self.mongodb_etl.raw_collection.find(query).sort('_id', 1).limit(self.batch_size))
+            if not docs:
+                break
+            by_month: Dict[str, List[Dict]] = {}
+            for doc in docs:
+                row = self._archive_row(doc)
+                by_month.setdefault(row['source_time'].strftime('%Y-%m'), []).append(row)
+            for month, rows in sorted(by_month.items()):
+                entry = self._write_partition(month, rows)
+                manifest['files'].append(entry)
+                written.append(entry)
+            self._save_manifest(manifest)
+
+            # Only delete once the files and manifest are on disk
+            self.mongodb_etl.raw_collection.delete_many({'_id': {'$in': [doc['_id'] for doc in docs]}})
+            self._release_references(docs)
+            archived += len(docs)
+            print(f"  Archived {archived} raw batches so far")
+
+        archived_bytes = sum(entry['bytes'] for entry in written)
+        print(f"Archived {archived} raw batches into {len(written)} files ({archived_bytes} bytes); "
+              f"{self.mongodb_etl.raw_collection.estimated_document_count()} remain in MongoDB")
+        return {'batches': archived, 'files': written, 'bytes': archived_bytes}
+
+    def manifest_entries(self, months: Optional[List[str]] = None) -> List[Dict]:
+        return [entry for entry in self.load_manifest()['files'] if not months or entry['month'] in months]
+
+    def iter_file_documents(self, entry: Dict) -> Iterator[Dict]:
+        """Yield the raw batch documents of one archive file"""
+        parquet_file = pq.ParquetFile(os.path.join(self.archive_dir, entry['path']))
+        for batch in parquet_file.iter_batches(batch_size=self.batch_size, columns=['document']):
+            for document in batch.column('document').to_pylist():
+                yield json_util.loads(document)
+
+    def iter_documents(self, months: Optional[List[str]] = None) -> Iterator[Dict]:
+        """Yield archived raw batch documents (with their original _id) in archive order"""
+        for entry in self.manifest_entries(months):
+            yield from self.iter_file_documents(entry)
+
+    def _replay_chunk(self, clickhouse_etl, docs: List[Dict]) -> int:
+        # Archived batches were usually loaded before, so their rows are replaced rather than added
+        rows = clickhouse_etl.replace_observations(clickhouse_etl.extract_observations_from_documents(docs))
+        clickhouse_etl.load_forecasts(docs)
+        return rows
+
+    def replay_to_clickhouse(self, months: Optional[List[str]] = None) -> int:
+        """Reparse archived batches into ClickHouse, e.g. after a schema change or an overwrite load.
+        Rows already loaded for the same observations are replaced, so replaying twice adds nothing."""
+        from clickhouse_etl import ClickHouseETL
+        clickhouse_etl = ClickHouseETL()
+        rows = 0
+        chunk = []
+        for doc in self.iter_documents(months):
+            chunk.append(doc)
+            if len(chunk) >= self.batch_size:
+                rows += self._replay_chunk(clickhouse_etl, chunk)
+                chunk = []
+        if chunk:
+            rows += self._replay_chunk(clickhouse_etl, chunk)
+        clickhouse_etl.compute_aggregates()
+        print(f"Replayed {rows} observations from the archive into ClickHouse")
+        return rows
+
+    def restore_to_mongodb(self, months: Optional[List[str]] = None) -> int:
+        """Put archived batches back into the raw collection (idempotent on _id), then drop their files from
+        the archive so later replays and overwrite loads do not read them a second time"""
+        restored = 0
+        for entry in self.manifest_entries(months):
+            parquet_file = pq.ParquetFile(os.path.join(self.archive_dir, entry['path']))
+            for batch in parquet_file.iter_batches(batch_size=self.batch_size, columns=['document', 'cold_payload']):
+                for document, cold_payload in zip(batch.column('document').to_pylist(),
+                                                  batch.column('cold_payload').to_pylist()):
+                    doc = json_util.loads(document)
+                    # Back to the hot layout: observations in the observation store, referenced by id
+                    observation_ids = self.mongodb_etl.store_observations(doc)['observation_ids']
+                    doc = self.mongodb_etl.reference_observations(doc, observation_ids)
+                    self.mongodb_etl.raw_collection.replace_one({'_id': doc['_id']}, doc, upsert=True)
+                    if cold_payload is not None:
+                        self.mongodb_etl.cold_collection.replace_one({'raw_doc_id': doc['_id']}, {
+                            'raw_doc_id': doc['_id'],
+                            'etl_batch_id': doc.get('etl_batch_id'),
+                            'stored_at_utc': datetime.utcnow(),
+                            'encoding': 'json+zlib',
+                            'original_bytes': len(zlib.decompress(cold_payload)),
+                            'compressed_bytes': len(cold_payload),
+                            'payload': Binary(cold_payload)
+                        }, upsert=True)
+                    restored += 1
+
+            # Only once every batch of the file is back in MongoDB
+            manifest = self.load_manifest()
+            manifest['files'] = [kept for kept in manifest['files'] if kept['path'] != entry['path']]
+            self._save_manifest(manifest)
+            os.remove(os.path.join(self.archive_dir, entry['path']))
+            print(f"  Restored {entry['rows']} raw batches from {entry['path']} and removed it from the archive")
+        print(f"Restored {restored} raw batches to {config.MONGODB_COLLECTION_RAW}")
+        return restored
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive old raw MongoDB batches to Parquet or replay them")
+    parser.add_argument("command", choices=["archive", "replay", "restore", "manifest"])
+    parser.add_argument("--older-than-days", type=int, default=config.ARCHIVE_AFTER_DAYS)
+    parser.add_argument("--month", action="append", help="Limit replay/restore to a month (YYYY-MM), repeatable")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    archiver = RawArchiver()
+    if args.command == "archive":
+        archiver.archive(args.older_than_days, args.dry_run)
+    elif args.command == "replay":
+        archiver.replay_to_clickhouse(args.month)
+    elif args.command == "restore":
+        archiver.restore_to_mongodb(args.month)
+    else:
+        for entry in archiver.manifest_entries():
+            print(f"{entry['month']}  {entry['rows']:>6} batches  {entry['observations']:>8} obs  "
+                  f"{entry['bytes']:>10} bytes  {entry['path']}")
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@ from datetime import datetime
 from typing import Dict, Optional
 import config
 from clickhouse_etl import ClickHouseETL
+from query_stats import profiled_stage
 
 class RedisETL:
     def __init__(self):
@@ -19,6 +20,7 @@ class RedisETL:
         self.clickhouse_etl = ClickHouseETL()
         self.ttl = config.REDIS_TTL
     
+    @profiled_stage
     def cache_monthly_averages(self, months: int = 12) -> Dict:
         """Cache monthly averages from ClickHouse"""
         print("Fetching monthly averages from ClickHouse...")
@@ -68,6 +70,7 @@ class RedisETL:
         print(f"Cached monthly averages (TTL: {self.ttl}s)")
         return cache_data
     
+    @profiled_stage
     def cache_daily_averages(self, days: int = 30) -> Dict:
         """Cache daily averages from ClickHouse"""
         print("Fetching daily averages from ClickHouse...")
@@ -83,7 +86,7 @@ class RedisETL:
             LIMIT {days}
         """
         
-        results = self.clickhouse_etl.client.execute(query)
+        results = self.clickhouse_etl.pool.execute(query)
         
         daily_data = [
             {
@@ -95,6 +98,19 @@ class RedisETL:
             for row in results
         ]
         
+        # The current day is read from MongoDB's running aggregate (one document, up to date as soon as
+        # observations are stored) instead of waiting for the next warehouse aggregation
+        today = self.clickhouse_etl.mongodb_etl.get_daily_stats()
+        if today:
+            daily_data = [row for row in daily_data if row['date'] != today['date']]
+            daily_data.append({
+                'date': today['date'],
+                'avg_temperature_c': today['avg_temperature_c'],
+                'total_rainfall_mm': today['total_rainfall_mm'],
+                'avg_humidity_percent': today['avg_humidity_percent']
+            })
+            daily_data = sorted(daily_data, key=lambda row: row['date'], reverse=True)[:days]
+        
         cache_data = {
             'cache_timestamp': datetime.utcnow().isoformat() + "Z",
             'data_version': f"v{int(datetime.utcnow().timestamp())}",
@@ -116,6 +132,31 @@ class RedisETL:
         print(f"Cached daily averages (TTL: {self.ttl}s)")
         return cache_data
     
+    @profiled_stage
+    def cache_anomalies(self, days: Optional[int] = None) -> Dict:
+        """Cache recently flagged readings from ClickHouse"""
+        days = days or config.ANOMALY_CACHE_DAYS
+        print("Fetching recent anomalies from ClickHouse...")
+        anomalies = self.clickhouse_etl.anomaly_detector.get_recent_anomalies(days)
+        
+        cache_data = {
+            'cache_timestamp': datetime.utcnow().isoformat() + "Z",
+            'data_version': f"v{int(datetime.utcnow().timestamp())}",
+            'refresh_interval_sec': config.REDIS_TTL,
+            'period_days': days,
+            'anomalies': anomalies
+        }
+        
+        cache_key = "weather:stockton:anomalies"
+        self.client.setex(
+            cache_key,
+            self.ttl,
+            json.dumps(cache_data, default=str)
+        )
+        
+        print(f"Cached {len(anomalies)} anomalies (TTL: {self.ttl}s)")
+        return cache_data
+    
     def get_cached_data(self, key: str = "weather:stockton:monthly_averages") -> Optional[Dict]:
         """Retrieve cached data from Redis"""
         cached = self.client.get(key)
@@ -129,11 +170,13 @@ class RedisETL:
         
         monthly_cache = self.cache_monthly_averages(12)
         daily_cache = self.cache_daily_averages(30)
+        anomaly_cache = self.cache_anomalies()
         
         print("Redis sync completed")
         return {
             'monthly_cached': bool(monthly_cache),
             'daily_cached': bool(daily_cache),
+            'anomalies_cached': bool(anomaly_cache),
             'cache_timestamp': datetime.utcnow().isoformat() + "Z"
         }
     
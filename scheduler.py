@@ -7,6 +7,8 @@ from datetime import datetime
 from mongodb_etl import MongoDBETL
 from clickhouse_etl import ClickHouseETL
 from redis_etl import RedisETL
+from cdc_consumer import ChangeStreamCDC
+from raw_archive import RawArchiver
 import config
 
 class PipelineScheduler:
@@ -19,7 +21,10 @@ class PipelineScheduler:
         """Sync from API to MongoDB"""
         print(f"\n[{datetime.now()}] Starting API -> MongoDB sync...")
         try:
-            self.mongodb_etl.sync_from_api("partial")
+            if config.FANOUT_ENABLED:
+                self.mongodb_etl.sync_locations("partial")
+            else:
+                self.mongodb_etl.sync_from_api("partial")
             print(f"[{datetime.now()}] API -> MongoDB sync completed")
         except Exception as e:
             print(f"[{datetime.now()}] Error in API -> MongoDB sync: {e}")
@@ -42,22 +47,46 @@ class PipelineScheduler:
         except Exception as e:
             print(f"[{datetime.now()}] Error in ClickHouse -> Redis sync: {e}")
     
+    def archive_raw_batches(self):
+        """Move old raw batches from MongoDB to the Parquet archive"""
+        print(f"\n[{datetime.now()}] Starting raw batch archival...")
+        try:
+            RawArchiver(self.mongodb_etl).archive()
+            print(f"[{datetime.now()}] Raw batch archival completed")
+        except Exception as e:
+            print(f"[{datetime.now()}] Error in raw batch archival: {e}")
+    
     def start(self):
         """Start the scheduler"""
         print("=" * 60)
         print("Weather Data Pipeline Scheduler")
         print("=" * 60)
         print(f"API -> MongoDB: Every {config.SYNC_INTERVAL_API_TO_MONGODB} minutes")
-        print(f"MongoDB -> ClickHouse: Every {config.SYNC_INTERVAL_MONGODB_TO_CLICKHOUSE} minutes")
+        if config.CDC_ENABLED:
+            print(f"MongoDB -> ClickHouse: Change stream (batch window {config.CDC_BATCH_WINDOW_SEC}s)")
+        else:
+            print(f"MongoDB -> ClickHouse: Every {config.SYNC_INTERVAL_MONGODB_TO_CLICKHOUSE} minutes")
         print(f"ClickHouse -> Redis: Every {config.SYNC_INTERVAL_CLICKHOUSE_TO_REDIS} minutes")
+        if config.ARCHIVE_ENABLED:
+            print(f"Raw archival: Daily, batches older than {config.ARCHIVE_AFTER_DAYS} days")
         print("=" * 60)
         print("Scheduler started. Press Ctrl+C to stop.")
         print()
         
         # Schedule jobs
         schedule.every(config.SYNC_INTERVAL_API_TO_MONGODB).minutes.do(self.sync_api_to_mongodb)
-        schedule.every(config.SYNC_INTERVAL_MONGODB_TO_CLICKHOUSE).minutes.do(self.sync_mongodb_to_clickhouse)
+        if not config.CDC_ENABLED:
+            schedule.every(config.SYNC_INTERVAL_MONGODB_TO_CLICKHOUSE).minutes.do(self.sync_mongodb_to_clickhouse)
         schedule.every(config.SYNC_INTERVAL_CLICKHOUSE_TO_REDIS).minutes.do(self.sync_clickhouse_to_redis)
+        if config.ARCHIVE_ENABLED:
+            schedule.every().day.at("03:00").do(self.archive_raw_batches)
+        
+        cdc_consumer = None
+        if config.CDC_ENABLED:
+            # The consumer gets its own ClickHouse connection since it runs on another thread.
+            # Its start position is fixed before the initial sync, so inserts made meanwhile are not lost.
+            cdc_consumer = ChangeStreamCDC()
+            cdc_consumer.record_start_position()
         
         # Run initial sync
         print(f"[{datetime.now()}] Running initial sync...")
@@ -67,6 +96,10 @@ class PipelineScheduler:
         time.sleep(5)
         self.sync_clickhouse_to_redis()
         
+        if cdc_consumer:
+            # New enriched documents now reach ClickHouse within the CDC batch window
+            cdc_consumer.start_background()
+        
         # Keep running
         while True:
             schedule.run_pending()
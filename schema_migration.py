@@ -0,0 +1,191 @@
+"""
+Schema Migration - Upgrades weather_observations online to the partitioned, codec-compressed schema
+Copies month by month into a new table, catches up rows written meanwhile, then swaps the tables.
+Reports on-disk size and scan times before and after.
+"""
+import argparse
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+from clickhouse_driver import Client
+from clickhouse_etl import OBSERVATIONS_TABLE_DDL, create_client
+
+LIVE_TABLE = "weather_observations"
+MIGRATION_TABLE = "weather_observations_migration"
+OLD_TABLE = "weather_observations_unpartitioned"
+
+# Representative scans; {station} is the least-observed station so pruning is visible
+SCAN_QUERIES = {
+    'daily_rollup': "SELECT toDate(timestamp) AS d, avg(temperature_c), sum(rainfall_mm) FROM {table} GROUP BY d",
+    'station_filter': "SELECT count(), avg(temperature_c) FROM {table} WHERE station_id = '{station}'",
+    'last_30_days': "SELECT count(), max(temperature_c) FROM {table} WHERE timestamp >= now() - INTERVAL 30 DAY"
+}
+
+class ObservationsSchemaMigration:
+    def __init__(self, client: Optional[Client] = None, scan_runs: int = 3):
+        # Month copies can run long, so this uses a dedicated connection with a generous socket timeout
+        self.client = client or create_client(query_timeout_sec=3600)
+        self.scan_runs = scan_runs
+
+    def is_migrated(self, table: str = LIVE_TABLE) -> bool:
+        rows = self.client.execute(
+            "SELECT partition_key FROM system.tables WHERE database = currentDatabase() AND name = %(table)s",
+            {'table': table}
+        )
+        return bool(rows and rows[0][0])
+
+    def storage_stats(self, table: str) -> Dict:
+        """Active-part sizes from system.parts"""
+        rows, parts, on_disk, compressed, uncompressed = self.client.execute("""
+            SELECT sum(rows), count(), sum(bytes_on_disk), sum(data_compressed_bytes), sum(data_uncompressed_bytes)
+            FROM system.parts
+            WHERE database = currentDatabase() AND table = %(table)s AND active
+        """, {'table': table})[0]
+        return {
+            'rows': rows or 0,
+            'parts': parts,
+            'bytes_on_disk': on_disk or 0,
+            'compressed_bytes': compressed or 0,
+            'uncompressed_bytes': uncompressed or 0,
+            'compression_ratio': round(uncompressed / compressed, 2) if compressed else None
+        }
+
+    def scan_stats(self, table: str) -> Dict:
+        """Best-of-N wall time and rows read for each representative scan"""
+        station = self.client.execute(
+            f"SELECT station_id FROM {table} GROUP BY station_id ORDER BY count() ASC LIMIT 1"
+        )
+        station = station[0][0] if station else ''
+        results = {}
+        for name, query in SCAN_QUERIES.items():
+            timings = []
+            rows_read = None
+            for _ in range(self.scan_runs):
+                started = time.perf_counter()
+                self.client.execute(query.format(table=table, station=station))
+                timings.append(time.perf_counter() - started)
+                last_query = getattr(self.client, 'last_query', None)
+                if last_query is not None and last_query.progress is not None:
+                    rows_read = last_query.progress.rows
+            results[name] = {'best_ms': round(min(timings) * 1000, 2), 'rows_read': rows_read}
+        return results
+
+    def report(self, table: str) -> Dict:
+        return {'storage': self.storage_stats(table), 'scans': self.scan_stats(table)}
+
+    def _months(self, table: str) -> List[int]:
+        return [row[0] for row in self.client.execute(
+            f"SELECT DISTINCT toYYYYMM(timestamp) AS month FROM {table} ORDER BY month"
+        )]
+
+    def _catch_up(self, source: str, target: str, watermark: datetime) -> datetime:
+        """Copy rows ingested at or after the watermark that the target lacks, and return the new watermark.
+        ingest_time_utc has second resolution, so more rows can land in the watermark's second after it was read;
+        the observation_id check keeps the copy idempotent."""
+        new_watermark = self.client.execute(f"SELECT max(ingest_time_utc) FROM {source}")[0][0] or watermark
+        self.client.execute(
+            f"INSERT INTO {target} SELECT * FROM {source} "
+            f"WHERE ingest_time_utc >= %(low)s AND ingest_time_utc <= %(high)s "
+            f"AND observation_id NOT IN (SELECT observation_id FROM {target} WHERE ingest_time_utc >= %(low)s)",
+            {'low': watermark, 'high': new_watermark}
+        )
+        return new_watermark
+
+    def _verify_copy(self, source: str, target: str, watermark: datetime):
+        """ID diff of everything ingested up to the watermark; missing rows are copied once more before giving up"""
+        missing_query = (f"FROM {source} WHERE ingest_time_utc <= %(high)s "
+                         f"AND observation_id NOT IN (SELECT observation_id FROM {target})")
+        missing = self.client.execute(f"SELECT count() {missing_query}", {'high': watermark})[0][0]
+        if missing:
+            print(f"  {missing} rows missing from {target}; copying them")
+            self.client.execute(f"INSERT INTO {target} SELECT * {missing_query}", {'high': watermark})
+        source_rows, target_rows = (
+            self.client.execute(f"SELECT count() FROM {table} WHERE ingest_time_utc <= %(high)s", {'high': watermark})[0][0]
+            for table in (source, target)
+        )
+        if target_rows < source_rows:
+            raise RuntimeError(f"{target} has {target_rows} rows up to {watermark}, {source} has {source_rows}; "
+                               f"not swapping")
+
+    def _swap(self):
+        """Swap the migrated table in, leaving the old schema's data in the migration table"""
+        try:
+            self.client.execute(f"EXCHANGE TABLES {LIVE_TABLE} AND {MIGRATION_TABLE}")
+        except Exception as e:
+            # EXCHANGE needs an Atomic database; a multi-table RENAME is still a single statement
+            print(f"EXCHANGE TABLES unavailable ({e}), falling back to RENAME")
+            self.client.execute(f"RENAME TABLE {LIVE_TABLE} TO {LIVE_TABLE}_swap, "
+                                f"{MIGRATION_TABLE} TO {LIVE_TABLE}, {LIVE_TABLE}_swap TO {MIGRATION_TABLE}")
+
+    def migrate(self, keep_old: bool = True) -> Optional[Dict]:
+        """Copy into the new schema month by month while writes continue, then swap it in"""
+        if self.is_migrated():
+            print(f"{LIVE_TABLE} is already partitioned; nothing to migrate")
+            return None
+
+        print(f"[{datetime.now()}] Measuring {LIVE_TABLE} before migration...")
+        before = self.report(LIVE_TABLE)
+
+        self.client.execute(f"DROP TABLE IF EXISTS {MIGRATION_TABLE}")
+        self.client.execute(OBSERVATIONS_TABLE_DDL.format(table=MIGRATION_TABLE))
+
+        # Rows ingested up to the watermark are copied per month; later rows are caught up before the swap
+        watermark = self.client.execute(f"SELECT max(ingest_time_utc) FROM {LIVE_TABLE}")[0][0]
+        started = time.perf_counter()
+        for month in self._months(LIVE_TABLE):
+            self.client.execute(
+                f"INSERT INTO {MIGRATION_TABLE} SELECT * FROM {LIVE_TABLE} "
+                f"WHERE toYYYYMM(timestamp) = %(month)s AND ingest_time_utc <= %(watermark)s",
+                {'month': month, 'watermark': watermark}
+            )
+            print(f"  Copied {month}")
+        watermark = self._catch_up(LIVE_TABLE, MIGRATION_TABLE, watermark)
+        self._verify_copy(LIVE_TABLE, MIGRATION_TABLE, watermark)
+
+        self._swap()
+        # Anything that landed in the old table between the last catch-up and the swap
+        self._catch_up(MIGRATION_TABLE, LIVE_TABLE, watermark)
+        copy_sec = time.perf_counter() - started
+
+        self.client.execute(f"DROP TABLE IF EXISTS {OLD_TABLE}")
+        self.client.execute(f"RENAME TABLE {MIGRATION_TABLE} TO {OLD_TABLE}")
+        print(f"Swapped in the partitioned schema in {copy_sec:.1f}s; old table kept as {OLD_TABLE}")
+
+        # Merge the per-month inserts so the size comparison is not skewed by small parts
+        self.client.execute(f"OPTIMIZE TABLE {LIVE_TABLE} FINAL")
+        after = self.report(LIVE_TABLE)
+        print_comparison(before, after)
+
+        if not keep_old:
+            self.client.execute(f"DROP TABLE {OLD_TABLE}")
+            print(f"Dropped {OLD_TABLE}")
+        return {'before': before, 'after': after, 'copy_sec': copy_sec}
+
+def print_comparison(before: Dict, after: Dict):
+    print("\n" + "=" * 60)
+    print(f"{'':24}{'before':>16}{'after':>16}")
+    for key in ('rows', 'parts', 'bytes_on_disk', 'compressed_bytes', 'uncompressed_bytes', 'compression_ratio'):
+        print(f"{key:24}{str(before['storage'][key]):>16}{str(after['storage'][key]):>16}")
+    for name in SCAN_QUERIES:
+        b, a = before['scans'][name], after['scans'][name]
+        print(f"{name + ' ms':24}{b['best_ms']:>16}{a['best_ms']:>16}")
+        print(f"{name + ' rows read':24}{str(b['rows_read']):>16}{str(a['rows_read']):>16}")
+    print("=" * 60)
+
+def main():
+    parser = argparse.ArgumentParser(description="Upgrade weather_observations to the partitioned schema")
+    parser.add_argument("--report-only", action="store_true", help="Print size and scan stats without migrating")
+    parser.add_argument("--drop-old", action="store_true", help=f"Drop {OLD_TABLE} after a successful swap")
+    args = parser.parse_args()
+
+    migration = ObservationsSchemaMigration()
+    if args.report_only:
+        report = migration.report(LIVE_TABLE)
+        print(f"Storage: {report['storage']}")
+        for name, stats in report['scans'].items():
+            print(f"{name}: {stats['best_ms']} ms, {stats['rows_read']} rows read")
+        return
+    migration.migrate(keep_old=not args.drop_old)
+
+if __name__ == '__main__':
+    main()
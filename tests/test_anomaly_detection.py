@@ -0,0 +1,98 @@
+import math
+import statistics
+from datetime import datetime, timezone
+
+from anomaly_detection import OVERALL_BUCKET, AnomalyDetector, season_bucket
+
+def ts(*args) -> int:
+    return int(datetime(*args, tzinfo=timezone.utc).timestamp())
+
+class RecordingClient:
+    """Answers the detector's queries from fixed rows and records every call"""
+    def __init__(self, baselines=(), observations=()):
+        self.baselines = list(baselines)
+        self.observations = list(observations)
+        self.calls = []
+
+    def execute(self, query, params=None, **kwargs):
+        self.calls.append((query, params))
+        if 'FROM anomaly_baselines' in query:
+            return self.baselines
+        if 'FROM weather_observations' in query:
+            return self.observations
+        return []
+
+    def queries(self, fragment):
+        return [(query, params) for query, params in self.calls if fragment in query]
+
+def test_season_bucket_uses_meteorological_seasons():
+    assert season_bucket(datetime(2024, 12, 1, 0)) == 'DJF-00'
+    assert season_bucket(datetime(2024, 1, 15, 7)) == 'DJF-07'
+    assert season_bucket(datetime(2024, 3, 1, 12)) == 'MAM-12'
+    assert season_bucket(datetime(2024, 8, 31, 23)) == 'JJA-23'
+    assert season_bucket(datetime(2024, 11, 30, 14)) == 'SON-14'
+
+def test_welford_update_matches_batch_statistics():
+    values = [12.5, 14.0, 9.75, 18.25, 15.5, 11.0]
+    baseline = {'count': 0, 'mean': 0.0, 'm2': 0.0, 'last_hour': 0}
+    for i, value in enumerate(values):
+        AnomalyDetector._update(baseline, value, 3600 * (10 - i))
+
+    assert baseline['count'] == len(values)
+    assert math.isclose(baseline['mean'], statistics.mean(values))
+    assert math.isclose(baseline['m2'] / (baseline['count'] - 1), statistics.variance(values))
+    # Watermark is the newest hour seen, not the last one folded in
+    assert baseline['last_hour'] == 3600 * 10
+
+def test_score_needs_enough_samples_and_spread():
+    detector = AnomalyDetector(RecordingClient(), z_threshold=3, min_samples=5)
+    assert detector._score(None, 10.0) is None
+    assert detector._score({'count': 4, 'mean': 0.0, 'm2': 3.0}, 10.0) is None
+    assert detector._score({'count': 5, 'mean': 7.0, 'm2': 0.0}, 10.0) is None
+    z_score, std = detector._score({'count': 5, 'mean': 7.0, 'm2': 4.0}, 10.0)
+    assert std == 1.0
+    assert z_score == 3.0
+
+def test_hours_at_or_before_every_watermark_are_skipped():
+    watermark = ts(2024, 6, 1, 12)
+    client = RecordingClient(baselines=[
+        ('KSCK', 'temperature_c', OVERALL_BUCKET, 50, 20.0, 49.0, watermark),
+        ('KMOD', 'temperature_c', OVERALL_BUCKET, 50, 20.0, 49.0, watermark + 7200),
+    ])
+    detector = AnomalyDetector(client, z_threshold=3, min_samples=5)
+
+    assert detector.process([watermark - 3600, watermark]) == 0
+    assert not client.queries('FROM weather_observations')
+
+def test_newer_hours_are_filtered_per_station_in_the_query():
+    watermark = ts(2024, 6, 1, 12)
+    client = RecordingClient(baselines=[
+        ('KSCK', 'temperature_c', OVERALL_BUCKET, 50, 20.0, 49.0, watermark),
+        ('KMOD', 'temperature_c', OVERALL_BUCKET, 50, 20.0, 49.0, watermark + 7200),
+    ])
+    detector = AnomalyDetector(client, z_threshold=3, min_samples=5)
+    detector.process([watermark, watermark + 3600, watermark + 10800])
+
+    (query, params), = client.queries('FROM weather_observations')
+    assert params['hours'] == [watermark + 3600, watermark + 10800]
+    # Each station's own watermark is applied server-side
+    assert 'transform(toString(station_id)' in query
+    assert dict(zip(params['stations'], params['watermarks'])) == {'KSCK': watermark, 'KMOD': watermark + 7200}
+
+def test_outlier_is_flagged_against_the_station_wide_baseline_while_the_bucket_warms_up():
+    hour = ts(2024, 7, 1, 15)
+    client = RecordingClient(
+        baselines=[('KSCK', 'temperature_c', OVERALL_BUCKET, 10, 20.0, 9.0, hour - 3600)],
+        observations=[('KSCK', hour, 30.0, None, None, None)]
+    )
+    detector = AnomalyDetector(client, z_threshold=3, min_samples=5)
+
+    assert detector.process([hour]) == 1
+    (_, rows), = client.queries('INSERT INTO observation_anomalies')
+    station_id, _, metric, value, mean, std, z_score, bucket, count, _ = rows[0]
+    assert (station_id, metric, value, mean, std, z_score, bucket, count) == \
+        ('KSCK', 'temperature_c', 30.0, 20.0, 1.0, 10.0, OVERALL_BUCKET, 10)
+
+    # Both the seasonal and the station-wide baselines learn the new reading
+    (_, baselines), = client.queries('INSERT INTO anomaly_baselines')
+    assert {row[2]: row[3] for row in baselines} == {'JJA-15': 1, OVERALL_BUCKET: 11}
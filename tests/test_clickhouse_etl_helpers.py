@@ -0,0 +1,107 @@
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import pyarrow as pa
+import pytest
+
+from clickhouse_etl import ClickHouseETL, _arrow_type, _forecast_wind_speed_ms
+
+def row(station, hour):
+    timestamp = datetime(2026, 6, 1, hour, tzinfo=timezone.utc)
+    return {'observation_id': f"{station}_{int(timestamp.timestamp())}", 'timestamp': timestamp}
+
+def test_unloaded_observations_skips_rows_already_in_the_table():
+    queries = []
+    loaded = row('KSCK', 1)
+    etl = object.__new__(ClickHouseETL)
+    etl.execute_bulk = lambda query, params: queries.append(params) or [(loaded['observation_id'],)]
+
+    fresh = [row('KSCK', 2), row('KMOD', 3)]
+    assert etl.unloaded_observations([loaded] + fresh) == fresh
+
+    # One lookup, bounded by the batch's time range
+    assert len(queries) == 1
+    assert (queries[0]['start'], queries[0]['end']) == (int(loaded['timestamp'].timestamp()),
+                                                        int(fresh[-1]['timestamp'].timestamp()))
+    assert queries[0]['ids'] == [loaded['observation_id']] + [obs['observation_id'] for obs in fresh]
+
+def test_unloaded_observations_without_rows_skips_the_lookup():
+    etl = object.__new__(ClickHouseETL)
+    etl.execute_bulk = None
+    assert etl.unloaded_observations([]) == []
+
+@pytest.mark.parametrize('text, expected', [
+    ('10 mph', 4.4704),
+    ('10 to 20 mph', 15 * 0.44704),
+    ('18 km/h', 5.0),
+    ('7.5 to 12.5 km/h', 10 / 3.6),
+])
+def test_forecast_wind_speed_converts_to_meters_per_second(text, expected):
+    assert _forecast_wind_speed_ms(text) == pytest.approx(expected)
+
+@pytest.mark.parametrize('text', [None, '', 'Calm'])
+def test_forecast_wind_speed_without_a_number_is_unknown(text):
+    assert _forecast_wind_speed_ms(text) is None
+
+@pytest.mark.parametrize('clickhouse_type, expected', [
+    ('DateTime', pa.timestamp('s')),
+    ("DateTime('UTC')", pa.timestamp('s')),
+    ('Date', pa.date32()),
+    ('String', pa.string()),
+    ('UInt8', pa.uint8()),
+    ('Int16', pa.int16()),
+    ('Float64', pa.float64()),
+    ('Nullable(Float64)', pa.float64()),
+    ('LowCardinality(String)', pa.string()),
+    ('LowCardinality(Nullable(String))', pa.string()),
+    ("Enum8('a' = 1, 'b' = 2)", pa.string()),
+    ('Decimal(10, 2)', pa.decimal128(10, 2)),
+    ('Array(Nullable(String))', pa.list_(pa.string())),
+    ('Map(String, Array(Float64))', pa.map_(pa.string(), pa.list_(pa.float64()))),
+])
+def test_arrow_type_maps_clickhouse_types(clickhouse_type, expected):
+    assert _arrow_type(clickhouse_type) == expected
+
+@pytest.mark.parametrize('clickhouse_type', ['Int128', 'AggregateFunction(avg, Float64)', 'Array(Int128)'])
+def test_arrow_type_leaves_unmapped_types_to_inference(clickhouse_type):
+    assert _arrow_type(clickhouse_type) is None
+
+class ExportClient:
+    """execute_iter stand-in: column names and types first, then the rows"""
+    def __init__(self, column_types, rows):
+        self.column_types = column_types
+        self.rows = rows
+
+    def execute_iter(self, query, params, **kwargs):
+        yield self.column_types
+        yield from self.rows
+
+def test_export_batches_keep_non_scalar_columns():
+    column_types = [('station_id', 'String'), ('tags', 'Array(String)'),
+                    ('readings', 'Map(String, Float64)'), ('amount', 'Decimal(10, 2)'), ('counter', 'Int128')]
+    rows = [('KSCK', ['a', 'b'], {'t': 1.5}, Decimal('1.25'), 7),
+            ('KMOD', [], {}, Decimal('2.50'), 8),
+            ('KSCK', ['c'], {'t': 2.0, 'h': 40.0}, None, 9)]
+    etl = object.__new__(ClickHouseETL)
+    etl.client = ExportClient(column_types, rows)
+
+    batches = list(etl.iter_export_batches('observations', datetime(2026, 6, 1), datetime(2026, 6, 2), batch_rows=2))
+
+    assert [batch.num_rows for batch in batches] == [2, 1]
+    schema = batches[0].schema
+    assert schema.field('tags').type == pa.list_(pa.string())
+    assert schema.field('readings').type == pa.map_(pa.string(), pa.float64())
+    assert schema.field('amount').type == pa.decimal128(10, 2)
+    # Int128 has no fixed mapping; its type comes from the first block
+    assert schema.field('counter').type == pa.int64()
+    assert all(batch.schema == schema for batch in batches)
+    table = pa.Table.from_batches(batches)
+    assert table.column('tags').to_pylist() == [['a', 'b'], [], ['c']]
+    assert table.column('readings').to_pylist()[2] == [('t', 2.0), ('h', 40.0)]
+
+def test_export_rejects_a_column_arrow_cannot_hold_before_streaming():
+    etl = object.__new__(ClickHouseETL)
+    etl.client = ExportClient([('counter', 'Int128')], [(2 ** 100,)])
+
+    with pytest.raises(ValueError, match='counter of type Int128'):
+        next(etl.iter_export_batches('observations', datetime(2026, 6, 1), datetime(2026, 6, 2)))
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from mongodb_etl import MongoDBETL
+
+mongomock = pytest.importorskip('mongomock')
+
+def observation(station, timestamp, temperature=None, precipitation=None, humidity=None):
+    """Observation collection document with NWS-style {'value': v} measurements"""
+    return {
+        'observation_id': f"{station}_{int(timestamp.timestamp())}",
+        'station_id': station,
+        'timestamp': timestamp,
+        'properties': {
+            'timestamp': timestamp.isoformat() + '+00:00',
+            'temperature': {'value': temperature},
+            'precipitationLastHour': {'value': precipitation},
+            'relativeHumidity': {'value': humidity},
+        },
+    }
+
+@pytest.fixture
+def etl():
+    """MongoDBETL over an in-memory observations collection, without connecting anywhere"""
+    etl = object.__new__(MongoDBETL)
+    etl.observations_collection = mongomock.MongoClient().db.observations
+    return etl
+
+def test_window_metrics_buckets_by_day_with_unit_conversions(etl):
+    day = datetime(2026, 6, 1)
+    etl.observations_collection.insert_many([
+        observation('KSCK', day + timedelta(hours=1), temperature=293.15, precipitation=0.002, humidity=40.0),
+        observation('KSCK', day + timedelta(hours=2), temperature=22.0, humidity=60.0),
+        observation('KMOD', day + timedelta(hours=3), temperature=18.0, precipitation=1.5),
+        observation('KSCK', day + timedelta(days=1, hours=1), temperature=30.0),
+        # Outside the window
+        observation('KSCK', day + timedelta(days=2), temperature=99.0),
+    ])
+
+    metrics = etl.compute_window_metrics(day, day + timedelta(days=2))
+
+    assert [row['period'] for row in metrics] == ['2026-06-01', '2026-06-02']
+    first = metrics[0]
+    assert first['observation_count'] == 3
+    assert first['station_count'] == 2
+    # 293.15 K is 20 C; 0.002 m is 2 mm, 1.5 is already mm
+    assert first['avg_temperature_c'] == pytest.approx(20.0)
+    assert (first['min_temperature_c'], first['max_temperature_c']) == pytest.approx((18.0, 22.0))
+    assert first['total_rainfall_mm'] == pytest.approx(3.5)
+    assert first['rainfall_count'] == 2
+    assert first['avg_humidity_percent'] == pytest.approx(50.0)
+    assert metrics[1]['observation_count'] == 1
+    assert metrics[1]['total_rainfall_mm'] is None
+
+def test_window_metrics_for_one_station_over_the_whole_window(etl):
+    day = datetime(2026, 6, 1)
+    etl.observations_collection.insert_many([
+        observation('KSCK', day + timedelta(hours=1), temperature=20.0),
+        observation('KMOD', day + timedelta(hours=1), temperature=30.0),
+        observation('KSCK', day + timedelta(days=1), temperature=24.0),
+    ])
+
+    metrics = etl.compute_window_metrics(day, day + timedelta(days=7), station_id='KSCK', bucket='all')
+
+    assert len(metrics) == 1
+    assert metrics[0]['period'] is None
+    assert metrics[0]['observation_count'] == 2
+    assert metrics[0]['avg_temperature_c'] == pytest.approx(22.0)
+
+class RecordingCollection:
+    """Captures the aggregation pipeline; mongomock does not implement $setWindowFields"""
+    def __init__(self):
+        self.pipeline = None
+
+    def aggregate(self, pipeline):
+        self.pipeline = pipeline
+        return iter([])
+
+def test_rolling_metrics_read_back_one_window_before_the_start():
+    etl = object.__new__(MongoDBETL)
+    etl.observations_collection = RecordingCollection()
+    start, end = datetime(2026, 6, 2), datetime(2026, 6, 3)
+
+    assert etl.compute_rolling_metrics(start, end, window_hours=6, station_id='KSCK') == []
+
+    stages = etl.observations_collection.pipeline
+    assert stages[0] == {'$match': {'timestamp': {'$gte': start - timedelta(hours=6), '$lt': end},
+                                    'station_id': 'KSCK'}}
+    window = next(stage['$setWindowFields'] for stage in stages if '$setWindowFields' in stage)
+    assert window['partitionBy'] == '$station_id'
+    assert window['sortBy'] == {'timestamp': 1}
+    assert window['output']['rolling_avg_temperature_c'] == {'$avg': '$temp_c', 'window': {'range': [-6, 0], 'unit': 'hour'}}
+    # The lookback rows are dropped after the windows are computed
+    assert {'$match': {'timestamp': {'$gte': start}}} in stages[stages.index({'$setWindowFields': window}):]
@@ -0,0 +1,209 @@
+import json
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from nws_api_fetcher_v2 import NWSAPIFetcher, RateLimiter, StationCache, dedupe_observations, ijson
+
+TOTAL_FEATURES = 260
+
+class ObservationPages(BaseHTTPRequestHandler):
+    """/stations/KSCK/observations serves TOTAL_FEATURES features in pages of the requested limit, linked
+    by pagination.next. /stations/STUCK/observations always links back to the same cursor."""
+    max_page = None
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        self.server.requests.append((parts.path, query))
+        limit = int(query['limit'])
+        base = f"http://127.0.0.1:{self.server.server_port}{parts.path}"
+        if parts.path == '/stations/STUCK/observations':
+            offset, count, cursor = 0, 30, 'abc'
+        else:
+            offset = int(query.get('cursor', 0))
+            count = max(min(limit, self.server.max_page or limit, TOTAL_FEATURES - offset), 0)
+            cursor = offset + count
+        body = json.dumps({
+            'type': 'FeatureCollection',
+            'features': [{'properties': {'timestamp': f'obs-{offset + i}', 'temperature': {'value': 20.0}}}
+                         for i in range(count)],
+            # NWS links a next page even past the end of the data
+            'pagination': {'next': f"{base}?cursor={cursor}&limit={limit}"}
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/geo+json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def nws_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ObservationPages)
+    server.requests = []
+    server.max_page = None
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture(params=['json', 'streaming'])
+def fetcher(request, nws_server):
+    if request.param == 'streaming' and ijson is None:
+        pytest.skip("streaming decode needs ijson")
+    fetcher = NWSAPIFetcher(rate_limiter=RateLimiter(0))
+    fetcher.base_url = f"http://127.0.0.1:{nws_server.server_port}"
+    fetcher.streaming_decode = request.param == 'streaming'
+    fetcher.page_limit_min = 10
+    fetcher.page_limit_max = 200
+    return fetcher
+
+START, END = datetime(2024, 6, 1), datetime(2024, 6, 8)
+
+def test_iter_observations_follows_the_cursor_to_the_last_page(fetcher, nws_server):
+    features = list(fetcher.iter_observations('KSCK', START, END, page_limit=50))
+
+    assert [f['properties']['timestamp'] for f in features] == [f'obs-{i}' for i in range(TOTAL_FEATURES)]
+    first_path, first_query = nws_server.requests[0]
+    assert first_path == '/stations/KSCK/observations'
+    assert (first_query['start'], first_query['end']) == ('2024-06-01T00:00:00Z', '2024-06-08T00:00:00Z')
+    # Every later request is the previous page's cursor; the empty page after the data ends the loop
+    assert [query.get('cursor') for _, query in nws_server.requests] == [None, '50', '150', '260']
+
+def test_iter_observations_grows_the_page_size_while_pages_are_full(fetcher, nws_server):
+    list(fetcher.iter_observations('KSCK', START, END, page_limit=50))
+
+    # 50 and 100 come back full and double, capped at page_limit_max; the short 110 page keeps 200
+    assert [int(query['limit']) for _, query in nws_server.requests] == [50, 100, 200, 200]
+
+def test_iter_observations_shrinks_the_page_size_when_pages_thin_out(fetcher, nws_server):
+    nws_server.max_page = 30
+    features = list(fetcher.iter_observations('KSCK', START, END, page_limit=100))
+
+    assert len(features) == TOTAL_FEATURES
+    limits = [int(query['limit']) for _, query in nws_server.requests]
+    # A 30-row page against a limit of 100 drops the limit to what the server returns; from there a full
+    # page doubles it again and a half-full one keeps it
+    assert limits[:3] == [100, 30, 60]
+    assert max(limits[1:]) == 60
+
+def test_iter_observations_stops_when_the_cursor_does_not_advance(fetcher, nws_server):
+    features = list(fetcher.iter_observations('STUCK', START, END, page_limit=50))
+
+    # The first page links to ?cursor=abc, whose page links to itself again
+    assert len(nws_server.requests) == 2
+    assert len(features) == 60
+
+def test_rate_limiter_spaces_requests():
+    limiter = RateLimiter(max_per_second=50)
+    started = time.monotonic()
+    for _ in range(6):
+        limiter.wait()
+    # The first request goes at once, the next five 20 ms apart
+    assert time.monotonic() - started >= 0.095
+
+def test_rate_limiter_shares_slots_between_threads():
+    limiter = RateLimiter(max_per_second=100)
+    calls = []
+    lock = threading.Lock()
+
+    def worker():
+        for _ in range(3):
+            limiter.wait()
+            with lock:
+                calls.append(time.monotonic())
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    calls.sort()
+    assert len(calls) == 12
+    # Twelve slots 10 ms apart, whichever thread got them
+    assert calls[-1] - calls[0] >= 0.105
+
+def test_rate_limiter_without_a_limit_does_not_wait():
+    limiter = RateLimiter(max_per_second=0)
+    started = time.monotonic()
+    for _ in range(100):
+        limiter.wait()
+    assert time.monotonic() - started < 0.05
+
+def test_station_cache_fetches_a_shared_station_once():
+    cache = StationCache()
+    fetches = []
+    release = threading.Event()
+
+    def load():
+        fetches.append(1)
+        release.wait(1)
+        return ['obs']
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_fetch(('latest', 'KSCK'), load)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert fetches == [1]
+    assert results == [['obs']] * 4
+    assert (cache.misses, cache.hits) == (1, 3)
+
+def test_station_cache_stores_shared_observations_once():
+    cache = StationCache()
+    stored = []
+
+    def store(ids):
+        stored.append(ids)
+        return len(ids)
+
+    assert cache.store_once('KSCK', ['KSCK_1', 'KSCK_2'], lambda: store(['KSCK_1', 'KSCK_2'])) == (2, True)
+    # A second location with the same observations of the station only references them
+    assert cache.store_once('KSCK', ['KSCK_2', 'KSCK_1'], lambda: store(['KSCK_2', 'KSCK_1'])) == (2, False)
+    # A different set of the station's observations is stored on its own
+    assert cache.store_once('KSCK', ['KSCK_3'], lambda: store(['KSCK_3'])) == (1, True)
+
+    assert stored == [['KSCK_1', 'KSCK_2'], ['KSCK_3']]
+    assert cache.observations_shared == 2
+    # Stores do not count as station fetches
+    assert (cache.misses, cache.hits) == (0, 0)
+
+def feature(station, timestamp, temperature):
+    """NWS GeoJSON observation feature"""
+    return {'properties': {'station': f'https://api.weather.gov/stations/{station}', 'timestamp': timestamp,
+                           'temperature': {'value': temperature}}}
+
+def test_dedupe_keeps_the_first_occurrence_within_a_set():
+    first = feature('KSCK', '2024-06-01T12:00:00+00:00', 20.0)
+    repeat = feature('KSCK', '2024-06-01T12:00:00+00:00', 21.0)
+    other = feature('KSCK', '2024-06-01T13:00:00+00:00', 22.0)
+
+    observations, removed = dedupe_observations([first, repeat, other])
+    assert observations == [first, other]
+    assert removed == 1
+
+def test_dedupe_across_sets_and_schemas():
+    latest = [feature('KSCK', '2024-06-01T12:00:00+00:00', 20.0)]
+    # Slim-schema record of the same observation, plus one from another station at the same time
+    historical = [
+        {'station_id': 'KSCK', 'timestamp': '2024-06-01T12:00:00+00:00', 'temperature': 20.0},
+        {'station_id': 'KMOD', 'timestamp': '2024-06-01T12:00:00+00:00', 'temperature': 23.0},
+    ]
+
+    deduped_latest, deduped_historical, removed = dedupe_observations(latest, historical)
+    assert deduped_latest == latest
+    assert deduped_historical == historical[1:]
+    assert removed == 1
@@ -0,0 +1,19 @@
+from schema_migration import LIVE_TABLE, MIGRATION_TABLE, ObservationsSchemaMigration
+
+class OrdinaryDatabaseClient:
+    """Records statements and rejects EXCHANGE, like a database without the Atomic engine"""
+    def __init__(self):
+        self.queries = []
+
+    def execute(self, query, params=None):
+        if query.startswith("EXCHANGE"):
+            raise Exception("EXCHANGE TABLES is supported only for Atomic databases")
+        self.queries.append(query)
+        return []
+
+def test_swap_falls_back_to_rename_without_exchange():
+    client = OrdinaryDatabaseClient()
+    ObservationsSchemaMigration(client=client)._swap()
+
+    assert client.queries == [f"RENAME TABLE {LIVE_TABLE} TO {LIVE_TABLE}_swap, "
+                              f"{MIGRATION_TABLE} TO {LIVE_TABLE}, {LIVE_TABLE}_swap TO {MIGRATION_TABLE}"]
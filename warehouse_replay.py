@@ -0,0 +1,222 @@
+"""
+Warehouse Replay - Rebuilds weather_observations from MongoDB into a shadow table and swaps it in
+Reads the observation collection, legacy raw batches and/or the Parquet archive in parallel chunks;
+use after fixing observation parsing
+"""
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import Dict, List, Optional
+import config
+from clickhouse_etl import ClickHouseETL
+from query_stats import profiled_stage
+from raw_archive import MANIFEST_FILE, RawArchiver
+
+LIVE_TABLE = "weather_observations"
+SHADOW_TABLE = "weather_observations_shadow"
+PREVIOUS_TABLE = "weather_observations_previous"
+
+class WarehouseReplay:
+    def __init__(self, clickhouse_etl: Optional[ClickHouseETL] = None, workers: Optional[int] = None,
+                 chunk_docs: Optional[int] = None):
+        self.clickhouse_etl = clickhouse_etl or ClickHouseETL()
+        self.mongodb_etl = self.clickhouse_etl.mongodb_etl
+        self.client = self.clickhouse_etl.client
+        self.workers = workers or config.REPLAY_WORKERS
+        self.chunk_docs = chunk_docs or config.REPLAY_CHUNK_DOCS
+        self._lock = threading.Lock()
+        self.stats = {'documents': 0, 'rows': 0}
+
+    def _insert_rows(self, observations: List[Dict], documents: int) -> int:
+        # Each insert checks out its own pooled connection
+        rows = self.clickhouse_etl.insert_observations(observations, SHADOW_TABLE)
+        with self._lock:
+            self.stats['documents'] += documents
+            self.stats['rows'] += rows
+        return rows
+
+    def _load_chunk(self, raw_docs: List[Dict], skip_stored: bool = False) -> int:
+        """Parse a chunk of raw batches embedding their observations and insert the rows into the shadow table.
+        skip_stored drops observations the observation collection holds, when that is replayed as well."""
+        observations = self.clickhouse_etl.extract_observations_from_documents(raw_docs)
+        if skip_stored and observations:
+            stored = self.mongodb_etl.stored_observation_ids([obs['observation_id'] for obs in observations])
+            observations = [obs for obs in observations if obs['observation_id'] not in stored]
+        return self._insert_rows(observations, len(raw_docs))
+
+    def _observation_chunk(self, first_id, last_id) -> int:
+        """Insert one _id range of the observation collection, where each observation is stored once"""
+        docs = list(self.mongodb_etl.observations_collection.find({'_id': {'$gte': first_id, '$lte': last_id}}))
+        observations = [obs for obs in map(self.clickhouse_etl._parse_stored_observation, docs) if obs]
+        return self._insert_rows(observations, len(docs))
+
+    def _legacy_chunk(self, first_id, last_id) -> int:
+        """Raw batches from before the observation collection, which still embed their arrays"""
+        docs = list(self.mongodb_etl.raw_collection.find({'_id': {'$gte': first_id, '$lte': last_id},
+                                                          'observations': {'$exists': True}}))
+        return self._load_chunk(docs, skip_stored=True)
+
+    def _archive_file(self, archiver: RawArchiver, entry: Dict, skip_stored: bool = False) -> int:
+        rows = 0
+        chunk = []
+        for doc in archiver.iter_file_documents(entry):
+            chunk.append(doc)
+            if len(chunk) >= self.chunk_docs:
+                rows += self._load_chunk(chunk, skip_stored)
+                chunk = []
+        if chunk:
+            rows += self._load_chunk(chunk, skip_stored)
+        return rows
+
+    def _id_ranges(self, collection, query: Optional[Dict] = None, after_id=None) -> List[tuple]:
+        """Split a collection into _id ranges of chunk_docs documents each"""
+        query = dict(query or {})
+        if after_id is not None:
+            query['_id'] = {'$gt': after_id}
+        ids = [doc['_id'] for doc in collection.find(query, {'_id': 1}).sort('_id', 1)]
+        return [(ids[i], ids[min(i + self.chunk_docs, len(ids)) - 1]) for i in range(0, len(ids), self.chunk_docs)]
+
+    def _mongodb_ranges(self, after: Optional[Dict] = None) -> List[tuple]:
+        """(source, first _id, last _id) chunks of the observation collection and the legacy raw batches"""
+        after = after or {}
+        observations = self.mongodb_etl.observations_collection
+        raw = self.mongodb_etl.raw_collection
+        return ([('observations', first, last)
+                 for first, last in self._id_ranges(observations, after_id=after.get('observations'))] +
+                [('raw', first, last)
+                 for first, last in self._id_ranges(raw, {'observations': {'$exists': True}}, after.get('raw'))])
+
+    def _mongodb_chunk(self, source: str, first_id, last_id) -> int:
+        loader = self._observation_chunk if source == 'observations' else self._legacy_chunk
+        return loader(first_id, last_id)
+
+    def _snapshot(self) -> Dict:
+        """Newest _id of each source collection, so documents arriving during the replay are caught up later"""
+        snapshot = {}
+        for name, collection in (('observations', self.mongodb_etl.observations_collection),
+                                 ('raw', self.mongodb_etl.raw_collection)):
+            last_doc = collection.find_one({}, {'_id': 1}, sort=[('_id', -1)])
+            if last_doc:
+                snapshot[name] = last_doc['_id']
+        return snapshot
+
+    @profiled_stage
+    def _prepare_shadow(self):
+        self.client.execute(f"DROP TABLE IF EXISTS {SHADOW_TABLE}")
+        self.client.execute(f"CREATE TABLE {SHADOW_TABLE} AS {LIVE_TABLE}")
+
+    @profiled_stage
+    def row_count_diff(self, limit: int = 10) -> Dict:
+        """Compare row counts, distinct observations and per-day counts of the live and shadow tables"""
+        # Full scans of both tables, so these run under the bulk timeout
+        totals = {}
+        for table in (LIVE_TABLE, SHADOW_TABLE):
+            rows, distinct = self.clickhouse_etl.execute_bulk(
+                f"SELECT count(), uniqExact(observation_id) FROM {table}"
+            )[0]
+            totals[table] = {'rows': rows, 'distinct_observations': distinct}
+
+        daily_diff = self.clickhouse_etl.execute_bulk(f"""
+            SELECT date, countIf(source = 1) AS live_rows, countIf(source = 2) AS shadow_rows
+            FROM (
+                SELECT toDate(timestamp) AS date, 1 AS source FROM {LIVE_TABLE}
+                UNION ALL
+                SELECT toDate(timestamp) AS date, 2 AS source FROM {SHADOW_TABLE}
+            )
+            GROUP BY date
+            HAVING live_rows != shadow_rows
+            ORDER BY abs(toInt64(shadow_rows) - toInt64(live_rows)) DESC
+            LIMIT {int(limit)}
+        """)
+        live, shadow = totals[LIVE_TABLE], totals[SHADOW_TABLE]
+        print(f"Live:   {live['rows']} rows ({live['distinct_observations']} distinct observations)")
+        print(f"Shadow: {shadow['rows']} rows ({shadow['distinct_observations']} distinct observations)")
+        print(f"Diff:   {shadow['rows'] - live['rows']:+d} rows, "
+              f"{shadow['distinct_observations'] - live['distinct_observations']:+d} distinct observations")
+        for date, live_rows, shadow_rows in daily_diff:
+            print(f"  {date}: live {live_rows}, shadow {shadow_rows} ({shadow_rows - live_rows:+d})")
+        return {'live': live, 'shadow': shadow,
+                'daily_diff': [{'date': str(d), 'live_rows': l, 'shadow_rows': s} for d, l, s in daily_diff]}
+
+    @profiled_stage
+    def swap(self):
+        """Atomically swap the shadow table in, keeping the old data as weather_observations_previous"""
+        try:
+            self.client.execute(f"EXCHANGE TABLES {LIVE_TABLE} AND {SHADOW_TABLE}")
+        except Exception as e:
+            # EXCHANGE needs an Atomic database; a multi-table RENAME is still a single statement
+            print(f"EXCHANGE TABLES unavailable ({e}), falling back to RENAME")
+            self.client.execute(f"RENAME TABLE {LIVE_TABLE} TO {LIVE_TABLE}_swap, "
+                                f"{SHADOW_TABLE} TO {LIVE_TABLE}, {LIVE_TABLE}_swap TO {SHADOW_TABLE}")
+        self.client.execute(f"DROP TABLE IF EXISTS {PREVIOUS_TABLE}")
+        self.client.execute(f"RENAME TABLE {SHADOW_TABLE} TO {PREVIOUS_TABLE}")
+        print(f"Swapped the rebuilt table in; previous data kept in {PREVIOUS_TABLE}")
+
+    @profiled_stage
+    def run(self, source: str = "all", swap: bool = True) -> Dict:
+        """Rebuild the observations table from raw batches, report throughput and the row diff, then swap"""
+        started = time.perf_counter()
+        self._prepare_shadow()
+        archiver = None
+        if source in ("archive", "all") and os.path.exists(os.path.join(config.ARCHIVE_DIR, MANIFEST_FILE)):
+            archiver = RawArchiver(self.mongodb_etl)
+
+        # Observations and batches that arrive while the replay runs are caught up before the swap
+        snapshot = self._snapshot() if source in ("mongodb", "all") else {}
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="replay") as executor:
+            futures = []
+            for name, first_id, last_id in (self._mongodb_ranges() if snapshot else []):
+                if name in snapshot and first_id <= snapshot[name]:
+                    futures.append(executor.submit(self._mongodb_chunk, name, first_id, min(last_id, snapshot[name])))
+            if archiver:
+                # Archived batches' observations usually still live in the observation collection
+                for entry in archiver.manifest_entries():
+                    futures.append(executor.submit(self._archive_file, archiver, entry, source == "all"))
+            print(f"Replaying {len(futures)} chunks with {self.workers} workers into {SHADOW_TABLE}...")
+            for done, future in enumerate(as_completed(futures), 1):
+                future.result()
+                if done % 10 == 0 or done == len(futures):
+                    elapsed = time.perf_counter() - started
+                    print(f"  {done}/{len(futures)} chunks, {self.stats['rows']} rows ({self.stats['rows'] / elapsed:.0f} rows/s)")
+
+        if source in ("mongodb", "all"):
+            for name, first_id, last_id in self._mongodb_ranges(after=snapshot):
+                self._mongodb_chunk(name, first_id, last_id)
+            # Legacy daily aggregate documents are loaded by the regular path too
+            legacy = [obs for obs in map(self.clickhouse_etl._parse_daily_aggregate,
+                                         self.mongodb_etl.get_legacy_daily_aggregates()) if obs]
+            self.stats['rows'] += self.clickhouse_etl.insert_observations(legacy, SHADOW_TABLE)
+
+        elapsed = time.perf_counter() - started
+        print(f"Replayed {self.stats['documents']} documents, {self.stats['rows']} rows in {elapsed:.1f}s "
+              f"({self.stats['documents'] / elapsed:.1f} documents/s, {self.stats['rows'] / elapsed:.0f} rows/s)")
+
+        report = {'documents': self.stats['documents'], 'rows': self.stats['rows'], 'elapsed_sec': elapsed,
+                  'rows_per_sec': self.stats['rows'] / elapsed if elapsed else None,
+                  'diff': self.row_count_diff(), 'swapped': False}
+        if swap:
+            self.swap()
+            self.clickhouse_etl.rebuild_hourly_aggregates()
+            self.clickhouse_etl.compute_aggregates()
+            report['swapped'] = True
+        else:
+            print(f"Not swapped; inspect {SHADOW_TABLE} and rerun without --no-swap")
+        return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild weather_observations from raw batches via a shadow table")
+    parser.add_argument("--source", choices=["mongodb", "archive", "all"], default="all")
+    parser.add_argument("--workers", type=int, default=config.REPLAY_WORKERS)
+    parser.add_argument("--chunk-docs", type=int, default=config.REPLAY_CHUNK_DOCS)
+    parser.add_argument("--no-swap", action="store_true", help="Build and diff the shadow table without swapping it in")
+    args = parser.parse_args()
+
+    print(f"[{datetime.now()}] Starting warehouse replay from {args.source}")
+    WarehouseReplay(workers=args.workers, chunk_docs=args.chunk_docs).run(args.source, swap=not args.no_swap)
+
+if __name__ == '__main__':
+    main()